@@ -0,0 +1,71 @@
+import json
+import os
+import os.path
+
+from library_xml.files import atomic_write
+
+
+class ResultCache:
+    """Persistent cache of analysis results, one JSON file per key
+
+    Keys are Track.fingerprint values, so a result is reused as long as the file it was computed from doesn't change.
+    The files are spread in subdirectories named after the first two characters of the key.
+
+    Attributes:
+        path (str): path to the directory of the cache
+
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        os.makedirs(self.path, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return 'ResultCache("{}")'.format(self.path)
+
+    def __contains__(self, key: str) -> bool:
+        return os.path.isfile(self.file(key))
+
+    def get(self, key: str, default=None):
+        """
+        Args:
+            key: the key of the result
+            default (None): returned if there is no result for the key
+
+        Returns:
+            the cached result
+
+        """
+        try:
+            with open(self.file(key), "r", encoding="utf-8") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return default
+
+    def set(self, key: str, value) -> None:
+        """Stores a result, the file is replaced atomically so that concurrent readers never see a partial result
+
+        Args:
+            key: the key of the result
+            value: JSON serializable result
+
+        """
+        atomic_write(self.file(key), json.dumps(value))
+
+    def remove(self, key: str) -> None:
+        try:
+            os.remove(self.file(key))
+        except FileNotFoundError:
+            pass
+
+    def file(self, key: str, extension: str=".json") -> str:
+        """
+        Args:
+            key: the key of the result
+            extension (".json"): extension of the file, other extensions can be used to store data next to a result
+
+        Returns:
+            str: path to the file of a key
+
+        """
+        return os.path.join(self.path, key[:2], key + extension)
@@ -0,0 +1,259 @@
+import math
+
+import numpy
+
+from analysis.cache import ResultCache
+from analysis.pcm import PCMReader, map_library
+
+
+HASH_BITS = 64
+SEGMENTS = 16  # the track is cut in this many segments, each one described by its mean chroma vector
+FRAME_DURATION = 0.186  # seconds, length of an FFT frame
+SILENCE = 1e-3  # relative to the mean energy of the frames, leading and trailing frames under it are ignored
+MIN_FREQUENCY = 55.0
+MAX_FREQUENCY = 5000.0
+
+# random hyperplanes of the similarity hash, fixed so that hashes stay comparable between runs
+_PLANES = numpy.random.default_rng(0x5eed).standard_normal((HASH_BITS, SEGMENTS * 12))
+
+
+def _chroma_matrix(size: int, sample_rate: int) -> numpy.ndarray:
+    """(bins, 12) matrix summing the power of the FFT bins into pitch classes"""
+    frequencies = numpy.fft.rfftfreq(size, 1 / sample_rate)
+    matrix = numpy.zeros((len(frequencies), 12))
+    used = (frequencies >= MIN_FREQUENCY) & (frequencies <= MAX_FREQUENCY)
+    classes = numpy.round(12 * numpy.log2(frequencies[used] / 440.0)).astype(numpy.int64) % 12
+    matrix[numpy.nonzero(used)[0], classes] = 1.0
+    return matrix
+
+
+def chroma(path: str) -> tuple:
+    """Computes the chroma vectors of a file, one per FFT frame
+
+    Args:
+        path: path to the file
+
+    Returns:
+        (numpy.ndarray, float): array of shape (frames, 12) and the duration of the file in seconds
+
+    """
+    reader = PCMReader(path)
+    size = 1 << int(round(math.log2(FRAME_DURATION * reader.sample_rate)))
+    matrix = _chroma_matrix(size, reader.sample_rate)
+    window = numpy.hanning(size)
+
+    vectors = []
+    energies = []
+    remainder = numpy.zeros(0, dtype=numpy.float32)
+    frames = 0
+    for chunk in reader:
+        frames += len(chunk)
+        data = numpy.concatenate((remainder, chunk.mean(axis=1)))
+        count = len(data) // size
+        remainder = data[count * size:]
+        if not count:
+            continue
+        blocks = data[:count * size].reshape(count, size)
+        energies.append(numpy.square(blocks).mean(axis=1))
+        spectrum = numpy.abs(numpy.fft.rfft(blocks * window, axis=1)) ** 2
+        vectors.append(spectrum @ matrix)
+
+    duration = frames / reader.sample_rate if reader.sample_rate else 0.0
+    if not vectors:
+        return numpy.zeros((0, 12)), duration
+    vectors = numpy.concatenate(vectors)
+    energies = numpy.concatenate(energies)
+
+    loud = numpy.nonzero(energies > SILENCE * energies.mean())[0]
+    if not len(loud):
+        return numpy.zeros((0, 12)), duration
+    return vectors[loud[0]:loud[-1] + 1], duration
+
+
+def acoustic_fingerprint(path: str) -> dict:
+    """Computes a compact acoustic fingerprint of a file
+
+    The non silent part of the file is cut in SEGMENTS segments, the mean normalized chroma vector of each segment is
+    computed and the resulting vector is reduced to a HASH_BITS similarity hash (signs of random projections). Two
+    rips of the same recording give hashes at a small Hamming distance, whatever their codec and bitrate.
+
+    Args:
+        path: path to the file
+
+    Returns:
+        dict: "hash" as an hexadecimal string, None if the file is silent, and "duration" in seconds
+
+    """
+    vectors, duration = chroma(path)
+    if len(vectors) < SEGMENTS:
+        return {"hash": None, "duration": duration}
+
+    vectors = vectors / numpy.maximum(vectors.sum(axis=1, keepdims=True), 1e-12)
+    bounds = numpy.linspace(0, len(vectors), SEGMENTS + 1).astype(numpy.int64)
+    segments = numpy.add.reduceat(vectors, bounds[:-1], axis=0) / numpy.diff(bounds)[:, None]
+    # the square root evens out the dominant pitch classes, so that noise and coding artifacts weigh less
+    features = numpy.sqrt(segments).ravel()
+    features -= features.mean()
+
+    bits = (_PLANES @ features) > 0
+    value = 0
+    for bit in bits:
+        value = value << 1 | int(bit)
+    return {"hash": "{:016x}".format(value), "duration": duration}
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class FingerprintIndex:
+    """Locality-sensitive hashing index of acoustic fingerprints
+
+    A hash is cut in bands bands, every item is stored in one bucket per band, keyed by the band bits and the
+    duration of the item rounded to duration_tolerance. Two items at a Hamming distance smaller than bands share
+    at least one band, so they are always found, and a query only looks at the items of bands * 3 buckets.
+
+    Attributes:
+        bands (int): number of bands, must divide HASH_BITS
+        duration_tolerance (float): maximum difference of duration in seconds between duplicates
+
+    """
+
+    def __init__(self, bands: int=8, duration_tolerance: float=2.0):
+        if HASH_BITS % bands:
+            raise ValueError("bands must divide {}".format(HASH_BITS))
+        self.bands = bands
+        self.duration_tolerance = duration_tolerance
+        self._band_bits = HASH_BITS // bands
+        self._buckets = dict()
+        self._items = dict()  # item -> (hash, duration)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _keys(self, value: int):
+        mask = (1 << self._band_bits) - 1
+        for band in range(self.bands):
+            yield band, value >> (band * self._band_bits) & mask
+
+    def add(self, item, value: int, duration: float) -> None:
+        """
+        Args:
+            item: hashable identifier of the item
+            value: the fingerprint hash
+            duration: duration in seconds
+
+        """
+        self._items[item] = (value, duration)
+        bucket = int(duration // self.duration_tolerance)
+        for band, bits in self._keys(value):
+            self._buckets.setdefault((band, bits, bucket), []).append(item)
+
+    def query(self, value: int, duration: float, max_distance: int):
+        """Finds the items close to a fingerprint
+
+        Args:
+            value: the fingerprint hash
+            duration: duration in seconds
+            max_distance: maximum Hamming distance
+
+        Returns:
+            set: the items with a hash at most max_distance bits away and a duration within duration_tolerance
+
+        """
+        bucket = int(duration // self.duration_tolerance)
+        candidates = set()
+        for band, bits in self._keys(value):
+            for neighbour in (bucket - 1, bucket, bucket + 1):
+                candidates.update(self._buckets.get((band, bits, neighbour), ()))
+
+        found = set()
+        for item in candidates:
+            other, other_duration = self._items[item]
+            if abs(other_duration - duration) <= self.duration_tolerance and hamming(value, other) <= max_distance:
+                found.add(item)
+        return found
+
+
+class DuplicateFinder:
+    """Finds the tracks of a library which are copies of the same recording
+
+    Fingerprints are cached by Track.fingerprint, so only new or modified files are decoded.
+
+    Example:
+        finder = DuplicateFinder("cache/fingerprints")
+        for cluster in finder.find(library):
+            print([track.path for track in cluster])
+
+    Attributes:
+        cache (ResultCache): the acoustic fingerprints
+        max_distance (int): maximum Hamming distance between the hashes of duplicates
+        bands (int): number of bands of the index, distances under bands are always found
+        duration_tolerance (float): maximum difference of duration in seconds between duplicates
+        max_workers (int): number of processes used to compute the fingerprints, None for the number of processors
+
+    """
+
+    def __init__(self, cache_path: str, max_distance: int=6, bands: int=8, duration_tolerance: float=2.0, max_workers: int=None):
+        self.cache = ResultCache(cache_path)
+        self.max_distance = max_distance
+        self.bands = bands
+        self.duration_tolerance = duration_tolerance
+        self.max_workers = max_workers
+
+    def scan(self, tracks, executor=None) -> int:
+        """Computes the fingerprints of the tracks which are not in the cache yet
+
+        Args:
+            tracks: iterable of Track
+            executor (None): executor used instead of a new process pool
+
+        Returns:
+            int: number of fingerprints computed
+
+        """
+        missing = {track.fingerprint(): track for track in tracks}
+        missing = [track for key, track in missing.items() if key not in self.cache]
+
+        computed = 0
+        for track, result in map_library(missing, acoustic_fingerprint, self.max_workers, executor):
+            self.cache.set(track.fingerprint(), result)
+            computed += 1
+        return computed
+
+    def find(self, tracks, executor=None) -> list:
+        """Groups the duplicated tracks
+
+        Args:
+            tracks: iterable of Track
+            executor (None): executor used to compute the missing fingerprints
+
+        Returns:
+            list of list of Track: the clusters of at least two tracks, largest first
+
+        """
+        tracks = list(tracks)
+        self.scan(tracks, executor)
+
+        index = FingerprintIndex(self.bands, self.duration_tolerance)
+        parents = list(range(len(tracks)))
+
+        def root(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for i, track in enumerate(tracks):
+            result = self.cache.get(track.fingerprint())
+            if result is None or result["hash"] is None:
+                continue
+            value = int(result["hash"], 16)
+            for j in index.query(value, result["duration"], self.max_distance):
+                parents[root(j)] = root(i)
+            index.add(i, value, result["duration"])
+
+        clusters = dict()
+        for i, track in enumerate(tracks):
+            clusters.setdefault(root(i), []).append(track)
+        return sorted((cluster for cluster in clusters.values() if len(cluster) > 1), key=len, reverse=True)
@@ -0,0 +1,378 @@
+import math
+import time
+
+import numpy
+
+from analysis.cache import ResultCache
+from analysis.pcm import PCMReader, map_library
+
+
+REFERENCE_LOUDNESS = -18.0  # LUFS, ReplayGain 2.0 reference level
+ABSOLUTE_GATE = -70.0  # LUFS
+RELATIVE_GATE = -10.0  # LU
+HISTOGRAM_STEP = 0.01  # LU, resolution of the block loudness histograms
+OVERSAMPLING = 4  # true peak oversampling factor
+_PEAK_CONTEXT = 512  # samples on each side of a true peak segment, discarded after oversampling
+
+
+def _biquad_response(b, a, frequencies, sample_rate):
+    z = numpy.exp(-2j * numpy.pi * frequencies / sample_rate)
+    return (b[0] + b[1] * z + b[2] * z ** 2) / (a[0] + a[1] * z + a[2] * z ** 2)
+
+
+def k_weighting(frequencies: numpy.ndarray, sample_rate: int) -> numpy.ndarray:
+    """Computes the power response of the ITU-R BS.1770 K-weighting filter
+
+    The two filter stages (high shelf and high pass) are designed for the sample rate, so that the response is the
+    same as the 48 kHz reference filter at any rate.
+
+    Args:
+        frequencies: frequencies in Hz
+        sample_rate: sample rate in Hz
+
+    Returns:
+        numpy.ndarray: squared magnitude of the filter at each frequency
+
+    """
+    # high shelf, models the acoustic effect of the head
+    center, gain, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    K = math.tan(math.pi * center / sample_rate)
+    Vh = 10 ** (gain / 20)
+    Vb = Vh ** 0.4996667741545416
+    a0 = 1 + K / q + K * K
+    shelf_b = ((Vh + Vb * K / q + K * K) / a0, 2 * (K * K - Vh) / a0, (Vh - Vb * K / q + K * K) / a0)
+    shelf_a = (1.0, 2 * (K * K - 1) / a0, (1 - K / q + K * K) / a0)
+
+    # high pass, RLB weighting
+    center, q = 38.13547087602444, 0.5003270373238773
+    K = math.tan(math.pi * center / sample_rate)
+    a0 = 1 + K / q + K * K
+    pass_b = (1.0, -2.0, 1.0)
+    pass_a = (1.0, 2 * (K * K - 1) / a0, (1 - K / q + K * K) / a0)
+
+    response = _biquad_response(shelf_b, shelf_a, frequencies, sample_rate) * _biquad_response(pass_b, pass_a, frequencies, sample_rate)
+    return numpy.abs(response) ** 2
+
+
+def channel_weights(channels: int) -> numpy.ndarray:
+    """BS.1770 channel weights, the surround channels of a 5.1 stream count more and the LFE channel is ignored"""
+    weights = numpy.ones(channels)
+    if channels == 6:
+        weights[3] = 0.0
+        weights[4:] = 1.41
+    return weights
+
+
+class LoudnessMeter:
+    """Measures the integrated loudness and the true peak of PCM data, fed chunk by chunk
+
+    The signal is cut in 100 ms sub-blocks, the K-weighted mean square of every sub-block is computed at once for a
+    whole chunk with an FFT (Parseval's theorem applied to the filtered spectrum), and 400 ms gating blocks with
+    75 % overlap are averages of 4 consecutive sub-blocks. The true peak is measured on the signal oversampled 4
+    times, by zero padding the spectrum of every chunk.
+
+    Attributes:
+        sample_rate (int): sample rate of the data
+        channels (int): number of channels of the data
+        frames (int): number of frames measured
+
+    """
+
+    def __init__(self, sample_rate: int, channels: int):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frames = 0
+        self._block = int(round(sample_rate / 10))
+        self._response = k_weighting(numpy.fft.rfftfreq(self._block, 1 / sample_rate), sample_rate)
+        # Parseval, every bin except DC and Nyquist stands for two conjugate bins
+        self._response[1:(self._block + 1) // 2] *= 2
+        self._response /= self._block ** 2
+        self._weights = channel_weights(channels)
+        self._remainder = numpy.zeros((0, channels), dtype=numpy.float32)
+        self._sub_blocks = []
+        self._peak = 0.0
+        # the signal is silent before its start
+        self._peak_tail = numpy.zeros((_PEAK_CONTEXT, channels), dtype=numpy.float32)
+
+    def add(self, chunk: numpy.ndarray) -> None:
+        """Measures a chunk of PCM data
+
+        Args:
+            chunk: float array of shape (frames, channels)
+
+        """
+        self.frames += len(chunk)
+        self._add_peak(chunk)
+
+        data = numpy.concatenate((self._remainder, chunk)) if len(self._remainder) else chunk
+        count = len(data) // self._block
+        self._remainder = data[count * self._block:]
+        if not count:
+            return
+        blocks = data[:count * self._block].reshape(count, self._block, self.channels)
+        spectrum = numpy.fft.rfft(blocks, axis=1)
+        power = numpy.einsum("bfc,f->bc", numpy.abs(spectrum) ** 2, self._response)
+        self._sub_blocks.append(power @ self._weights)
+
+    def _add_peak(self, chunk: numpy.ndarray) -> None:
+        if not len(chunk):
+            return
+        self._peak = max(self._peak, float(numpy.abs(chunk).max()))
+
+        # the first _PEAK_CONTEXT frames of the tail were already measured, the others weren't
+        segment = numpy.concatenate((self._peak_tail, chunk))
+        self._peak_tail = segment[-2 * _PEAK_CONTEXT:]
+        self._peak = max(self._peak, self._oversampled_peak(segment))
+
+    def _oversampled_peak(self, segment: numpy.ndarray) -> float:
+        """peak of the segment oversampled, except on its edges which are distorted by the FFT"""
+        if len(segment) <= 2 * _PEAK_CONTEXT:
+            return 0.0
+        spectrum = numpy.fft.rfft(segment, axis=0)
+        oversampled = numpy.fft.irfft(spectrum, n=len(segment) * OVERSAMPLING, axis=0) * OVERSAMPLING
+        return float(numpy.abs(oversampled[_PEAK_CONTEXT * OVERSAMPLING:(len(segment) - _PEAK_CONTEXT) * OVERSAMPLING]).max())
+
+    def block_loudness(self) -> numpy.ndarray:
+        """
+        Returns:
+            numpy.ndarray: loudness in LUFS of every 400 ms gating block
+
+        """
+        if not self._sub_blocks:
+            return numpy.zeros(0)
+        sub_blocks = numpy.concatenate(self._sub_blocks)
+        if len(sub_blocks) < 4:
+            return numpy.zeros(0)
+        blocks = numpy.convolve(sub_blocks, numpy.full(4, 0.25), mode="valid")
+        with numpy.errstate(divide="ignore"):
+            return -0.691 + 10 * numpy.log10(blocks)
+
+    def true_peak(self) -> float:
+        """
+        Returns:
+            float: true peak in dBTP, -inf for digital silence
+
+        """
+        # the end of the signal is followed by silence
+        end = numpy.concatenate((self._peak_tail, numpy.zeros((_PEAK_CONTEXT, self.channels), dtype=numpy.float32)))
+        peak = max(self._peak, self._oversampled_peak(end))
+        return 20 * math.log10(peak) if peak > 0 else -math.inf
+
+    def result(self) -> dict:
+        """
+        Returns:
+            dict: the measures of the data, see analyse
+
+        """
+        histogram = loudness_histogram(self.block_loudness())
+        integrated = gated_loudness(histogram)
+        return {
+            "integrated": integrated,
+            "true_peak": self.true_peak() if self._peak > 0 else None,
+            "gain": REFERENCE_LOUDNESS - integrated if integrated is not None else None,
+            "duration": self.frames / self.sample_rate if self.sample_rate else 0.0,
+            "histogram": histogram,
+        }
+
+
+def loudness_histogram(block_loudness: numpy.ndarray) -> dict:
+    """Counts the gating blocks above the absolute gate in HISTOGRAM_STEP wide bins
+
+    The histograms of the tracks of an album can be added to compute the loudness of the album.
+
+    Args:
+        block_loudness: loudness of the gating blocks in LUFS
+
+    Returns:
+        dict: {bin: count}, the bin of a block is round(loudness / HISTOGRAM_STEP), the keys are strings for JSON
+
+    """
+    gated = block_loudness[block_loudness > ABSOLUTE_GATE]
+    bins, counts = numpy.unique(numpy.round(gated / HISTOGRAM_STEP).astype(numpy.int64), return_counts=True)
+    return {str(b): int(c) for b, c in zip(bins, counts)}
+
+
+def gated_loudness(*histograms) -> float:
+    """Computes the BS.1770 integrated loudness from block histograms
+
+    Args:
+        histograms: one or more histograms from loudness_histogram
+
+    Returns:
+        float: integrated loudness in LUFS, None if every block is below the absolute gate
+
+    """
+    total = dict()
+    for histogram in histograms:
+        for b, count in histogram.items():
+            total[int(b)] = total.get(int(b), 0) + count
+    if not total:
+        return None
+
+    bins = numpy.fromiter(total.keys(), dtype=numpy.float64, count=len(total))
+    counts = numpy.fromiter(total.values(), dtype=numpy.float64, count=len(total))
+    loudness = bins * HISTOGRAM_STEP
+    energy = 10 ** ((loudness + 0.691) / 10)
+
+    threshold = -0.691 + 10 * math.log10((energy * counts).sum() / counts.sum()) + RELATIVE_GATE
+    kept = loudness > threshold
+    if not kept.any():
+        return None
+    return -0.691 + 10 * math.log10((energy[kept] * counts[kept]).sum() / counts[kept].sum())
+
+
+def analyse(path: str) -> dict:
+    """Measures the loudness of a file
+
+    Args:
+        path: path to the file
+
+    Returns:
+        dict:
+            - "integrated": integrated loudness in LUFS, None for silence
+            - "true_peak": true peak in dBTP, None for silence
+            - "gain": ReplayGain 2.0 track gain in dB (REFERENCE_LOUDNESS - integrated)
+            - "duration": duration in seconds
+            - "histogram": block loudness histogram, see loudness_histogram
+
+    """
+    reader = PCMReader(path)
+    meter = LoudnessMeter(reader.sample_rate, reader.channels)
+    for chunk in reader:
+        meter.add(chunk)
+    return meter.result()
+
+
+def album_key(track) -> tuple:
+    """Groups tracks by album, MusicBrainz album id first and then album artist and album title"""
+    tags = track.tags
+    if tags.get("musicbrainz_albumid"):
+        return tuple(tags["musicbrainz_albumid"])
+    return tuple(tags.get("albumartist") or tags.get("artist") or []), tuple(tags.get("album") or [])
+
+
+class LoudnessScanner:
+    """Measures and caches the loudness of the tracks of a library
+
+    Results are cached by Track.fingerprint, so a track is only analysed again when its file changes.
+
+    Example:
+        scanner = LoudnessScanner("cache/loudness")
+        scanner.scan(library)
+        player.gain_provider = scanner.gain_provider(library, album=True)
+
+    Attributes:
+        cache (ResultCache): the results of the analysis
+        max_workers (int): number of processes used for the analysis, None for the number of processors
+
+    """
+
+    def __init__(self, cache_path: str, max_workers: int=None):
+        self.cache = ResultCache(cache_path)
+        self.max_workers = max_workers
+
+    def scan(self, tracks, executor=None) -> int:
+        """Analyses the tracks which are not in the cache yet
+
+        Args:
+            tracks: iterable of Track
+            executor (None): executor used instead of a new process pool
+
+        Returns:
+            int: number of tracks analysed
+
+        """
+        missing = {track.fingerprint(): track for track in tracks}
+        missing = [track for key, track in missing.items() if key not in self.cache]
+
+        analysed = 0
+        for track, result in map_library(missing, analyse, self.max_workers, executor):
+            self.cache.set(track.fingerprint(), result)
+            analysed += 1
+        return analysed
+
+    def track_result(self, track) -> dict:
+        """
+        Returns:
+            dict: the cached result of a track, see analyse, None if the track wasn't analysed
+
+        """
+        return self.cache.get(track.fingerprint())
+
+    def album_results(self, tracks) -> dict:
+        """Computes the album loudness and peak of every album of tracks
+
+        Args:
+            tracks: iterable of Track
+
+        Returns:
+            dict: {album_key: {"integrated", "true_peak", "gain"}}
+
+        """
+        albums = dict()
+        for track in tracks:
+            result = self.track_result(track)
+            if result is not None:
+                albums.setdefault(album_key(track), []).append(result)
+
+        results = dict()
+        for key, album in albums.items():
+            integrated = gated_loudness(*(result["histogram"] for result in album))
+            peaks = [result["true_peak"] for result in album if result["true_peak"] is not None]
+            results[key] = {
+                "integrated": integrated,
+                "true_peak": max(peaks) if peaks else None,
+                "gain": REFERENCE_LOUDNESS - integrated if integrated is not None else None,
+            }
+        return results
+
+    def gain_provider(self, tracks, album: bool=False, prevent_clipping: bool=True):
+        """Builds a function giving the gain to apply to a file, to be used as PlayAudio.gain_provider
+
+        Args:
+            tracks: iterable of Track
+            album (False): uses the album gain instead of the track gain
+            prevent_clipping (True): lowers the gain so that the true peak stays under 0 dBTP
+
+        Returns:
+            function taking a path and returning a gain in dB, or None for unknown files
+
+        """
+        tracks = list(tracks)
+        albums = self.album_results(tracks) if album else None
+        gains = dict()
+        for track in tracks:
+            result = albums[album_key(track)] if album and album_key(track) in albums else self.track_result(track)
+            if result is None or result["gain"] is None:
+                continue
+            gain = result["gain"]
+            if prevent_clipping and result["true_peak"] is not None:
+                gain = min(gain, -result["true_peak"])
+            gains[track.path] = gain
+        return gains.get
+
+
+def benchmark(tracks, max_workers: int=None) -> dict:
+    """Measures the analysis throughput, without the cache
+
+    Args:
+        tracks: iterable of Track
+        max_workers (None): number of processes
+
+    Returns:
+        dict: "tracks", "seconds", "audio_seconds" and "tracks_per_second"
+
+    """
+    start = time.perf_counter()
+    count = 0
+    duration = 0.0
+    for _, result in map_library(tracks, analyse, max_workers):
+        count += 1
+        duration += result["duration"]
+    seconds = time.perf_counter() - start
+    return {
+        "tracks": count,
+        "seconds": seconds,
+        "audio_seconds": duration,
+        "tracks_per_second": count / seconds if seconds else 0.0,
+    }
@@ -0,0 +1,224 @@
+import concurrent.futures
+import logging
+import os.path
+import wave
+from ctypes import create_string_buffer
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+
+class PCMReader:
+    """Decodes an audio file to PCM without playing it
+
+    The file is decoded in chunks, each chunk is a numpy.float32 array of shape (frames, channels) with samples
+    between -1 and 1. WAV files are read with the wave module, every other format is decoded by FMOD with
+    Mode.openonly and Sound.read_data.
+
+    Example:
+        reader = PCMReader(track.path)
+        for chunk in reader:
+            peak = max(peak, numpy.abs(chunk).max())
+
+    Attributes:
+        path (str): path to the file
+        chunk_frames (int): number of frames per chunk
+        sample_rate (int): sample rate of the decoded data
+        channels (int): number of channels of the decoded data
+
+    """
+
+    WAV_EXTENSIONS = {".wav", ".wave"}
+
+    def __init__(self, path: str, chunk_frames: int=65536):
+        self.path = path
+        self.chunk_frames = chunk_frames
+        if os.path.splitext(path)[1].lower() in PCMReader.WAV_EXTENSIONS:
+            self._chunks = self._read_wav()
+        else:
+            self._chunks = self._read_fmod()
+        # the generators read the format before yielding their first chunk
+        self.sample_rate, self.channels = next(self._chunks)
+
+    def __iter__(self):
+        return self._chunks
+
+    def __repr__(self) -> str:
+        return 'PCMReader("{}")'.format(self.path)
+
+    def read_all(self) -> numpy.ndarray:
+        """Decodes the remaining data in a single array
+
+        Returns:
+            numpy.ndarray: float32 array of shape (frames, channels)
+
+        """
+        chunks = list(self)
+        if not chunks:
+            return numpy.zeros((0, self.channels), dtype=numpy.float32)
+        return numpy.concatenate(chunks)
+
+    def _read_wav(self):
+        with wave.open(self.path, "rb") as file:
+            channels = file.getnchannels()
+            width = file.getsampwidth()
+            yield file.getframerate(), channels
+
+            while True:
+                data = file.readframes(self.chunk_frames)
+                if not data:
+                    return
+                yield to_float(data, width * 8, channels, signed=width > 1)
+
+    def _read_fmod(self):
+        from fmod import Mode, SoundFormat
+
+        opened = _decoding_system().create_sound(self.path, Mode.openonly | Mode.ignoretags)
+        try:
+            sound = opened
+            if sound.get_num_subsounds():
+                sound = sound.get_subsound(0)
+            _, format, channels, bits = sound.get_format()
+            frequency, _ = sound.get_defaults()
+            if format == SoundFormat.pcmfloat:
+                bits = 0
+            elif format not in {SoundFormat.pcm8, SoundFormat.pcm16, SoundFormat.pcm24, SoundFormat.pcm32}:
+                raise NotImplementedError("Not implemented sound format: {}".format(format))
+            yield int(frequency), channels
+
+            frame_size = channels * (bits // 8 if bits else 4)
+            size = self.chunk_frames * frame_size
+            buffer = create_string_buffer(size)
+            while True:
+                read = sound.read_data(buffer, size)
+                if not read:
+                    return
+                # only whole frames are converted
+                read -= read % frame_size
+                yield to_float(buffer.raw[:read], bits, channels)
+        finally:
+            # releasing the parent sound releases its subsounds as well
+            opened.release()
+
+
+def to_float(data: bytes, bits: int, channels: int, signed: bool=True) -> numpy.ndarray:
+    """Converts interleaved little endian PCM data to float samples
+
+    Args:
+        data: the PCM data
+        bits: bits per sample, 0 for 32 bit float data
+        channels: number of channels
+        signed (True): the integer samples are signed, 8 bit WAV data is unsigned
+
+    Returns:
+        numpy.ndarray: float32 array of shape (frames, channels) with samples between -1 and 1
+
+    """
+    if not bits:
+        samples = numpy.frombuffer(data, dtype="<f4")
+    elif bits == 24:
+        raw = numpy.frombuffer(data, dtype=numpy.uint8).reshape(-1, 3).astype(numpy.int32)
+        samples = (raw[:, 0] << 8 | raw[:, 1] << 16 | raw[:, 2] << 24) >> 8
+        samples = samples.astype(numpy.float32) / (1 << 23)
+    else:
+        dtype = numpy.dtype("<{}{}".format("i" if signed else "u", bits // 8))
+        samples = numpy.frombuffer(data, dtype=dtype).astype(numpy.float32)
+        if not signed:
+            samples -= 1 << (bits - 1)
+        samples /= 1 << (bits - 1)
+    return samples.astype(numpy.float32, copy=False).reshape(-1, channels)
+
+
+_system = None
+
+
+def _decoding_system():
+    """the FMOD system used to decode files, created on first use in each process"""
+    global _system
+    if _system is None:
+        from fmod import System, InitFlags, OutputType
+        _system = System(1, InitFlags.normal, output=OutputType.nosound_nrt)
+    return _system
+
+
+def read_pcm(path: str, chunk_frames: int=65536):
+    """Yields the PCM chunks of a file, see PCMReader
+
+    Args:
+        path: path to the file
+        chunk_frames (65536): number of frames per chunk
+
+    """
+    yield from PCMReader(path, chunk_frames)
+
+
+def summary(path: str) -> dict:
+    """Computes the duration, the peak and the RMS level of a file
+
+    Args:
+        path: path to the file
+
+    Returns:
+        dict: "duration" in seconds, "peak" and "rms" as linear amplitudes
+
+    """
+    reader = PCMReader(path)
+    frames = 0
+    peak = 0.0
+    square_sum = 0.0
+    for chunk in reader:
+        frames += len(chunk)
+        if len(chunk):
+            peak = max(peak, float(numpy.abs(chunk).max()))
+            square_sum += float(numpy.square(chunk, dtype=numpy.float64).sum())
+
+    return {
+        "duration": frames / reader.sample_rate if reader.sample_rate else 0.0,
+        "peak": peak,
+        "rms": (square_sum / (frames * reader.channels)) ** 0.5 if frames else 0.0,
+    }
+
+
+def _apply(function, path):
+    try:
+        return function(path), None
+    except Exception as e:
+        return None, e
+
+
+def map_library(tracks, function, max_workers: int=None, executor=None):
+    """Runs an analysis function on every track in a process pool
+
+    The function is called with the path of a track, it must be picklable (defined at the top level of a module).
+    Tracks for which the function fails are skipped and logged as warnings.
+
+    Example:
+        for track, stats in map_library(library, summary):
+            print(track.path, stats["peak"])
+
+    Args:
+        tracks: iterable of Track, a Library for example
+        function: function taking a path
+        max_workers (None): number of processes, defaults to the number of processors
+        executor (None): executor to use instead of creating a process pool
+
+    Yields:
+        (Track, result) in the order of tracks
+
+    """
+    tracks = list(tracks)
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+
+    try:
+        results = executor.map(_apply, [function] * len(tracks), [track.path for track in tracks])
+        for track, (result, error) in zip(tracks, results):
+            if error is not None:
+                logger.warning("Can't analyze %s: %s", track.path, error)
+                continue
+            yield track, result
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
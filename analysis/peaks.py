@@ -0,0 +1,281 @@
+import functools
+import math
+
+import numpy
+
+from analysis.cache import ResultCache
+from analysis.pcm import PCMReader, map_library
+from library_xml.files import atomic_write
+
+
+SCALE = 32767  # the summaries are stored as int16, samples between -1 and 1 are multiplied by SCALE
+MIN_LEVEL_SIZE = 64  # the pyramid stops at the first level with fewer bins
+
+
+class PeakBuilder:
+    """Computes the waveform summary of PCM data, fed chunk by chunk
+
+    The channels are mixed down: every bin of the base level holds the minimum and maximum sample over all the
+    channels and the RMS level of its samples_per_bin frames. Each next level halves the number of bins, until a level
+    has less than MIN_LEVEL_SIZE bins.
+
+    Attributes:
+        sample_rate (int): sample rate of the data
+        samples_per_bin (int): number of frames in a bin of the base level
+
+    """
+
+    def __init__(self, sample_rate: int, samples_per_bin: int=256):
+        self.sample_rate = sample_rate
+        self.samples_per_bin = samples_per_bin
+        self._remainder = None
+        self._minimums = []
+        self._maximums = []
+        self._squares = []
+        self._counts = []
+
+    def add(self, chunk: numpy.ndarray) -> None:
+        """Summarizes a chunk of PCM data
+
+        Args:
+            chunk: float array of shape (frames, channels)
+
+        """
+        data = numpy.concatenate((self._remainder, chunk)) if self._remainder is not None else chunk
+        count = len(data) // self.samples_per_bin
+        self._remainder = data[count * self.samples_per_bin:]
+        if count:
+            self._add_bins(data[:count * self.samples_per_bin].reshape(count, -1))
+
+    def _add_bins(self, bins: numpy.ndarray) -> None:
+        # bins: shape (bins, samples), the channels of each frame are consecutive samples
+        self._minimums.append(bins.min(axis=1))
+        self._maximums.append(bins.max(axis=1))
+        self._squares.append(numpy.square(bins, dtype=numpy.float64).sum(axis=1))
+        self._counts.append(numpy.full(len(bins), bins.shape[1], dtype=numpy.float64))
+
+    def levels(self) -> list:
+        """Builds the pyramid
+
+        Returns:
+            list of numpy.ndarray: int16 arrays of shape (bins, 3) holding min, max and RMS, base level first
+
+        """
+        if self._remainder is not None and len(self._remainder):
+            self._add_bins(self._remainder.reshape(1, -1))
+            self._remainder = None
+        if not self._minimums:
+            return [numpy.zeros((0, 3), dtype=numpy.int16)]
+
+        minimums = numpy.concatenate(self._minimums)
+        maximums = numpy.concatenate(self._maximums)
+        squares = numpy.concatenate(self._squares)
+        counts = numpy.concatenate(self._counts)
+        self._minimums, self._maximums, self._squares, self._counts = [minimums], [maximums], [squares], [counts]
+
+        levels = []
+        while True:
+            levels.append(_quantize(minimums, maximums, numpy.sqrt(squares / counts)))
+            if len(minimums) < 2 * MIN_LEVEL_SIZE:
+                return levels
+            if len(minimums) % 2:
+                minimums = numpy.append(minimums, minimums[-1])
+                maximums = numpy.append(maximums, maximums[-1])
+                squares = numpy.append(squares, 0.0)
+                counts = numpy.append(counts, 0.0)
+            minimums = minimums.reshape(-1, 2).min(axis=1)
+            maximums = maximums.reshape(-1, 2).max(axis=1)
+            squares = squares.reshape(-1, 2).sum(axis=1)
+            counts = counts.reshape(-1, 2).sum(axis=1)
+
+
+def _quantize(minimums, maximums, rms) -> numpy.ndarray:
+    level = numpy.stack((minimums, maximums, rms), axis=1)
+    return numpy.round(numpy.clip(level, -1, 1) * SCALE).astype(numpy.int16)
+
+
+def summarize(path: str, samples_per_bin: int=256) -> dict:
+    """Computes the waveform summary of a file in a single decoding pass
+
+    Args:
+        path: path to the file
+        samples_per_bin (256): number of frames in a bin of the base level
+
+    Returns:
+        dict: "sample_rate", "samples_per_bin", "frames" and "levels", see PeakBuilder.levels
+
+    """
+    reader = PCMReader(path)
+    builder = PeakBuilder(reader.sample_rate, samples_per_bin)
+    frames = 0
+    for chunk in reader:
+        builder.add(chunk)
+        frames += len(chunk)
+    return {
+        "sample_rate": reader.sample_rate,
+        "samples_per_bin": samples_per_bin,
+        "frames": frames,
+        "levels": builder.levels(),
+    }
+
+
+class Peaks:
+    """Memory-mapped waveform summary of a track
+
+    Attributes:
+        sample_rate (int): sample rate of the track
+        samples_per_bin (int): number of frames in a bin of the base level
+        frames (int): number of frames of the track
+        levels (list of numpy.memmap): int16 arrays of shape (bins, 3) holding min, max and RMS, base level first
+
+    """
+
+    def __init__(self, metadata: dict, data: numpy.ndarray):
+        self.sample_rate = metadata["sample_rate"]
+        self.samples_per_bin = metadata["samples_per_bin"]
+        self.frames = metadata["frames"]
+        self.levels = []
+        start = 0
+        for size in metadata["sizes"]:
+            self.levels.append(data[start:start + size])
+            start += size
+
+    @property
+    def duration(self) -> float:
+        return self.frames / self.sample_rate if self.sample_rate else 0.0
+
+    def bin_duration(self, level: int) -> float:
+        """
+        Returns:
+            float: duration in seconds of a bin of a level
+
+        """
+        return self.samples_per_bin * 2 ** level / self.sample_rate
+
+    def window(self, start: float, end: float, width: int) -> numpy.ndarray:
+        """Gives the summary of a time range for a display of a given width
+
+        The coarsest level with at least width bins in the range is used, so the cost only depends on the width.
+
+        Args:
+            start: start of the range in seconds
+            end: end of the range in seconds
+            width: number of columns to draw
+
+        Returns:
+            numpy.ndarray: float32 array of shape (bins, 3) holding min, max and RMS between -1 and 1
+
+        """
+        duration = max(end - start, 0.0)
+        level = 0
+        while level + 1 < len(self.levels) and duration / self.bin_duration(level + 1) >= width:
+            level += 1
+        bin_duration = self.bin_duration(level)
+        first = max(0, int(math.floor(start / bin_duration)))
+        last = min(len(self.levels[level]), int(math.ceil(end / bin_duration)))
+        return numpy.asarray(self.levels[level][first:last], dtype=numpy.float32) / SCALE
+
+
+class PeakCache:
+    """Content-addressed cache of waveform summaries
+
+    Summaries are keyed by Track.fingerprint (path and last modification). The levels of a summary are stored
+    back to back in a .npy file next to a small JSON description, and read memory-mapped so that any zoom level
+    is served without decoding the file again. A summary built with another samples_per_bin is considered missing.
+
+    Example:
+        cache = PeakCache("cache/peaks")
+        cache.build(library)
+        columns = cache.get(track).window(0, 30, width=800)
+
+    Attributes:
+        results (ResultCache): the descriptions of the summaries, the arrays are stored next to them
+        samples_per_bin (int): number of frames in a bin of the base level
+        max_workers (int): number of processes used to build the summaries, None for the number of processors
+
+    """
+
+    def __init__(self, path: str, samples_per_bin: int=256, max_workers: int=None):
+        self.results = ResultCache(path)
+        self.samples_per_bin = samples_per_bin
+        self.max_workers = max_workers
+
+    def __contains__(self, track) -> bool:
+        return self._metadata(track.fingerprint()) is not None
+
+    def _metadata(self, key: str):
+        metadata = self.results.get(key)
+        if metadata is None or metadata.get("samples_per_bin") != self.samples_per_bin:
+            return None
+        return metadata
+
+    def get(self, track):
+        """
+        Args:
+            track (Track): the track
+
+        Returns:
+            Peaks, or None if the summary of the track isn't in the cache
+
+        """
+        key = track.fingerprint()
+        metadata = self._metadata(key)
+        if metadata is None:
+            return None
+        try:
+            data = numpy.load(self.results.file(key, ".npy"), mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        return Peaks(metadata, data)
+
+    def get_or_build(self, track):
+        """
+        Args:
+            track (Track): the track
+
+        Returns:
+            Peaks, the summary is built in the calling thread if it isn't in the cache
+
+        """
+        peaks = self.get(track)
+        if peaks is None:
+            self.store(track, summarize(track.path, self.samples_per_bin))
+            peaks = self.get(track)
+        return peaks
+
+    def build(self, tracks, executor=None) -> int:
+        """Builds the summaries of the tracks which are not in the cache, in a process pool
+
+        Args:
+            tracks: iterable of Track
+            executor (None): executor used instead of a new process pool
+
+        Returns:
+            int: number of summaries built
+
+        """
+        missing = [track for track in tracks if track not in self]
+        built = 0
+        function = functools.partial(summarize, samples_per_bin=self.samples_per_bin)  # picklable for the processes
+        for track, summary in map_library(missing, function, self.max_workers, executor):
+            self.store(track, summary)
+            built += 1
+        return built
+
+    def store(self, track, summary: dict) -> None:
+        """Writes a summary, the array is written before its description so that readers never see a partial summary
+
+        Args:
+            track (Track): the track
+            summary: result of summarize
+
+        """
+        key = track.fingerprint()
+        atomic_write(self.results.file(key, ".npy"), lambda file: numpy.save(file, numpy.concatenate(summary["levels"])))
+
+        self.results.set(key, {
+            "sample_rate": summary["sample_rate"],
+            "samples_per_bin": summary["samples_per_bin"],
+            "frames": summary["frames"],
+            "sizes": [len(level) for level in summary["levels"]],
+        })
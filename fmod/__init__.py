@@ -1 +1,5 @@
-from fmod.fmod import TimeUnit, DebugFlags, InitFlags, Mode, PluginType, Sound, Channel, System
\ No newline at end of file
+from fmod.fmod import TimeUnit, DebugFlags, InitFlags, Mode, PluginType, OutputType, SoundFormat, CreateSoundExInfo, Sound, Channel, System
+from fmod.memory import MemorySource, ReadAheadLoader
+from fmod.pool import SoundPool
+from fmod.play_queue import FeistelPermutation, AliasSampler, PlayQueue
+from fmod.seek_index import SeekIndex, SeekIndexCache
\ No newline at end of file
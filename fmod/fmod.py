@@ -2,7 +2,25 @@ from ctypes import *
 
 
 VERSION = 0x00010810
-FMOD = WinDLL("fmodL")
+
+
+class _Library:
+    """Loads the FMOD library the first time one of its functions is used, so that importing fmod is fast"""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._dll = None
+
+    def __getattr__(self, name: str):
+        if self._dll is None:
+            self._dll = WinDLL(self._name)
+        function = getattr(self._dll, name)
+        # the next calls don't go through __getattr__
+        setattr(self, name, function)
+        return function
+
+
+FMOD = _Library("fmodL")
 
 
 class DebugFlags:
@@ -139,6 +157,42 @@ class PluginType:
     max = 3
 
 
+class OutputType:
+    """
+    autodetect: Picks the best output mode for the platform. This is the default.
+    unknown: All - 3rd party plugin, unknown. This is for use with System::getOutput only.
+    nosound: All - Perform all mixing but discard the final output.
+    wavwriter: All - Writes output to a .wav file.
+    nosound_nrt: All - Non-realtime version of nosound. User can drive mixer with System::update at whatever rate they want.
+    wavwriter_nrt: All - Non-realtime version of wavwriter. User can drive mixer with System::update at whatever rate they want.
+    """
+    autodetect = 0
+    unknown = 1
+    nosound = 2
+    wavwriter = 3
+    nosound_nrt = 4
+    wavwriter_nrt = 5
+
+
+class SoundFormat:
+    """
+    none: Unitialized / unknown.
+    pcm8: 8bit integer PCM data.
+    pcm16: 16bit integer PCM data.
+    pcm24: 24bit integer PCM data.
+    pcm32: 32bit integer PCM data.
+    pcmfloat: 32bit floating point PCM data.
+    bitstream: Sound data is in its native compressed format.
+    """
+    none = 0
+    pcm8 = 1
+    pcm16 = 2
+    pcm24 = 3
+    pcm32 = 4
+    pcmfloat = 5
+    bitstream = 6
+
+
 class TimeUnit:
     """
     ms: Milliseconds.
@@ -162,24 +216,88 @@ class TimeUnit:
     buffered = 0x10000000
 
 
+class CreateSoundExInfo(Structure):
+    """Additional info used by System.create_sound and System.create_stream, mirrors FMOD_CREATESOUNDEXINFO.
+
+    Fields:
+        cbsize: Size of this structure. Set automatically, this is used so the structure can be expanded in the future.
+        length: Size in bytes of the file or memory to load. Required when opening with Mode.openmemory or Mode.openmemory_point.
+        fileoffset: Offset in the file or memory to start reading from.
+        numchannels, defaultfrequency, format: Format of the data, only used with Mode.openuser or Mode.openraw.
+        decodebuffersize: Size in PCM samples of the decode buffer of a stream.
+        initialsubsound: Subsound to seek to when the stream is opened.
+        numsubsounds: Number of subsounds, only used with Mode.openuser.
+        suggestedsoundtype: Skips the file format checks and tries this codec first.
+        filebuffersize: Buffer size in bytes used when reading the file, -1 disables file buffering.
+        initialseekposition, initialseekpostype: Position to seek a stream to when it is opened.
+        other fields: Callbacks and platform specific settings, left to 0 in this wrapper.
+
+    """
+    _fields_ = [
+        ("cbsize", c_int),
+        ("length", c_uint),
+        ("fileoffset", c_uint),
+        ("numchannels", c_int),
+        ("defaultfrequency", c_int),
+        ("format", c_int),
+        ("decodebuffersize", c_uint),
+        ("initialsubsound", c_int),
+        ("numsubsounds", c_int),
+        ("inclusionlist", c_voidp),
+        ("inclusionlistnum", c_int),
+        ("pcmreadcallback", c_voidp),
+        ("pcmsetposcallback", c_voidp),
+        ("nonblockcallback", c_voidp),
+        ("dlsname", c_char_p),
+        ("encryptionkey", c_char_p),
+        ("maxpolyphony", c_int),
+        ("userdata", c_voidp),
+        ("suggestedsoundtype", c_int),
+        ("fileuseropen", c_voidp),
+        ("fileuserclose", c_voidp),
+        ("fileuserread", c_voidp),
+        ("fileuserseek", c_voidp),
+        ("fileuserasyncread", c_voidp),
+        ("fileuserasynccancel", c_voidp),
+        ("fileuserdata", c_voidp),
+        ("filebuffersize", c_int),
+        ("channelorder", c_int),
+        ("channelmask", c_uint),
+        ("initialsoundgroup", c_voidp),
+        ("initialseekposition", c_uint),
+        ("initialseekpostype", c_uint),
+        ("ignoresetfilesystem", c_int),
+        ("audioqueuepolicy", c_uint),
+        ("minmidigranularity", c_uint),
+        ("nonblockthreadid", c_int),
+    ]
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.cbsize = sizeof(CreateSoundExInfo)
+
+
 class Sound:
     """Sound object
 
     Attributes:
         _sound (c_voidp): A C pointer to the sound.
+        _source (MemorySource): The memory the sound was opened from, kept alive until the sound is released. None for sounds opened from a file.
     
     """
 
-    def __init__(self, sound=None):
+    def __init__(self, sound=None, source=None):
         """Initializes a Sound object
 
         Args:
             sound (c_voidp, optional): A C pointer to the sound, None means the sound is given a new pointer.
+            source (MemorySource, optional): The memory the sound reads from, closed when the sound is released.
         
         """
         if sound is None:
             sound = c_voidp()
         self._sound = sound
+        self._source = source
     
     def get_loop_count(self):
         """Retrieves the current loop count value for the specified sound.
@@ -195,6 +313,49 @@ class Sound:
         FMOD.FMOD_Sound_GetNumSubSounds(self._sound, loopcount)
         return loopcount.value
     
+    def get_defaults(self):
+        """Retrieves a sound's default attributes for when it is played on a channel.
+
+        Returns:
+            (frequency, priority): The default playback frequency in Hz and the default priority, 0 = most important, 256 = least important.
+        
+        """
+        frequency = c_float()
+        priority = c_int()
+        FMOD.FMOD_Sound_GetDefaults(self._sound, byref(frequency), byref(priority))
+        return frequency.value, priority.value
+    
+    def get_format(self):
+        """Returns format information about the sound.
+
+        Returns:
+            (type, format, channels, bits): The type of sound, its SoundFormat, the number of channels and the number of bits per sample.
+        
+        """
+        type = c_int()
+        format = c_int()
+        channels = c_int()
+        bits = c_int()
+        FMOD.FMOD_Sound_GetFormat(self._sound, byref(type), byref(format), byref(channels), byref(bits))
+        return type.value, format.value, channels.value, bits.value
+    
+    def get_length(self, lengthtype) -> int:
+        """Retrieves the length of the sound using the specified time unit.
+
+        Args:
+            lengthtype: Time unit to retrieve into the length parameter. See TimeUnit.
+
+        Returns:
+            The length of the sound in the specified units.
+        
+        Remarks:
+            TimeUnit.pcmbytes gives the size of the decoded sound, TimeUnit.rawbytes the size of the compressed data.
+        
+        """
+        length = c_uint()
+        FMOD.FMOD_Sound_GetLength(self._sound, byref(length), lengthtype)
+        return length.value
+    
     def get_num_subsounds(self):
         num_subsounds = c_int()
         FMOD.FMOD_Sound_GetNumSubSounds(self._sound, num_subsounds)
@@ -203,7 +364,35 @@ class Sound:
     def get_subsound(self, numsubsound: int):
         subsound = c_voidp()
         FMOD.FMOD_Sound_GetSubSound(self._sound, numsubsound, byref(subsound))
-        return Sound(subsound)
+        return Sound(subsound, self._source)
+    
+    def read_data(self, buffer, length: int) -> int:
+        """Reads data from an opened sound to a specified buffer, using FMOD's internal codecs.
+
+        Args:
+            buffer: A writable ctypes buffer that receives the decoded data from the sound.
+            length: Length of the data in bytes to read into the buffer.
+
+        Returns:
+            The number of bytes actually read, 0 at the end of the sound.
+        
+        Remarks:
+            This can be used for decoding data offline in small or big chunks, it doesn't play the sound. The sound should be opened with Mode.openonly so that FMOD doesn't prebuffer it.
+            The data is in the format given by Sound.get_format.
+        
+        """
+        read = c_uint()
+        FMOD.FMOD_Sound_ReadData(self._sound, buffer, length, byref(read))
+        return read.value
+    
+    def seek_data(self, pcm: int):
+        """Seeks a sound for use with data reading. This is not a function to 'seek a sound' for normal use.
+
+        Args:
+            pcm: Offset to seek to in PCM samples.
+        
+        """
+        FMOD.FMOD_Sound_SeekData(self._sound, pcm)
     
     def set_loop_count(self, loopcount: int=-1):
         """Sets a sound, by default, to loop a specified number of times before stopping if its mode is set to FMOD_LOOP_NORMAL or FMOD_LOOP_BIDI.
@@ -221,9 +410,13 @@ class Sound:
             This will free the sound object and everything created under it.
             If this is a stream that is playing as a subsound of another parent stream, then if this is the currently playing subsound, the whole stream will stop.
             Note - This function will block if it was opened with Mode.nonblocking and hasn't finished opening yet.
+            The memory source of the sound, if any, is closed after the sound is freed.
         
         """
         FMOD.FMOD_Sound_Release(self._sound)
+        if self._source is not None:
+            self._source.close()
+            self._source = None
 
 
 class Channel:
@@ -312,12 +505,13 @@ class System:
     
     """
 
-    def __init__(self, maxchannels: int, flags):
+    def __init__(self, maxchannels: int, flags, output=None):
         """Creates the system object and initializes it, and the sound device.
 
         Args:
             maxchannels: The maximum number of channels to be used in FMOD. They are also called 'virtual channels' as you can play as many of these as you want, even if you only have a small number of software voices. See remarks for more.
             flags: See InitFlags. This can be a selection of flags bitwise OR'ed together to change the behaviour of FMOD at initialization time.
+            output (None): See OutputType. The output to use, None lets FMOD pick the sound device. OutputType.nosound_nrt is meant for systems that only decode.
         
         Remarks:
             Virtual channels.
@@ -331,21 +525,68 @@ class System:
         """
         self._system = c_voidp()
         FMOD.FMOD_System_Create(byref(self._system))
+        if output is not None:
+            FMOD.FMOD_System_SetOutput(self._system, output)
         FMOD.FMOD_System_Init(self._system, maxchannels, flags, 0)
     
-    def create_stream(self, name_or_data: str, mode=0):
+    def create_sound(self, name_or_data, mode=0, exinfo: CreateSoundExInfo=None):
+        """Loads a sound into memory, or opens it for streaming.
+
+        Args:
+            name_or_data (str or c_voidp): Name of the file or URL to open, or a pointer to the data when mode contains Mode.openmemory or Mode.openmemory_point.
+            mode: Behaviour modifier for opening the sound. See Mode.
+            exinfo (None): Additional info used to open the sound, required with Mode.openmemory and Mode.openmemory_point. See CreateSoundExInfo.
+
+        Returns:
+            A Sound object created from name_or_data
+
+        """
+        sound = c_voidp()
+        if isinstance(name_or_data, str):
+            name_or_data = name_or_data.encode('utf-8')
+        FMOD.FMOD_System_CreateSound(self._system, name_or_data, mode, byref(exinfo) if exinfo is not None else 0, byref(sound))
+        return Sound(sound)
+
+    def create_sound_from_memory(self, source, mode=Mode.createstream, exinfo: CreateSoundExInfo=None):
+        """Opens a sound from a MemorySource.
+
+        The sound keeps a reference to the source, which is closed when the sound is released.
+
+        Args:
+            source (MemorySource): The loaded file contents.
+            mode (Mode.createstream): Behaviour modifier for opening the sound. Mode.openmemory is added unless Mode.openmemory_point is given.
+            exinfo (None): Additional info, its fileoffset is an offset in the memory. The length is set to the size of the source.
+
+        Returns:
+            A Sound object reading from the source
+
+        """
+        if not mode & Mode.openmemory_point:
+            mode |= Mode.openmemory
+        if exinfo is None:
+            exinfo = CreateSoundExInfo()
+        exinfo.length = source.size
+        # without argtypes, a bare int would be passed as a 32 bits C int and truncate 64 bits addresses
+        sound = self.create_sound(c_voidp(source.address), mode, exinfo)
+        sound._source = source
+        return sound
+
+    def create_stream(self, name_or_data, mode=0, exinfo: CreateSoundExInfo=None):
         """Opens a sound for streaming. This function is a helper function that is the same as System.create_sound but has the createstream flag added internally.
 
         Args:
             name_of_data (str): Name of the file or URL to open encoded in a UTF-8 string.
             mode: Behaviour modifier for opening the sound. See Mode. Also see remarks for more.
+            exinfo (None): Additional info used to open the sound. See CreateSoundExInfo.
 
         Returns:
             A Sound object created from the name_of_data
 
         """
         sound = c_voidp()
-        FMOD.FMOD_System_CreateStream(self._system, name_or_data.encode('ascii'), mode, 0, byref(sound))
+        if isinstance(name_or_data, str):
+            name_or_data = name_or_data.encode('utf-8')
+        FMOD.FMOD_System_CreateStream(self._system, name_or_data, mode, byref(exinfo) if exinfo is not None else 0, byref(sound))
         return Sound(sound)
     
     def load_plugin(self, filename: str, priority: int) -> int:
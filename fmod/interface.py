@@ -1,4 +1,4 @@
-from fmod import System, Sound, Channel, Mode, TimeUnit, PluginType
+from fmod import System, Sound, Channel, Mode, TimeUnit, PluginType, CreateSoundExInfo
 
 
 class PlayAudio:
@@ -11,34 +11,90 @@ class PlayAudio:
         sound: The current playing sound of the channel.
         repeat (False): Repeat the current playing sound.
         volume (1.0): A floating point number between 0 and 1 representing the volume.
+        loader (None): A ReadAheadLoader, sounds are then streamed from memory instead of from the disk.
+        pool (None): A SoundPool, short sounds are then played from the pool instead of being streamed.
+        gain_provider (None): A function giving the gain in dB to apply to a file from its path, or None if it is unknown. See analysis.loudness.LoudnessScanner.gain_provider.
+        gain (0.0): The gain in dB applied to the current playing sound, on top of the volume.
+        seek_indexes (None): A SeekIndexCache, MPEG audio files are then seeked accurately by reopening them at the right frame instead of using Mode.accuratetime.
 
     """
 
-    def __init__(self, volume=1.0, repeat=False, flags=Mode.loop_normal|Mode.ignoretags):
+    def __init__(self, volume=1.0, repeat=False, flags=Mode.loop_normal|Mode.ignoretags, loader=None, pool=None, gain_provider=None, seek_indexes=None):
         self.flags = flags
         self.system = System(1, self.flags)
         self.channel = Channel()
         self.sound = None
+        self.loader = loader
+        self.pool = pool
+        if pool is not None and pool.system is None:
+            pool.system = self.system
+        self._opened = None
+        self._pooled = False
+        self._path = None
+        self._prefetched = None  # the path given to the loader by prefetch and not opened yet
+        # when the sound was reopened in the middle of the file by set_position, the time and sample rate of its start
+        self._position_offset = 0.0
+        self._offset_rate = 0
+        self.seek_indexes = seek_indexes
+        self.gain_provider = gain_provider
+        self.gain = 0.0
         self.set_volume(volume)
         self.set_repeat(repeat)
     
-    def play_sound(self, path: str):
+    def play_sound(self, path: str, gain: float=None):
         """Plays an audio file.
 
         Args:
             path: The path of the audio file to play.
+            gain (None): The gain in dB to apply to the sound, None asks the gain_provider.
         
         """
-        if self.sound is not None:
-            # we free the last playing sound memory
-            self.sound.release()
-            del self.sound
-        self.sound = self.system.create_stream(path, mode=self.flags)
+        if gain is None:
+            gain = self.gain_provider(path) if self.gain_provider is not None else None
+        self.gain = gain if gain is not None else 0.0
+        self._close()
+        self._path = path
+        self._start(self._open(path))
+    
+    def _start(self, opened: Sound, paused: bool=False, position_offset: float=0.0, offset_rate: int=0):
+        self._opened = opened
+        self.sound = self._opened
         if self.sound.get_num_subsounds():
             self.sound = self.sound.get_subsound(0)
+        self._position_offset = position_offset
+        self._offset_rate = offset_rate
         self.set_repeat(self.repeat)
-        self.system.play_sound(self.sound, channel=self.channel)
-        self.channel.set_volume(self.volume)
+        self.system.play_sound(self.sound, paused=paused, channel=self.channel)
+        self.set_volume(self.volume)
+    
+    def prefetch(self, path: str):
+        """Starts loading an audio file in memory, so that playing it next doesn't wait for the disk.
+
+        Args:
+            path: The path of the audio file which will be played.
+        
+        """
+        if self.loader is not None:
+            if self._prefetched is not None and self._prefetched != path:
+                # superseded, the loader would otherwise keep it loaded and count it against its budget
+                self.loader.discard(self._prefetched)
+            self._prefetched = path
+            self.loader.prefetch(path)
+    
+    def _open(self, path: str) -> Sound:
+        if path == self._prefetched:
+            self._prefetched = None
+        if self.pool is not None:
+            sound = self.pool.acquire(path, self.flags)
+            self._pooled = sound is not None
+            if sound is not None:
+                if self.loader is not None:
+                    self.loader.discard(path)
+                return sound
+        source = self.loader.get(path) if self.loader is not None else None
+        if source is None:
+            return self.system.create_stream(path, mode=self.flags)
+        return self.system.create_sound_from_memory(source, mode=self.flags|Mode.createstream)
     
     def get_position(self, time_unit: TimeUnit=TimeUnit.ms):
         """
@@ -49,7 +105,13 @@ class PlayAudio:
             The current playback position for the specified channel.
         
         """
-        return self.channel.get_position(time_unit)
+        position = self.channel.get_position(time_unit)
+        if self._position_offset:
+            if time_unit == TimeUnit.ms:
+                position += int(round(self._position_offset))
+            elif time_unit == TimeUnit.pcm:
+                position += int(round(self._position_offset * self._offset_rate / 1000))
+        return position
     
     def is_playing(self) -> bool:
         """Retrieves the playing state.
@@ -64,7 +126,58 @@ class PlayAudio:
         self.channel.set_paused(paused)
     
     def set_position(self, position: int, time_unit: TimeUnit=TimeUnit.ms):
-        self.channel.set_position(position, time_unit)
+        """Seeks the current playing sound.
+
+        With a seek index, MPEG audio files are reopened at the frame to decode from and then seeked within the first
+        frames, which is accurate on VBR files without the scan of Mode.accuratetime, and from the memory of the loader
+        when the sound was streamed from it. Other sounds, repeated sounds and positions in other units than ms and pcm
+        are seeked by FMOD.
+
+        Args:
+            position: The position to seek to.
+            time_unit (ms): The time unit of the position.
+        
+        """
+        index = self._seek_index() if time_unit in (TimeUnit.ms, TimeUnit.pcm) else None
+        if index is None:
+            if self._position_offset:
+                # the sound was opened in the middle of the file, seeking is relative to there
+                self._reopen(0, 0.0, 0)
+            self.channel.set_position(position, time_unit)
+            return
+        if time_unit == TimeUnit.pcm:
+            position = position * 1000.0 / index.sample_rate
+        offset, skip = index.locate(position)
+        self._reopen(offset, position - skip, index.sample_rate)
+        self.channel.set_position(int(round(skip)), TimeUnit.ms)
+    
+    def _seek_index(self):
+        if self.seek_indexes is None or self._path is None or self._pooled or self.repeat:
+            return None
+        try:
+            return self.seek_indexes.get(self._path)
+        except OSError:
+            return None
+    
+    def _reopen(self, fileoffset: int, position_offset: float, offset_rate: int):
+        paused = self.channel.get_paused()
+        # a sound streamed from the memory of the loader is reopened from that memory instead of the disk, it is
+        # detached from the sound so that releasing the sound doesn't close it
+        source = None
+        if self._opened is not None:
+            source, self._opened._source = self._opened._source, None
+        self._close()
+        exinfo = CreateSoundExInfo(fileoffset=fileoffset) if fileoffset else None
+        if source is None:
+            opened = self.system.create_stream(self._path, mode=self.flags, exinfo=exinfo)
+        else:
+            try:
+                opened = self.system.create_sound_from_memory(source, mode=self.flags|Mode.createstream, exinfo=exinfo)
+            except BaseException:
+                source.close()
+                raise
+        self._start(opened, True, position_offset, offset_rate)
+        self.channel.set_paused(paused)
     
     def set_repeat(self, repeat: bool=True):
         """Repeat the sound when after it ends
@@ -79,13 +192,27 @@ class PlayAudio:
             self.sound.set_loop_count(-1 if repeat else 0)
     
     def set_volume(self, volume: float=1.0):
+        """Sets the volume, the gain of the current playing sound is applied on top of it.
+
+        Args:
+            volume (1.0): A floating point number between 0 and 1.
+        
+        """
         self.volume = volume
-        self.channel.set_volume(volume)
+        self.channel.set_volume(volume * 10 ** (self.gain / 20))
         
     def stop(self):
-        if self.sound is not None:
-            # we free the last playing sound memory
-            self.sound.release()
-            del self.sound
-            self.sound = None
-        self.channel.stop()
\ No newline at end of file
+        self._close()
+        self.channel.stop()
+    
+    def _close(self):
+        if self._opened is not None:
+            # we free the last playing sound memory, pooled sounds are only given back to the pool
+            if self._pooled:
+                self.pool.release(self._opened)
+            else:
+                self._opened.release()
+        self._opened = None
+        self._pooled = False
+        self._position_offset = 0.0
+        self.sound = None
\ No newline at end of file
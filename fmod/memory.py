@@ -0,0 +1,232 @@
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from ctypes import addressof, c_char
+
+
+class MemorySource:
+    """The contents of an audio file held in memory, to be opened with Mode.openmemory or Mode.openmemory_point
+
+    The data is either read entirely into a buffer, or memory-mapped. The source must stay alive as long as FMOD
+    reads from it, System.create_sound_from_memory ties it to the Sound so that Sound.release closes it.
+
+    Attributes:
+        path (str): path to the file
+        size (int): size of the data in bytes
+        use_mmap (bool): the file is memory-mapped instead of read
+        address (int): address of the first byte of the data, passed to FMOD as name_or_data
+
+    """
+
+    def __init__(self, path: str, use_mmap: bool=False, on_close=None):
+        """Loads the file
+
+        Args:
+            path: path to the file
+            use_mmap (False): memory-maps the file instead of reading it
+            on_close (None): called with the source when it is closed
+
+        """
+        self.path = path
+        self.use_mmap = use_mmap
+        self._on_close = on_close
+        self._array = None
+
+        with open(path, "rb") as file:
+            self.size = os.fstat(file.fileno()).st_size
+            if use_mmap:
+                # ACCESS_COPY gives a writable view without touching the file, ctypes needs a writable buffer
+                self._data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+                if hasattr(mmap, "MADV_WILLNEED"):
+                    self._data.madvise(mmap.MADV_WILLNEED)
+            else:
+                self._data = bytearray(self.size)
+                view = memoryview(self._data)
+                read = 0
+                while read < self.size:
+                    n = file.readinto(view[read:])
+                    if not n:
+                        break
+                    read += n
+                view.release()
+
+        self._array = (c_char * self.size).from_buffer(self._data)
+        self.address = addressof(self._array)
+
+    def __repr__(self) -> str:
+        return 'MemorySource("{}")'.format(self.path)
+
+    @property
+    def closed(self) -> bool:
+        return self._array is None
+
+    def close(self) -> None:
+        """Frees the memory, the sound using it must have been released before"""
+        if self._array is None:
+            return
+        self._array = None
+        self.address = 0
+        if self.use_mmap:
+            self._data.close()
+        self._data = None
+        if self._on_close is not None:
+            self._on_close(self)
+
+
+class ReadAheadLoader:
+    """Loads MemorySources on a background thread, within a memory budget
+
+    Paths are loaded in the order they are prefetched. The memory of every source which was loaded by the loader
+    and is not closed yet counts towards the budget. When the next path doesn't fit, the loaded sources which were
+    not taken are closed, the least recently prefetched first, then the thread waits for the taken sources to be
+    closed. Files larger than the budget are never loaded, get returns None for them and the caller should open
+    the file normally.
+
+    Attributes:
+        budget (int): maximum number of bytes held by the sources of the loader
+        use_mmap (bool): memory-maps the files instead of reading them
+        used (int): number of bytes currently held by the sources of the loader
+
+    """
+
+    def __init__(self, budget: int=256 * 1024 * 1024, use_mmap: bool=False):
+        self.budget = budget
+        self.use_mmap = use_mmap
+        self.used = 0
+        self._condition = threading.Condition()
+        self._pending = OrderedDict()  # path -> None, waiting to be loaded
+        self._loading = None
+        self._ready = OrderedDict()  # path -> MemorySource or Exception, least recently prefetched first
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="ReadAheadLoader", daemon=True)
+        self._thread.start()
+
+    def prefetch(self, path: str) -> None:
+        """Schedules the loading of a file
+
+        Args:
+            path: path to the file
+
+        """
+        with self._condition:
+            if path in self._ready:
+                self._ready.move_to_end(path)
+                return
+            if path in self._pending or path == self._loading:
+                return
+            self._pending[path] = None
+            self._condition.notify_all()
+
+    def get(self, path: str, wait: bool=True):
+        """Takes the source of a file, the caller becomes responsible for closing it
+
+        A file which is not loaded yet is loaded in the calling thread, unless the thread is already reading it. Files
+        asked for are always loaded, the budget only holds back the read-ahead.
+
+        Args:
+            path: path to the file
+            wait (True): waits for the file if the thread is reading it, otherwise returns None
+
+        Returns:
+            MemorySource, or None if the file is larger than the budget
+
+        """
+        with self._condition:
+            self._pending.pop(path, None)
+            if path == self._loading:
+                if not wait:
+                    return None
+                self._condition.wait_for(lambda: path in self._ready)
+            if path in self._ready:
+                result = self._ready.pop(path)
+                if isinstance(result, Exception):
+                    raise result
+                return result
+            if not self._fits(path):
+                return None
+
+        return self._load(path)
+
+    def discard(self, path: str) -> None:
+        """Cancels the prefetching of a file and frees it if it was already loaded
+
+        Args:
+            path: path to the file
+
+        """
+        with self._condition:
+            self._pending.pop(path, None)
+            source = self._ready.pop(path, None)
+        if isinstance(source, MemorySource):
+            source.close()
+
+    def close(self) -> None:
+        """Stops the thread and frees the loaded sources which were not taken"""
+        with self._condition:
+            self._closed = True
+            self._pending.clear()
+            self._condition.notify_all()
+        self._thread.join()
+        for path in list(self._ready):
+            self.discard(path)
+
+    def _fits(self, path: str) -> bool:
+        try:
+            return os.path.getsize(path) <= self.budget
+        except OSError:
+            return False
+
+    def _load(self, path: str) -> MemorySource:
+        source = MemorySource(path, self.use_mmap, on_close=self._release)
+        with self._condition:
+            self.used += source.size
+        return source
+
+    def _head_ready(self) -> bool:
+        """the next pending path can be loaded without going over the budget, paths which will never fit are skipped"""
+        while self._pending:
+            path = next(iter(self._pending))
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = self.budget + 1
+            if size <= self.budget:
+                return self.used + size <= self.budget or self._evict(size)
+            self._pending.popitem(last=False)
+            self._ready[path] = None
+        return False
+
+    def _evict(self, size: int) -> bool:
+        """closes the least recently prefetched sources which were not taken until size bytes fit in the budget"""
+        for path in list(self._ready):
+            if self.used + size <= self.budget:
+                break
+            if isinstance(self._ready[path], MemorySource):
+                # _release takes the condition again, its lock is reentrant
+                self._ready.pop(path).close()
+        return self.used + size <= self.budget
+
+    def _release(self, source: MemorySource) -> None:
+        with self._condition:
+            self.used -= source.size
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._closed or self._head_ready())
+                if self._closed:
+                    return
+                path, _ = self._pending.popitem(last=False)
+                self._loading = path
+
+            try:
+                result = self._load(path)
+            except Exception as e:
+                result = e
+
+            with self._condition:
+                self._loading = None
+                self._ready[path] = result
+                self._condition.notify_all()
@@ -0,0 +1,273 @@
+import collections
+import random
+
+_MASK64 = (1 << 64) - 1
+
+
+class FeistelPermutation:
+    """Pseudo-random permutation of range(size), computed index by index
+
+    A balanced Feistel network is a bijection over the numbers of 2 * half bits, the indices falling outside of
+    range(size) are encrypted again until they fall inside (cycle walking), which keeps the bijection. The domain
+    is less than 4 times size, so an index costs a few rounds on average whatever the size, and no list is built.
+
+    Attributes:
+        size (int): number of indices
+        seed (int): the permutation given by a seed is always the same
+
+    """
+
+    def __init__(self, size: int, seed: int=None, rounds: int=4):
+        self.size = size
+        self.seed = seed if seed is not None else random.getrandbits(64)
+        self._half = max(1, (max(size - 1, 1).bit_length() + 1) // 2)
+        self._mask = (1 << self._half) - 1
+        generator = random.Random(self.seed)
+        self._keys = [generator.getrandbits(64) for _ in range(rounds)]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _round(self, key: int, value: int) -> int:
+        value = (value ^ key) * 0x9E3779B97F4A7C15 & _MASK64
+        value ^= value >> 29
+        return value & self._mask
+
+    def _encrypt(self, value: int) -> int:
+        left, right = value >> self._half, value & self._mask
+        for key in self._keys:
+            left, right = right, left ^ self._round(key, right)
+        return left << self._half | right
+
+    def __getitem__(self, index: int) -> int:
+        if not 0 <= index < self.size:
+            raise IndexError("permutation index out of range")
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+    def __iter__(self):
+        return (self[index] for index in range(self.size))
+
+
+class AliasSampler:
+    """Draws indices with probabilities proportional to weights in constant time (Vose's alias method)
+
+    Attributes:
+        size (int): number of weights
+
+    """
+
+    def __init__(self, weights, generator: random.Random=None):
+        weights = [max(float(weight), 0.0) for weight in weights]
+        self.size = len(weights)
+        self._random = generator or random.Random()
+        total = sum(weights)
+        if not self.size:
+            self._probabilities, self._aliases = [], []
+            return
+        if total <= 0:
+            weights = [1.0] * self.size
+            total = float(self.size)
+
+        scaled = [weight * self.size / total for weight in weights]
+        self._probabilities = [1.0] * self.size
+        self._aliases = list(range(self.size))
+        small = [i for i, weight in enumerate(scaled) if weight < 1.0]
+        large = [i for i, weight in enumerate(scaled) if weight >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self._probabilities[less] = scaled[less]
+            self._aliases[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        # the remaining ones are 1 up to rounding errors
+
+    def __len__(self) -> int:
+        return self.size
+
+    def sample(self) -> int:
+        """
+        Returns:
+            int: an index drawn with a probability proportional to its weight
+
+        Raises:
+            IndexError: there are no weights
+
+        """
+        if not self.size:
+            raise IndexError("sample from an empty sampler")
+        index = self._random.randrange(self.size)
+        return index if self._random.random() < self._probabilities[index] else self._aliases[index]
+
+
+def _path(item) -> str:
+    return getattr(item, "path", item)
+
+
+class PlayQueue:
+    """Gives the items to play one after the other and feeds them to a PlayAudio
+
+    In order and shuffle modes, the queue walks positions 0, 1, 2... which are mapped to items directly or through a
+    FeistelPermutation, so shuffling a huge library costs nothing upfront. In weighted mode, every item is drawn by
+    an AliasSampler with a probability proportional to weight(item), a rating or a play count for example. Items
+    added with enqueue are played first, in order.
+
+    The history keeps the last history_size played items, previous walks back into it and next then walks forward
+    again through the same items. The item after the current one is drawn in advance and prefetched by the player,
+    so that it starts without waiting for the disk.
+
+    Example:
+        queue = PlayQueue(library.snapshot(), PlayAudio(loader=ReadAheadLoader()), mode=PlayQueue.SHUFFLE)
+        queue.play_next()
+
+    Attributes:
+        ORDER, SHUFFLE, WEIGHTED: the modes
+        items (sequence): the items, Track or paths
+        player (PlayAudio): the player fed by play_next and play_previous, None to only use next and previous
+        mode (str): one of the modes
+        weight: function giving the weight of an item in weighted mode, None for uniform weights
+        repeat (bool): start again after the last item in order and shuffle modes, with a new permutation
+        current: the item being played, None before the first one
+
+    """
+
+    ORDER = "order"
+    SHUFFLE = "shuffle"
+    WEIGHTED = "weighted"
+
+    def __init__(self, items=(), player=None, mode: str=ORDER, weight=None, repeat: bool=False, history_size: int=1000, seed: int=None):
+        self.player = player
+        self.weight = weight
+        self.repeat = repeat
+        self.current = None
+        self._random = random.Random(seed)
+        self._history = collections.deque(maxlen=history_size)
+        self._forward = collections.deque(maxlen=history_size)  # items walked back by previous, next one last
+        self._enqueued = collections.deque()
+        self._upcoming = None  # the next drawn item, drawn in advance
+        self.mode = mode
+        self.set_items(items)
+
+    def set_items(self, items, mode: str=None) -> None:
+        """Replaces the items, the history and the enqueued items are kept
+
+        Args:
+            items: sequence of Track or paths, a LibrarySnapshot for example
+            mode (None): the new mode, None to keep the current one
+
+        """
+        if mode is not None:
+            self.mode = mode
+        if self.mode not in (PlayQueue.ORDER, PlayQueue.SHUFFLE, PlayQueue.WEIGHTED):
+            raise ValueError("Unknown mode: {}".format(self.mode))
+        self.items = items
+        self._position = 0
+        self._permutation = FeistelPermutation(len(items), self._random.getrandbits(64))
+        self._sampler = None
+        if self.mode == PlayQueue.WEIGHTED:
+            weights = [self.weight(item) for item in items] if self.weight is not None else [1.0] * len(items)
+            self._sampler = AliasSampler(weights, self._random)
+        self._upcoming = None
+
+    def enqueue(self, item) -> None:
+        """Plays an item after the current one and the items already enqueued"""
+        self._enqueued.append(item)
+        self._upcoming = None
+
+    @property
+    def history(self) -> list:
+        """the played items, the oldest first, the current one excluded"""
+        return list(self._history)
+
+    def _draw(self):
+        if self._enqueued:
+            return self._enqueued.popleft()
+        if not len(self.items):
+            return None
+
+        if self.mode == PlayQueue.WEIGHTED:
+            item = self.items[self._sampler.sample()]
+            # a second draw avoids most immediate repetitions
+            if item is self.current and len(self.items) > 1:
+                item = self.items[self._sampler.sample()]
+            return item
+
+        if self._position >= len(self.items):
+            if not self.repeat:
+                return None
+            self._position = 0
+            self._permutation = FeistelPermutation(len(self.items), self._random.getrandbits(64))
+        index = self._permutation[self._position] if self.mode == PlayQueue.SHUFFLE else self._position
+        self._position += 1
+        return self.items[index]
+
+    def peek(self):
+        """
+        Returns:
+            the item next will give, None at the end of the queue
+
+        """
+        if self._forward:
+            return self._forward[-1]
+        if self._upcoming is None:
+            self._upcoming = self._draw()
+        return self._upcoming
+
+    def next(self):
+        """Moves to the next item
+
+        Returns:
+            the new current item, None at the end of the queue
+
+        """
+        item = self.peek()
+        if item is None:
+            return None
+        if self._forward:
+            self._forward.pop()
+        else:
+            self._upcoming = None
+        if self.current is not None:
+            self._history.append(self.current)
+        self.current = item
+        return item
+
+    def previous(self):
+        """Moves back to the previous item of the history
+
+        Returns:
+            the new current item, None if the history is empty
+
+        """
+        if not self._history:
+            return None
+        if self._upcoming is not None and not self._forward:
+            # put back in front of the queue, so that walking forward again gives the same items
+            self._enqueued.appendleft(self._upcoming)
+            self._upcoming = None
+        self._forward.append(self.current)
+        self.current = self._history.pop()
+        return self.current
+
+    def play_next(self):
+        """Plays the next item and prefetches the one after it
+
+        Returns:
+            the played item, None at the end of the queue
+
+        """
+        return self._play(self.next())
+
+    def play_previous(self):
+        return self._play(self.previous())
+
+    def _play(self, item):
+        if item is None or self.player is None:
+            return item
+        self.player.play_sound(_path(item))
+        upcoming = self.peek()
+        if upcoming is not None:
+            self.player.prefetch(_path(upcoming))
+        return item
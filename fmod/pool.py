@@ -0,0 +1,181 @@
+import os
+import threading
+from collections import OrderedDict
+
+from fmod.fmod import Mode, TimeUnit
+
+
+class _Entry:
+
+    def __init__(self, path, sound, size, last_modification, mode):
+        self.path = path
+        self.sound = sound
+        self.size = size
+        self.last_modification = last_modification
+        self.mode = mode
+        self.references = 0
+
+
+class SoundPool:
+    """Cache of short sounds loaded in memory, shared between plays
+
+    Short files (jingles, UI sounds, previews) are decoded once with Mode.createsample, or kept compressed with
+    Mode.createcompressedsample, and stay in the pool. The pool holds at most budget bytes of sounds, the least
+    recently used sounds are released first. A sound is reference counted between acquire and release and is never
+    released while it is referenced, so the pool can go over the budget while every sound is in use.
+
+    Attributes:
+        system (System): The system used to load the sounds, PlayAudio sets it to its own system if it is None.
+        budget (int): Maximum number of bytes held by the pool.
+        max_file_size (int): Files larger than this are not pooled and should be streamed.
+        compressed (bool): Loads the sounds with Mode.createcompressedsample instead of Mode.createsample.
+        flags: Mode flags added when loading the sounds.
+        used (int): Number of bytes held by the pool.
+        hits (int): Number of acquire calls which found the sound in the pool.
+        misses (int): Number of acquire calls which loaded the sound.
+        evictions (int): Number of sounds released to stay within the budget.
+
+    """
+
+    def __init__(self, system=None, budget: int=64 * 1024 * 1024, max_file_size: int=2 * 1024 * 1024, compressed: bool=False, flags=Mode.default):
+        self.system = system
+        self.budget = budget
+        self.max_file_size = max_file_size
+        self.compressed = compressed
+        self.flags = flags & ~Mode.createstream
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # path -> _Entry, least recently used first
+        # id(sound) -> _Entry, including the entries replaced by a newer version of the file but still referenced
+        self._sounds = dict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, path: str) -> bool:
+        return os.path.abspath(path) in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def is_short(self, path: str) -> bool:
+        """Checks whether a file is small enough to be pooled
+
+        Args:
+            path: path to the file
+
+        """
+        try:
+            return os.path.getsize(path) <= self.max_file_size
+        except OSError:
+            return False
+
+    def acquire(self, path: str, flags=Mode.default):
+        """Takes a reference to the sound of a file, loading it if needed
+
+        Every acquired sound must be given back with release, and must not be released directly.
+
+        Args:
+            path: path to the file
+            flags (Mode.default): Mode flags of the player added to self.flags, Mode.loop_normal for the loop count
+                of the sound to work for example. A sound loaded with other flags is loaded again.
+
+        Returns:
+            Sound, or None if the file is too large to be pooled
+
+        """
+        path = os.path.abspath(path)
+        if not self.is_short(path):
+            return None
+        last_modification = os.path.getmtime(path)
+        mode = (self.flags | flags) & ~Mode.createstream
+        mode |= Mode.createcompressedsample if self.compressed else Mode.createsample
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.last_modification == last_modification and entry.mode == mode:
+                self.hits += 1
+                self._entries.move_to_end(path)
+                entry.references += 1
+                return entry.sound
+            self.misses += 1
+            if entry is not None:
+                # the file or the flags changed, the old sound goes away once it isn't referenced anymore
+                self._remove(path)
+
+        sound = self.system.create_sound(path, mode)
+        if self.compressed:
+            size = sound.get_length(TimeUnit.rawbytes) or os.path.getsize(path)
+        else:
+            size = sound.get_length(TimeUnit.pcmbytes)
+        entry = _Entry(path, sound, size, last_modification, mode)
+        entry.references = 1
+
+        with self._lock:
+            previous = self._entries.get(path)
+            if previous is not None:
+                # loaded concurrently by another thread
+                self._remove(path)
+            self._entries[path] = entry
+            self._sounds[id(sound)] = entry
+            self.used += size
+            self._evict()
+        return sound
+
+    def release(self, sound) -> None:
+        """Gives back a sound taken with acquire
+
+        Args:
+            sound (Sound): the acquired sound
+
+        """
+        with self._lock:
+            entry = self._sounds.get(id(sound))
+            if entry is None or entry.sound is not sound:
+                raise ValueError("sound not acquired from this pool")
+            entry.references -= 1
+            if self._entries.get(entry.path) is not entry:
+                # stale
+                if not entry.references:
+                    del self._sounds[id(sound)]
+                    entry.sound.release()
+                return
+            self._evict()
+
+    def clear(self) -> None:
+        """Releases every sound which isn't referenced"""
+        with self._lock:
+            for path in [path for path, entry in self._entries.items() if not entry.references]:
+                self._remove(path)
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: hits, misses, evictions, number of sounds and bytes held by the pool
+
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "sounds": len(self._entries),
+                "used": self.used,
+                "budget": self.budget,
+            }
+
+    def _remove(self, path: str) -> None:
+        entry = self._entries.pop(path)
+        self.used -= entry.size
+        if not entry.references:
+            del self._sounds[id(entry.sound)]
+            entry.sound.release()
+
+    def _evict(self) -> None:
+        if self.used <= self.budget:
+            return
+        for path in [path for path, entry in self._entries.items() if not entry.references]:
+            self._remove(path)
+            self.evictions += 1
+            if self.used <= self.budget:
+                return
\ No newline at end of file
@@ -0,0 +1,395 @@
+import array
+import collections
+import hashlib
+import mmap
+import os
+import os.path
+import struct
+import sys
+import time
+from ctypes import create_string_buffer
+
+from fmod.fmod import System, InitFlags, Mode, OutputType, SoundFormat, CreateSoundExInfo
+from library_xml.files import atomic_write
+
+
+EXTENSIONS = (".mp3", ".mp2", ".mp1", ".mpga")
+RESERVOIR = 511  # bytes, maximum distance back to the main data of a layer III frame
+
+# kbps, by (MPEG-1, layer) for MPEG-1 and (MPEG-2, layer) for MPEG-2 and 2.5, layers II and III share a table
+_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+# Hz, by version bits: 3 MPEG-1, 2 MPEG-2, 0 MPEG-2.5
+_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+_MAGIC = b"MPSI"
+_HEADER = struct.Struct("<4sHIHI")  # magic, format version, sample rate, samples per frame, frames
+
+
+def frame_header(data, position: int):
+    """Parses the MPEG audio frame header at a position
+
+    Args:
+        data: bytes-like content of the file
+        position: offset of the header
+
+    Returns:
+        (int, int, int): length of the frame in bytes, samples per frame and sample rate, None if there is no valid
+        header at position (free format frames are not supported)
+
+    """
+    if position + 4 > len(data):
+        return None
+    header = int.from_bytes(data[position:position + 4], "big")
+    if header >> 21 != 0x7FF:
+        return None
+    version = header >> 19 & 3
+    layer = 4 - (header >> 17 & 3)
+    bitrate_index = header >> 12 & 15
+    rate_index = header >> 10 & 3
+    padding = header >> 9 & 1
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = _BITRATES[(1, layer) if mpeg1 else (2, min(layer, 2))][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][rate_index]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    samples = 1152 if mpeg1 or layer == 2 else 576
+    return samples // 8 * bitrate // sample_rate + padding, samples, sample_rate
+
+
+def _audio_start(data) -> int:
+    # skips the ID3v2 tags
+    position = 0
+    while data[position:position + 3] == b"ID3" and len(data) >= position + 10:
+        flags = data[position + 5]
+        size = 0
+        for byte in data[position + 6:position + 10]:
+            size = size << 7 | byte & 0x7F
+        position += 10 + size + (10 if flags & 0x10 else 0)
+    return position
+
+
+def _audio_end(data) -> int:
+    end = len(data)
+    if data[end - 128:end - 125] == b"TAG":
+        end -= 128
+    return end
+
+
+class SeekIndex:
+    """Byte offsets of the audio frames of an MPEG audio file
+
+    Every frame holds the same number of samples, so the time of a frame is known from its number and the table
+    gives where to start decoding to reach any time, without the scan of Mode.accuratetime.
+
+    Attributes:
+        sample_rate (int): sample rate of the file
+        samples_per_frame (int): number of samples per channel in a frame
+        offsets (array.array): uint32 byte offsets of the frames
+
+    """
+
+    def __init__(self, sample_rate: int, samples_per_frame: int, offsets: array.array):
+        self.sample_rate = sample_rate
+        self.samples_per_frame = samples_per_frame
+        self.offsets = offsets
+
+    def __repr__(self) -> str:
+        return "SeekIndex(frames={}, duration={:.3f}s)".format(len(self.offsets), self.duration / 1000)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    @property
+    def duration(self) -> float:
+        """duration in milliseconds"""
+        return self.frame_time(len(self.offsets))
+
+    def frame_time(self, frame: int) -> float:
+        """
+        Returns:
+            float: time in milliseconds at which a frame starts
+
+        """
+        return frame * self.samples_per_frame * 1000.0 / self.sample_rate
+
+    def frame_at(self, position: float) -> int:
+        """
+        Args:
+            position: time in milliseconds
+
+        Returns:
+            int: number of the frame playing at position
+
+        """
+        frame = int(position * self.sample_rate / 1000.0 / self.samples_per_frame)
+        return min(max(frame, 0), max(len(self.offsets) - 1, 0))
+
+    def locate(self, position: float) -> tuple:
+        """Finds where to start decoding to reach a time
+
+        Decoding starts at least one frame and RESERVOIR bytes before the frame playing at position, so that the
+        frame is decoded with its bit reservoir and the overlap of the previous frame.
+
+        Args:
+            position: time in milliseconds
+
+        Returns:
+            (int, float): byte offset of the first frame to decode, and the time in milliseconds to skip from it
+
+        """
+        target = self.frame_at(position)
+        frame = max(target - 1, 0)
+        while frame > 0 and self.offsets[target] - self.offsets[frame] < RESERVOIR:
+            frame -= 1
+        return self.offsets[frame], max(position - self.frame_time(frame), 0.0)
+
+    @staticmethod
+    def scan(path: str):
+        """Builds the index of a file in a single pass over its frame headers
+
+        The Xing, Info or VBRI header frame of VBR files is left out, like decoders do. After a damaged frame, the
+        next frame is searched and accepted if the frame following it is valid too.
+
+        Args:
+            path: path to the file
+
+        Returns:
+            SeekIndex, None if the file has no MPEG audio frames
+
+        """
+        with open(path, "rb") as file:
+            if not os.fstat(file.fileno()).st_size:
+                return None
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return SeekIndex._scan(data)
+
+    @staticmethod
+    def _scan(data):
+        position = _audio_start(data)
+        end = _audio_end(data)
+        offsets = array.array("I")
+        first = None
+        synced = False
+
+        while position + 4 <= end:
+            header = frame_header(data, position)
+            if header is not None and first is not None and header[1:] != first[1:]:
+                header = None
+            if header is not None and not synced:
+                # a sync word in the middle of data is accepted only if the next frame follows it
+                following = position + header[0]
+                synced = following + 4 > end or frame_header(data, following) is not None
+            if header is None or not synced:
+                synced = False
+                position = data.find(b"\xff", position + 1, end)
+                if position < 0:
+                    break
+                continue
+
+            length = header[0]
+            if first is None:
+                first = header
+                frame = data[position:position + min(length, 200)]
+                if b"Xing" in frame or b"Info" in frame or b"VBRI" in frame:
+                    position += length
+                    continue
+            offsets.append(position)
+            position += length
+
+        if first is None or not offsets:
+            return None
+        return SeekIndex(first[2], first[1], offsets)
+
+    def to_bytes(self) -> bytes:
+        offsets = array.array("I", self.offsets)
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        return _HEADER.pack(_MAGIC, 1, self.sample_rate, self.samples_per_frame, len(offsets)) + offsets.tobytes()
+
+    @staticmethod
+    def from_bytes(data: bytes):
+        """
+        Returns:
+            SeekIndex, None if data isn't an index written by to_bytes
+
+        """
+        if len(data) < _HEADER.size:
+            return None
+        magic, version, sample_rate, samples_per_frame, frames = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != 1 or len(data) != _HEADER.size + 4 * frames:
+            return None
+        offsets = array.array("I")
+        offsets.frombytes(data[_HEADER.size:])
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        return SeekIndex(sample_rate, samples_per_frame, offsets)
+
+
+class SeekIndexCache:
+    """Cache of the SeekIndex of MPEG audio files, keyed by path and last modification
+
+    Indexes are kept in memory for the last memory_size files, and stored in path (the same key layout as the
+    analysis caches) so that they are scanned once per version of a file.
+
+    Example:
+        player = PlayAudio(seek_indexes=SeekIndexCache("cache/seek"))
+
+    Attributes:
+        path (str): directory of the stored indexes, None to only keep them in memory
+        memory_size (int): number of indexes kept in memory
+
+    """
+
+    def __init__(self, path: str=None, memory_size: int=64):
+        self.path = os.path.abspath(path) if path is not None else None
+        if self.path is not None:
+            os.makedirs(self.path, exist_ok=True)
+        self.memory_size = memory_size
+        self._indexes = collections.OrderedDict()
+
+    @staticmethod
+    def supports(path: str) -> bool:
+        return path.lower().endswith(EXTENSIONS)
+
+    @staticmethod
+    def key(path: str) -> str:
+        path = os.path.abspath(path)
+        return hashlib.sha1("{}\0{}".format(path, os.path.getmtime(path)).encode("utf-8")).hexdigest()
+
+    def file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key + ".idx")
+
+    def get(self, path: str):
+        """
+        Args:
+            path: path to the file
+
+        Returns:
+            SeekIndex, scanned if it isn't in the cache, None if the file isn't an MPEG audio file
+
+        """
+        if not SeekIndexCache.supports(path):
+            return None
+        key = SeekIndexCache.key(path)
+        if key in self._indexes:
+            self._indexes.move_to_end(key)
+            return self._indexes[key]
+
+        index = self._load(key)
+        if index is None:
+            index = SeekIndex.scan(path)
+            if index is not None and self.path is not None:
+                self._store(key, index)
+        self._indexes[key] = index
+        while len(self._indexes) > self.memory_size:
+            self._indexes.popitem(last=False)
+        return index
+
+    def _load(self, key: str):
+        if self.path is None:
+            return None
+        try:
+            with open(self.file(key), "rb") as file:
+                return SeekIndex.from_bytes(file.read())
+        except OSError:
+            return None
+
+    def _store(self, key: str, index: SeekIndex) -> None:
+        atomic_write(self.file(key), index.to_bytes())
+
+
+def _read_mono(system: System, path: str, mode: int, fileoffset: int, pcm: int, frames: int):
+    # decodes frames samples from pcm, mixed down to mono
+    import numpy
+
+    sound = system.create_sound(path, mode | Mode.openonly | Mode.createstream | Mode.ignoretags, CreateSoundExInfo(fileoffset=fileoffset))
+    try:
+        _, format, channels, bits = sound.get_format()
+        dtype = {SoundFormat.pcm16: numpy.int16, SoundFormat.pcmfloat: numpy.float32}.get(format)
+        if dtype is None:
+            raise NotImplementedError("Not implemented sound format: {}".format(format))
+        sound.seek_data(max(pcm, 0))
+        size = frames * channels * numpy.dtype(dtype).itemsize
+        buffer = create_string_buffer(size)
+        read = sound.read_data(buffer, size)
+        samples = numpy.frombuffer(buffer.raw[:read], dtype=dtype).astype(numpy.float64)
+        samples = samples[:len(samples) // channels * channels].reshape(-1, channels).mean(axis=1)
+        if max(pcm, 0) > pcm:
+            samples = numpy.concatenate((numpy.zeros(-pcm), samples))
+        return samples
+    finally:
+        sound.release()
+
+
+def benchmark(path: str, positions=None, cache: SeekIndexCache=None, window: float=0.5, max_lag: float=0.5) -> dict:
+    """Measures the open latency and the seek error of an MPEG audio file with and without seek index
+
+    The decoded audio around each position is cross-correlated with the audio decoded with Mode.accuratetime, the
+    seek error is the lag of the best match.
+
+    Args:
+        path: path to the file
+        positions (None): seek positions in milliseconds, None for 10 positions evenly spread over the file
+        cache (None): SeekIndexCache, None for a cache in memory
+        window (0.5): duration in seconds of the compared audio
+        max_lag (0.5): maximum error in seconds which can be measured
+
+    Returns:
+        dict: for "plain", "accuratetime" and "index", the "open" time in seconds and the "errors" in milliseconds at
+        each position; "index" has the "scan" time too
+
+    """
+    import numpy
+
+    system = System(1, InitFlags.normal, output=OutputType.nosound_nrt)
+    cache = cache if cache is not None else SeekIndexCache()
+    results = {"plain": dict(), "accuratetime": dict(), "index": dict()}
+    try:
+        for name, mode in (("plain", 0), ("accuratetime", Mode.accuratetime)):
+            start = time.perf_counter()
+            system.create_stream(path, mode | Mode.ignoretags).release()
+            results[name]["open"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        index = cache.get(path)
+        results["index"]["scan"] = time.perf_counter() - start
+        if index is None:
+            raise ValueError("Not an MPEG audio file: {}".format(path))
+        start = time.perf_counter()
+        offset, _ = index.locate(0)
+        system.create_stream(path, Mode.ignoretags, CreateSoundExInfo(fileoffset=offset)).release()
+        results["index"]["open"] = time.perf_counter() - start
+
+        if positions is None:
+            positions = numpy.linspace(0, index.duration, 12)[1:-1]
+        rate = index.sample_rate
+        frames = int(window * rate)
+        lag = int(max_lag * rate)
+        for name in results:
+            results[name]["errors"] = []
+        for position in positions:
+            pcm = int(position * rate / 1000)
+            reference = _read_mono(system, path, Mode.accuratetime, 0, pcm - lag, frames + 2 * lag)
+            offset, skip = index.locate(position)
+            blocks = {
+                "plain": _read_mono(system, path, 0, 0, pcm, frames),
+                "accuratetime": _read_mono(system, path, Mode.accuratetime, 0, pcm, frames),
+                "index": _read_mono(system, path, 0, offset, int(skip * rate / 1000), frames),
+            }
+            for name, block in blocks.items():
+                if len(block) < frames or len(reference) < frames + 2 * lag:
+                    continue
+                correlation = numpy.correlate(reference, block, "valid")
+                results[name]["errors"].append((int(numpy.argmax(correlation)) - lag) * 1000.0 / rate)
+    finally:
+        system.release()
+    return results
@@ -0,0 +1,292 @@
+import collections
+import random
+import threading
+import time
+
+from library_xml.collation import normalize
+from library_xml.import_library import ChangeSet, LibrarySnapshot, Track
+
+
+def _first(tags, *keys) -> str:
+    for key in keys:
+        for value in tags.get(key) or ():
+            if value:
+                return value
+    return ""
+
+
+def _length(track) -> float:
+    try:
+        return float(track.info.get("length", 0.0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _count(counter: collections.Counter, key, sign: int) -> None:
+    # no empty entries are kept, so that removed codecs and names disappear
+    counter[key] += sign
+    if counter[key] <= 0:
+        del counter[key]
+
+
+class _Entity:
+    """roll-up statistics of a group of tracks, updated track by track"""
+
+    def __init__(self, key):
+        self.key = key
+        self.track_count = 0
+        self.length = 0.0
+        self.codecs = collections.Counter()
+        self._names = collections.Counter()
+
+    @property
+    def name(self) -> str:
+        """the most common spelling of the name among the tracks"""
+        return self._names.most_common(1)[0][0] if self._names else ""
+
+    def _add(self, track, name: str, sign: int) -> None:
+        self.track_count += sign
+        self.length += sign * _length(track)
+        _count(self.codecs, track.info.get("codec", ""), sign)
+        _count(self._names, name, sign)
+
+
+class Album(_Entity):
+    """Tracks sharing a musicbrainz album id, or an album artist and an album title
+
+    Attributes:
+        key (tuple): identifier of the album
+        artist_key (str): key of the Artist of the album
+        tracks (dict): {path: Track}
+        track_count (int): number of tracks
+        length (float): total length in seconds
+        codecs (collections.Counter): number of tracks per codec
+        discs (collections.Counter): number of tracks per disc number
+        years (collections.Counter): number of tracks per year
+
+    """
+
+    def __init__(self, key, artist_key: str):
+        super().__init__(key)
+        self.artist_key = artist_key
+        self.tracks = dict()
+        self.discs = collections.Counter()
+        self.years = collections.Counter()
+        self._artist_names = collections.Counter()
+
+    def __repr__(self) -> str:
+        return 'Album("{}", tracks={})'.format(self.name, self.track_count)
+
+    @property
+    def artist(self) -> str:
+        return self._artist_names.most_common(1)[0][0] if self._artist_names else ""
+
+    @property
+    def year(self) -> str:
+        """the earliest year of the tracks"""
+        return min(self.years) if self.years else ""
+
+    def add(self, track) -> None:
+        self.tracks[track.path] = track
+        self._update(track, 1)
+
+    def remove(self, track) -> None:
+        del self.tracks[track.path]
+        self._update(track, -1)
+
+    def _update(self, track, sign: int) -> None:
+        self._add(track, _first(track.tags, "album"), sign)
+        _count(self._artist_names, _first(track.tags, "albumartist", "artist"), sign)
+        _count(self.discs, _first(track.tags, "discnumber").split("/")[0], sign)
+        _count(self.years, _first(track.tags, "originaldate", "date")[:4], sign)
+
+
+class Artist(_Entity):
+    """Albums sharing an album artist
+
+    Attributes:
+        key (str): identifier of the artist
+        albums (set): keys of the albums of the artist
+        track_count (int): number of tracks
+        length (float): total length in seconds
+        codecs (collections.Counter): number of tracks per codec
+
+    """
+
+    def __init__(self, key: str):
+        super().__init__(key)
+        self.albums = set()
+
+    def __repr__(self) -> str:
+        return 'Artist("{}", albums={})'.format(self.name, len(self.albums))
+
+
+class Aggregation:
+    """Albums and artists of a library, maintained from its change sets
+
+    The aggregation is built in a single pass over the tracks. Then it subscribes to the library and updates the
+    statistics of the albums and artists touched by each ChangeSet, without regrouping the other tracks.
+
+    Example:
+        aggregation = Aggregation(library)
+        for album in aggregation.albums_of(artist_key):
+            print(album.name, album.track_count, album.length, dict(album.codecs))
+
+    Attributes:
+        albums (dict): {key: Album}
+        artists (dict): {key: Artist}
+
+    """
+
+    def __init__(self, library=None):
+        self.albums = dict()
+        self.artists = dict()
+        self._album_of = dict()  # path -> album key
+        self._lock = threading.RLock()
+        self.library = library
+        if library is not None:
+            with library._write_lock:
+                self.build(library.snapshot())
+                library.subscribe(self.apply)
+
+    def close(self) -> None:
+        """Stops following the library"""
+        if self.library is not None:
+            self.library.unsubscribe(self.apply)
+
+    @staticmethod
+    def album_key(track) -> tuple:
+        """
+        Returns:
+            tuple: ("mbid", id) if the track has a musicbrainz album id, ("tags", album artist, album) otherwise
+
+        """
+        mbid = _first(track.tags, "musicbrainz_albumid")
+        if mbid:
+            return "mbid", mbid
+        return "tags", Aggregation.artist_key(track), normalize(_first(track.tags, "album"), articles=False)
+
+    @staticmethod
+    def artist_key(track) -> str:
+        return normalize(_first(track.tags, "albumartistsort", "albumartist", "artistsort", "artist"))
+
+    def build(self, tracks) -> None:
+        """Replaces the content of the aggregation
+
+        Args:
+            tracks: iterable of Track
+
+        """
+        with self._lock:
+            self.albums = dict()
+            self.artists = dict()
+            self._album_of = dict()
+            for track in tracks:
+                self._add(track)
+
+    def apply(self, changes: ChangeSet) -> None:
+        """Updates the albums and artists touched by a ChangeSet
+
+        Args:
+            changes: the modifications of the library
+
+        """
+        with self._lock:
+            for track in changes.removed:
+                self._remove(track)
+            for old, new in changes.changed:
+                self._remove(old)
+                self._add(new)
+            for track in changes.added:
+                self._add(track)
+
+    def _add(self, track) -> None:
+        key = Aggregation.album_key(track)
+        album = self.albums.get(key)
+        if album is None:
+            album = self.albums[key] = Album(key, Aggregation.artist_key(track))
+            artist = self.artists.get(album.artist_key)
+            if artist is None:
+                artist = self.artists[album.artist_key] = Artist(album.artist_key)
+            artist.albums.add(key)
+        album.add(track)
+        self.artists[album.artist_key]._add(track, _first(track.tags, "albumartist", "artist"), 1)
+        self._album_of[track.path] = key
+
+    def _remove(self, track) -> None:
+        key = self._album_of.pop(track.path, None)
+        if key is None:
+            return
+        album = self.albums[key]
+        album.remove(track)
+        artist = self.artists[album.artist_key]
+        artist._add(track, _first(track.tags, "albumartist", "artist"), -1)
+        if not album.track_count:
+            del self.albums[key]
+            artist.albums.discard(key)
+            if not artist.albums:
+                del self.artists[album.artist_key]
+
+    def album_of(self, track):
+        """
+        Args:
+            track: a Track, or the path of a track
+
+        Returns:
+            Album, None if the track isn't in the aggregation
+
+        """
+        with self._lock:
+            key = self._album_of.get(track if isinstance(track, str) else track.path)
+            return self.albums.get(key)
+
+    def albums_of(self, artist_key: str) -> list:
+        """
+        Args:
+            artist_key: key of the artist, see artist_key
+
+        Returns:
+            list of Album: the albums of the artist, by year
+
+        """
+        with self._lock:
+            artist = self.artists.get(artist_key)
+            if artist is None:
+                return []
+            return sorted((self.albums[key] for key in artist.albums), key=lambda album: (album.year, normalize(album.name)))
+
+
+def benchmark(tracks, changed: int=100, repeat: int=3) -> dict:
+    """Compares a full rebuild of the aggregation with an incremental update
+
+    changed tracks are replaced by copies, as a refresh does for modified files, then the aggregation is both rebuilt
+    from scratch and updated from the ChangeSet.
+
+    Args:
+        tracks: list of Track
+        changed (100): number of modified tracks
+        repeat (3): the best time of repeat runs is kept
+
+    Returns:
+        dict: "rebuild" and "update" times in seconds, "speedup" = rebuild / update
+
+    """
+    tracks = list(tracks)
+    old = LibrarySnapshot(tracks, version=1)
+    modified = dict((i, Track(tracks[i].path, tracks[i].last_modification, tracks[i].info, tracks[i].tags))
+                    for i in random.sample(range(len(tracks)), min(changed, len(tracks))))
+    new = LibrarySnapshot([modified.get(i, track) for i, track in enumerate(tracks)], version=2)
+
+    rebuild = update = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        Aggregation().build(new)
+        rebuild = min(rebuild, time.perf_counter() - start)
+
+        aggregation = Aggregation()
+        aggregation.build(old)
+        start = time.perf_counter()
+        aggregation.apply(ChangeSet.between(old, new))
+        update = min(update, time.perf_counter() - start)
+
+    return {"rebuild": rebuild, "update": update, "speedup": rebuild / update if update else float("inf")}
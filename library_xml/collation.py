@@ -0,0 +1,287 @@
+import bisect
+import operator
+import re
+import threading
+import unicodedata
+
+
+ARTICLES = ("the", "a", "an", "le", "la", "les", "l'", "der", "die", "das", "el", "los", "las", "il", "lo", "gli")
+
+_RE_ARTICLE = re.compile(r"^(?:{})(?:\s+|(?<=')\s*)".format("|".join(sorted((re.escape(article) for article in ARTICLES), key=len, reverse=True))))
+_RE_NUMBER = re.compile(r"\s*(\d+)")
+
+
+def normalize(text: str, articles: bool=True) -> str:
+    """Gives the collation form of a text: NFKC normalized, case folded and stripped
+
+    Args:
+        text: the text
+        articles (True): removes a leading article, "The Beatles" -> "beatles"
+
+    Returns:
+        str
+
+    """
+    text = unicodedata.normalize("NFKC", text).casefold().strip()
+    if articles:
+        stripped = _RE_ARTICLE.sub("", text, count=1)
+        # "The The" stays "the"
+        if stripped:
+            text = stripped
+    return text
+
+
+def number(text: str) -> int:
+    """
+    Args:
+        text: a track or disc number, "3", "03" or "3/12"
+
+    Returns:
+        int: the number, -1 if text doesn't start with a number
+
+    """
+    match = _RE_NUMBER.match(text)
+    return int(match.group(1)) if match else -1
+
+
+def _first(tags, keys) -> tuple:
+    # (value, key) of the first key having a non empty value
+    for key in keys:
+        for value in tags.get(key) or ():
+            if value:
+                return value, key
+    return "", None
+
+
+def text_field(*keys):
+    """Makes a field reading the first non empty tag of keys
+
+    The sort tags (ending with "sort") are used as they are, the articles are only removed from the plain tags.
+
+    Args:
+        keys: the tags, sort tags first, "albumsort", "album" for example
+
+    Returns:
+        function taking a Track and returning a str
+
+    """
+    def field(track) -> str:
+        value, key = _first(track.tags, keys)
+        return normalize(value, articles=key is not None and not key.endswith("sort"))
+    return field
+
+
+def number_field(key: str):
+    """Makes a field reading a numeric tag, such as tracknumber
+
+    Returns:
+        function taking a Track and returning an int
+
+    """
+    def field(track) -> int:
+        return number(_first(track.tags, (key,))[0])
+    return field
+
+
+def date_field(track) -> str:
+    # ISO dates sort as text, "2004" before "2004-06-07"
+    return _first(track.tags, ("originaldate", "date", "originalyear"))[0].strip()
+
+
+def path_field(track) -> str:
+    return normalize(track.path, articles=False)
+
+
+FIELDS = {
+    "albumartist": text_field("albumartistsort", "albumartist", "artistsort", "artist"),
+    "artist": text_field("artistsort", "artist"),
+    "album": text_field("albumsort", "album"),
+    "title": text_field("titlesort", "title"),
+    "composer": text_field("composersort", "composer"),
+    "genre": text_field("genre"),
+    "date": date_field,
+    "discnumber": number_field("discnumber"),
+    "tracknumber": number_field("tracknumber"),
+    "path": path_field,
+}
+
+ALBUM_ORDER = ("albumartist", "date", "album", "discnumber", "tracknumber")
+
+
+def collation_key(track, order=ALBUM_ORDER) -> tuple:
+    """
+    Args:
+        track (Track): the track
+        order (ALBUM_ORDER): names of FIELDS
+
+    Returns:
+        tuple: the values of the fields, then the path of the track so that two tracks never have the same key
+
+    """
+    return tuple(FIELDS[name](track) for name in order) + (track.path,)
+
+
+class SortedView:
+    """Tracks of a library kept sorted by their collation keys
+
+    The key of a track is computed once, when the track enters the view. The view subscribes to the library and
+    applies its change sets with binary searches, so a refresh costs time proportional to the number of modified
+    tracks, and reading a page costs time proportional to its size.
+
+    Example:
+        view = SortedView(library, ("artist", "album", "tracknumber"))
+        rows = view.page(0, size=100)
+        first = view.index_of_prefix("n")  # first artist starting with n
+
+    Attributes:
+        order (tuple): names of the FIELDS the tracks are sorted by
+        rebuild_ratio (float): change sets touching more than this fraction of the view rebuild it at once
+
+    """
+
+    def __init__(self, library=None, order=ALBUM_ORDER, rebuild_ratio: float=0.25):
+        for name in order:
+            if name not in FIELDS:
+                raise KeyError("Unknown field: {}".format(name))
+        self.order = tuple(order)
+        self.rebuild_ratio = rebuild_ratio
+        self._keys = []
+        self._tracks = []
+        self._key_of = dict()  # path -> key
+        self._lock = threading.Lock()
+        self.library = library
+        if library is not None:
+            with library._write_lock:
+                self.rebuild(library.snapshot())
+                library.subscribe(self.apply)
+
+    def close(self) -> None:
+        """Stops following the library"""
+        if self.library is not None:
+            self.library.unsubscribe(self.apply)
+
+    def key(self, track) -> tuple:
+        return collation_key(track, self.order)
+
+    def rebuild(self, tracks) -> None:
+        """Replaces the content of the view
+
+        Args:
+            tracks: iterable of Track
+
+        """
+        self._replace([(self.key(track), track) for track in tracks])
+
+    def _replace(self, entries: list) -> None:
+        entries.sort(key=operator.itemgetter(0))
+        with self._lock:
+            self._keys = [key for key, _ in entries]
+            self._tracks = [track for _, track in entries]
+            self._key_of = {track.path: key for key, track in entries}
+
+    def apply(self, changes) -> None:
+        """Updates the view with a ChangeSet
+
+        Args:
+            changes (ChangeSet): the modifications of the library
+
+        """
+        # the keys are computed before locking, readers only wait for the list updates
+        removed = [track.path for track in changes.removed] + [old.path for old, _ in changes.changed]
+        added = [(self.key(track), track) for track in changes.added] + [(self.key(new), new) for _, new in changes.changed]
+
+        if len(changes) > self.rebuild_ratio * max(len(self._keys), 1):
+            # a sort of the kept entries, which are already in order, beats as many insertions
+            removed = set(removed)
+            with self._lock:
+                entries = [(key, track) for key, track in zip(self._keys, self._tracks) if track.path not in removed]
+            self._replace(entries + added)
+            return
+
+        with self._lock:
+            for path in removed:
+                key = self._key_of.pop(path, None)
+                if key is None:
+                    continue
+                i = bisect.bisect_left(self._keys, key)
+                del self._keys[i]
+                del self._tracks[i]
+            for key, track in added:
+                i = bisect.bisect_left(self._keys, key)
+                self._keys.insert(i, key)
+                self._tracks.insert(i, track)
+                self._key_of[track.path] = key
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self.slice(0, len(self)))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            return self.slice(start, stop)[::step]
+        with self._lock:
+            return self._tracks[index]
+
+    def slice(self, start: int, stop: int) -> list:
+        """
+        Args:
+            start: index of the first track
+            stop: index after the last track
+
+        Returns:
+            list of Track: the tracks between start and stop, fewer at the end of the view
+
+        """
+        with self._lock:
+            return self._tracks[max(start, 0):max(stop, 0)]
+
+    def page(self, number: int, size: int=100) -> list:
+        """
+        Args:
+            number: number of the page, from 0
+            size (100): number of tracks per page
+
+        Returns:
+            list of Track
+
+        """
+        return self.slice(number * size, (number + 1) * size)
+
+    def page_count(self, size: int=100) -> int:
+        return -(-len(self) // size)
+
+    def index_of(self, track) -> int:
+        """
+        Args:
+            track: a Track, or the path of a track
+
+        Returns:
+            int: the position of the track in the view
+
+        Raises:
+            ValueError: the track isn't in the view
+
+        """
+        path = track if isinstance(track, str) else track.path
+        with self._lock:
+            key = self._key_of.get(path)
+            if key is None:
+                raise ValueError("{} is not in the view".format(path))
+            return bisect.bisect_left(self._keys, key)
+
+    def index_of_prefix(self, prefix: str) -> int:
+        """Finds where the tracks whose first field starts with prefix begin, to jump to a letter for example
+
+        Args:
+            prefix: text compared to the first field, which must be a text field, normalized like it
+
+        Returns:
+            int: the position of the first track whose first field is greater or equal to prefix
+
+        """
+        value = normalize(prefix, articles=False)
+        with self._lock:
+            return bisect.bisect_left(self._keys, (value,))
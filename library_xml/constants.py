@@ -152,3 +152,9 @@ tags_conversion = {
 }
 
 tags_names = {key for key in tags_conversion["flac"]}
+
+# tags read eagerly by LazyTags, the ones shown and sorted in track lists
+hot_tags_names = {
+    "title", "titlesort", "artist", "artistsort", "album", "albumsort", "albumartist", "albumartistsort",
+    "tracknumber", "discnumber", "date", "originaldate", "musicbrainz_albumid",
+}
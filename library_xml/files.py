@@ -0,0 +1,34 @@
+import os
+import os.path
+
+
+def atomic_write(path: str, data) -> None:
+    """Writes a file which readers see either in full or not at all
+
+    The data is written to a temporary file in the same directory, which then replaces path. The temporary file is
+    removed if the write fails.
+
+    Example:
+        atomic_write("library.json", json.dumps(value))
+        atomic_write("peaks.npy", lambda file: numpy.save(file, array))
+
+    Args:
+        path: path to the file, its directory is created if it doesn't exist
+        data: bytes, str written in UTF-8, or a function writing to the temporary file, opened in binary mode
+
+    """
+    import tempfile  # only imported by the processes which write, it's slow to import
+
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "wb") as file:
+            if callable(data):
+                data(file)
+            else:
+                file.write(data.encode("utf-8") if isinstance(data, str) else data)
+        os.replace(temporary, path)
+    except BaseException:
+        os.remove(temporary)
+        raise
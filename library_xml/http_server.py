@@ -0,0 +1,385 @@
+import asyncio
+import collections
+import hashlib
+import http
+import json
+import mimetypes
+import os
+import random
+import re
+import time
+import urllib.parse
+
+
+MAX_HEADER_SIZE = 16384  # bytes, larger request heads are refused
+
+_RE_RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def track_id(track) -> str:
+    """
+    Returns:
+        str: identifier of a track in the urls, stable as long as the path of the track doesn't change
+
+    """
+    return hashlib.sha1(track.path.encode("utf-8")).hexdigest()[:16]
+
+
+def track_json(track) -> dict:
+    return {
+        "id": track_id(track),
+        "path": track.path,
+        "last_modification": float(track.last_modification),
+        "info": dict(track.info),
+        "tags": dict(track.tags),
+    }
+
+
+def parse_range(value: str, size: int):
+    """Parses a single byte range of a Range header
+
+    Args:
+        value: the header, "bytes=0-499", "bytes=500-" or "bytes=-500"
+        size: size of the file
+
+    Returns:
+        (int, int): first and last byte of the range, None if the header isn't a single byte range, which is then
+        ignored, or False if the range is outside of the file
+
+    """
+    match = _RE_RANGE.match(value.strip())
+    if match is None or not (match.group(1) or match.group(2)):
+        return None
+    if not match.group(1):
+        # suffix range, the last bytes
+        length = int(match.group(2))
+        if not length or not size:
+            return False
+        return max(size - length, 0), size - 1
+    first = int(match.group(1))
+    last = int(match.group(2)) if match.group(2) else size - 1
+    if first >= size or last < first:
+        return False
+    return first, min(last, size - 1)
+
+
+class StatCache:
+    """LRU cache of the stat results of the streamed files
+
+    A stat result is trusted for stat_ttl seconds, so seeking in a track doesn't stat it again at every request. The
+    files themselves aren't cached, every transfer opens its own: loop.sendfile falls back to reading the file when
+    os.sendfile can't be used, which moves its position under the other transfers of a shared file object.
+
+    Attributes:
+        size (int): maximum number of stat results kept
+        stat_ttl (float): number of seconds a stat result is trusted
+
+    """
+
+    def __init__(self, size: int=256, stat_ttl: float=2.0):
+        self.size = size
+        self.stat_ttl = stat_ttl
+        self._stats = collections.OrderedDict()  # path -> (stat result, time of the stat)
+
+    async def stat(self, path: str) -> os.stat_result:
+        """
+        Args:
+            path: path to the file, stat'ed in the default executor of the loop when its result is too old
+
+        Returns:
+            os.stat_result: the stat result of the file
+
+        Raises:
+            OSError: the file can't be stat'ed
+
+        """
+        entry = self._stats.get(path)
+        if entry is None or time.monotonic() - entry[1] > self.stat_ttl:
+            try:
+                stat = await asyncio.get_running_loop().run_in_executor(None, os.stat, path)
+            except OSError:
+                self.discard(path)
+                raise
+            entry = self._stats[path] = (stat, time.monotonic())
+            while len(self._stats) > self.size:
+                self._stats.popitem(last=False)
+        self._stats.move_to_end(path)
+        return entry[0]
+
+    def discard(self, path: str) -> None:
+        self._stats.pop(path, None)
+
+    def clear(self) -> None:
+        self._stats.clear()
+
+
+class LibraryServer:
+    """HTTP/1.1 server streaming the tracks of a library to the clients of the local network
+
+    Routes:
+        GET /tracks?page=0&size=100: the metadata of a page of tracks, as JSON
+        GET /tracks/<id>: the metadata of a track
+        GET /tracks/<id>/stream: the file of a track, with support of single byte ranges for seeking
+
+    The files are sent with loop.sendfile, which uses os.sendfile when the event loop supports it, so their content
+    never goes through Python. Stat results are cached by a StatCache, files are opened by every transfer, and
+    connections are kept alive between requests. Stats and opens run in the default executor of the loop.
+
+    Example:
+        server = LibraryServer(library, host="0.0.0.0", port=8080)
+        asyncio.run(server.serve_forever())
+
+    Attributes:
+        library (Library): the served library, read through its snapshots
+        host (str): address to listen on
+        port (int): port to listen on, 0 to pick a free port, see the port attribute after start
+        page_size (int): default number of tracks per page
+        max_page_size (int): maximum number of tracks per page
+        stats (StatCache): the stat results of the streamed files
+
+    """
+
+    def __init__(self, library, host: str="127.0.0.1", port: int=8080, page_size: int=100, max_page_size: int=1000, stats: StatCache=None):
+        self.library = library
+        self.host = host
+        self.port = port
+        self.page_size = page_size
+        self.max_page_size = max_page_size
+        self.stats = stats if stats is not None else StatCache()
+        self._server = None
+        self._index_version = None
+        self._index = dict()
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port, limit=MAX_HEADER_SIZE)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        self.stats.clear()
+
+    async def serve_forever(self) -> None:
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def _track(self, identifier: str):
+        snapshot = self.library.snapshot()
+        if self._index_version != snapshot.version:
+            self._index = {track_id(track): track for track in snapshot}
+            self._index_version = snapshot.version
+        return self._index.get(identifier)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except asyncio.LimitOverrunError:
+                    await self._respond(writer, http.HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, close=True)
+                    return
+                except asyncio.IncompleteReadError:
+                    return
+                lines = head.decode("iso-8859-1").split("\r\n")
+                try:
+                    method, target, version = lines[0].split(" ")
+                except ValueError:
+                    await self._respond(writer, http.HTTPStatus.BAD_REQUEST, close=True)
+                    return
+                headers = dict()
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                close = headers.get("connection", "").lower() == "close" or version == "HTTP/1.0"
+                await self._dispatch(writer, method, target, headers, close)
+                if close:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, writer, method: str, target: str, headers: dict, close: bool) -> None:
+        if method not in ("GET", "HEAD"):
+            await self._respond(writer, http.HTTPStatus.METHOD_NOT_ALLOWED, {"Allow": "GET, HEAD"}, close=close)
+            return
+        head = method == "HEAD"
+        url = urllib.parse.urlsplit(target)
+        parts = [part for part in url.path.split("/") if part]
+
+        if parts == ["tracks"]:
+            query = urllib.parse.parse_qs(url.query)
+            try:
+                page = max(int(query.get("page", ["0"])[0]), 0)
+                size = min(max(int(query.get("size", [str(self.page_size)])[0]), 1), self.max_page_size)
+            except ValueError:
+                await self._respond(writer, http.HTTPStatus.BAD_REQUEST, close=close)
+                return
+            snapshot = self.library.snapshot()
+            body = {
+                "page": page,
+                "size": size,
+                "total": len(snapshot),
+                "version": snapshot.version,
+                "tracks": [track_json(track) for track in snapshot[page * size:(page + 1) * size]],
+            }
+            await self._respond_json(writer, body, head, close)
+            return
+
+        track = self._track(parts[1]) if len(parts) in (2, 3) and parts[0] == "tracks" else None
+        if track is None or (len(parts) == 3 and parts[2] != "stream"):
+            await self._respond(writer, http.HTTPStatus.NOT_FOUND, close=close)
+        elif len(parts) == 2:
+            await self._respond_json(writer, track_json(track), head, close)
+        else:
+            await self._stream(writer, track, headers, head, close)
+
+    async def _stream(self, writer, track, headers: dict, head: bool, close: bool) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            size = (await self.stats.stat(track.path)).st_size
+            file = None if head else await loop.run_in_executor(None, open, track.path, "rb")
+        except OSError:
+            await self._respond(writer, http.HTTPStatus.NOT_FOUND, close=close)
+            return
+        try:
+            response_headers = {
+                "Content-Type": mimetypes.guess_type(track.path)[0] or "application/octet-stream",
+                "Accept-Ranges": "bytes",
+                "ETag": '"{}"'.format(track.fingerprint()),
+            }
+            status = http.HTTPStatus.OK
+            first, last = 0, size - 1
+            requested = parse_range(headers["range"], size) if "range" in headers else None
+            if requested is False:
+                response_headers["Content-Range"] = "bytes */{}".format(size)
+                await self._respond(writer, http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, response_headers, close=close)
+                return
+            if requested is not None:
+                status = http.HTTPStatus.PARTIAL_CONTENT
+                first, last = requested
+                response_headers["Content-Range"] = "bytes {}-{}/{}".format(first, last, size)
+
+            count = last - first + 1
+            await self._respond(writer, status, response_headers, length=count, close=close)
+            if file is not None and count > 0:
+                await writer.drain()
+                if await loop.sendfile(writer.transport, file, first, count) < count:
+                    # the file shrank since its stat, the announced length can't be sent
+                    self.stats.discard(track.path)
+                    raise ConnectionAbortedError(track.path)
+        finally:
+            if file is not None:
+                file.close()
+
+    async def _respond_json(self, writer, value, head: bool, close: bool) -> None:
+        body = json.dumps(value).encode("utf-8")
+        await self._respond(writer, http.HTTPStatus.OK, {"Content-Type": "application/json"}, b"" if head else body, len(body), close)
+
+    @staticmethod
+    async def _respond(writer, status: http.HTTPStatus, headers: dict=None, body: bytes=b"", length: int=None, close: bool=False) -> None:
+        lines = ["HTTP/1.1 {} {}".format(status.value, status.phrase)]
+        for name, value in (headers or dict()).items():
+            lines.append("{}: {}".format(name, value))
+        lines.append("Content-Length: {}".format(len(body) if length is None else length))
+        if close:
+            lines.append("Connection: close")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1") + body)
+        await writer.drain()
+
+
+async def _request(reader, writer, host: str, target: str, headers: dict=None, keep_body: bool=True) -> tuple:
+    # sends a request on a kept alive connection, returns (status, time to first byte, body or its length)
+    lines = ["GET {} HTTP/1.1".format(target), "Host: {}".format(host)]
+    lines.extend("{}: {}".format(name, value) for name, value in (headers or dict()).items())
+    start = time.perf_counter()
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("iso-8859-1"))
+    await writer.drain()
+    first = await reader.readexactly(1)
+    ttfb = time.perf_counter() - start
+    head = first + await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+    if keep_body:
+        return status, ttfb, await reader.readexactly(length)
+    remaining = length
+    while remaining:
+        remaining -= len(await reader.readexactly(min(remaining, 1 << 20)))
+    return status, ttfb, length
+
+
+async def load_test(host: str="127.0.0.1", port: int=8080, clients: int=100, requests_per_client: int=20, range_size: int=None) -> dict:
+    """Streams random tracks of a running LibraryServer from concurrent clients
+
+    Every client keeps its connection alive and downloads requests_per_client random tracks, or random ranges of
+    range_size bytes to simulate seeking.
+
+    Args:
+        host ("127.0.0.1"): address of the server
+        port (8080): port of the server
+        clients (100): number of concurrent clients
+        requests_per_client (20): number of downloads per client
+        range_size (None): size of the requested ranges, None to download whole files
+
+    Returns:
+        dict: "requests", "bytes", "seconds", "throughput" in bytes per second, "requests_per_second", and the
+        "ttfb_p50" and "ttfb_p99" times to first byte in seconds
+
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+    identifiers = []
+    page = 0
+    while True:
+        _, _, body = await _request(reader, writer, host, "/tracks?page={}&size=1000".format(page))
+        tracks = json.loads(body)["tracks"]
+        identifiers.extend(track["id"] for track in tracks)
+        if len(tracks) < 1000:
+            break
+        page += 1
+    writer.close()
+    if not identifiers:
+        raise ValueError("The library is empty")
+
+    ttfbs = []
+    transferred = 0
+
+    async def client():
+        nonlocal transferred
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            for _ in range(requests_per_client):
+                headers = None
+                if range_size is not None:
+                    first = random.randrange(1 << 16)
+                    headers = {"Range": "bytes={}-{}".format(first, first + range_size - 1)}
+                target = "/tracks/{}/stream".format(random.choice(identifiers))
+                status, ttfb, length = await _request(reader, writer, host, target, headers, keep_body=False)
+                if status in (200, 206):
+                    ttfbs.append(ttfb)
+                    transferred += length
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    seconds = time.perf_counter() - start
+
+    ttfbs.sort()
+    percentile = lambda p: ttfbs[min(int(p * len(ttfbs)), len(ttfbs) - 1)] if ttfbs else float("nan")
+    return {
+        "requests": len(ttfbs),
+        "bytes": transferred,
+        "seconds": seconds,
+        "throughput": transferred / seconds,
+        "requests_per_second": len(ttfbs) / seconds,
+        "ttfb_p50": percentile(0.50),
+        "ttfb_p99": percentile(0.99),
+    }
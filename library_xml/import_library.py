@@ -1,18 +1,48 @@
+from __future__ import annotations
+
 import os
 import os.path
 import time
+import sys
+
+import collections
+import importlib
+import itertools
+import marshal
+import threading
+
+import hashlib
 
 import re
 
-import xml.sax.saxutils
-import xml.etree.ElementTree as ET
+from library_xml.constants import tags_conversion, tags_names, hot_tags_names
+from library_xml.files import atomic_write
+
+
+class _LazyModule:
+    """Stands for a module which is imported the first time one of its attributes is used
+
+    The heavy modules are only imported by the code paths needing them, so that importing the library is fast.
+    """
+
+    def __init__(self, *names):
+        self._names = names
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            for name in self._names:
+                importlib.import_module(name)
+            self._module = sys.modules[self._names[0]]
+        return getattr(self._module, attribute)
 
-import mutagen
-import mutagen.mp3
-import mutagen.id3
-import mutagen.flac
 
-from library_xml.constants import tags_conversion, tags_names
+asyncio = _LazyModule("asyncio")
+logging = _LazyModule("logging")
+xml = _LazyModule("xml", "xml.sax.saxutils")
+ET = _LazyModule("xml.etree.ElementTree")
+mutagen = _LazyModule("mutagen", "mutagen.mp3", "mutagen.id3", "mutagen.flac")
+
 
 
 class Track:
@@ -24,8 +54,13 @@ class Track:
         info (Info): information about the file (codec, bitrate, etc)
         tags (Tags): tags of the file (album, artist, title, etc)
 
+    Class attributes:
+        lazy_tags (bool): read the tags as LazyTags by default, only the hot tags are decoded when a track is read
+
     """
 
+    lazy_tags = False
+
     def __init__(self, path, last_modification, info, tags):
         self.path = path
         self.last_modification = last_modification
@@ -33,11 +68,12 @@ class Track:
         self.tags = tags
 
     @staticmethod
-    def from_path(path: str):
+    def from_path(path: str, lazy: bool=None):
         """Reads the file's informations
 
         Args:
             path (str): path to the file
+            lazy (None): stores the tags as LazyTags, defaults to Track.lazy_tags
 
         Returns:
             Track
@@ -48,12 +84,26 @@ class Track:
         last_modification = os.path.getmtime(path)
         info = Info.from_mutagen_file(file)
         tags = Tags.from_mutagen_file(file)
+        if Track.lazy_tags if lazy is None else lazy:
+            tags = LazyTags.from_tags(tags)
 
         return Track(path, last_modification, info, tags)
 
     def __repr__(self) -> str:
         return 'Track("{}")'.format(self.path)
 
+    def fingerprint(self) -> str:
+        """Identifies the version of the file the track was read from
+
+        Two tracks have the same fingerprint if they come from the same path with the same last modification
+        timestamp, whether they were read from the file or from xml. Used as a key to cache analysis results.
+
+        Returns:
+            str: hexadecimal sha1 digest
+
+        """
+        return hashlib.sha1("{}\0{}".format(self.path, self.last_modification).encode("utf-8")).hexdigest()
+
     def has_file_changed(self) -> bool:
         """Compares the last modification timestamp of the file with self.last_modification to determine if the file has changed since its import
 
@@ -61,11 +111,13 @@ class Track:
             bool: file changed ?
 
         """
-        return os.path.getmtime(self.path) != self.last_modification
+        return os.path.getmtime(self.path) != float(self.last_modification)
 
     def refresh(self) -> bool:
         """Checks the file has been modified since import and re-import it if it has
 
+        The track is modified in place, use refreshed for a track which may be shared with other threads.
+
         Returns:
             bool, file refreshed ?
 
@@ -74,19 +126,66 @@ class Track:
             file = mutagen.File(self.path)
             self.last_modification = os.path.getmtime(self.path)
             self.info = Info.from_mutagen_file(file)
-            self.tags = Tags.from_mutagen_file(file)
+            tags = Tags.from_mutagen_file(file)
+            self.tags = LazyTags.from_tags(tags) if isinstance(self.tags, LazyTags) else tags
             return True
         else:
             return False
 
+    def refreshed(self):
+        """Copy-on-write counterpart of refresh, the track itself is never modified
+
+        Returns:
+            Track: a new track read from the file if it has been modified since import, self otherwise
+
+        """
+        if self.has_file_changed():
+            return Track.from_path(self.path, isinstance(self.tags, LazyTags))
+        return self
+
     @staticmethod
-    def from_root_tree(root: ET.Element):
+    def from_root_tree(root: ET.Element, lazy: bool=None):
         path = root.attrib["path"]
         last_modification = root.attrib["last_modification"]
         info = Info.from_root_tree(root.find("info"))
-        tags = Tags.from_root_tree(root.find("tags"))
+        tags = (LazyTags if (Track.lazy_tags if lazy is None else lazy) else Tags).from_root_tree(root.find("tags"))
         return Track(path, last_modification, info, tags)
 
+    def to_record(self) -> tuple:
+        """Gives the track as a tuple of builtin types, for Library.write_cache
+
+        The tags are split like LazyTags, so that the cache loads as fast whether it was written from lazy tags or
+        not, the cold tags of LazyTags which aren't decoded are stored without decoding them.
+
+        Returns:
+            tuple: (path, last_modification, info, hot tags, cold tags record or None, cold tags record read from xml)
+
+        """
+        tags = self.tags
+        if not isinstance(tags, LazyTags) or tags.is_decoded:
+            tags = LazyTags.from_tags(tags)
+        return self.path, self.last_modification, dict(self.info), dict(dict.items(tags)), tags._record, tags._xml_record
+
+    @staticmethod
+    def from_record(record: tuple, lazy: bool=None):
+        """
+        Args:
+            record: result of Track.to_record
+            lazy (None): stores the tags as LazyTags, defaults to Track.lazy_tags
+
+        Returns:
+            Track
+
+        """
+        path, last_modification, info, tags, cold, xml_cold = record
+        if Track.lazy_tags if lazy is None else lazy:
+            tags = LazyTags._restore(tags, cold, xml_cold) if cold is not None else LazyTags.from_tags(tags)
+        elif cold is not None:
+            tags = Tags(LazyTags._restore(tags, cold, xml_cold).items())
+        else:
+            tags = Tags(tags)
+        return Track(path, last_modification, Info(info), tags)
+
     def to_root_tree(self) -> ET.Element:
         root = ET.Element("track")
         root.attrib["path"] = xml.sax.saxutils.escape(self.path)
@@ -352,11 +451,300 @@ class Tags(dict):
         return ET.tostring(self.to_root_tree(), encoding="utf-8").decode(encoding="utf-8")
 
 
+class LazyTags(Tags):
+    """Tags decoding only the hot tags eagerly
+
+    The tags of hot_tags_names are stored in the dict, the other ones are kept in a compact record which is decoded
+    the first time a cold tag is read, or when the tags are iterated or modified. Hot tags are served without decoding
+    the record, so list views of large libraries never pay for the ~80 tags of every track.
+
+    The reads of each tag of all the LazyTags are counted in accesses, and the number of records decoded in decoded,
+    to check which tags deserve to be hot.
+
+    Example:
+        Track.lazy_tags = True
+        library = Library.from_xml(xml_text)
+        print(LazyTags.accesses.most_common(10), LazyTags.decoded)
+
+    """
+
+    accesses = collections.Counter()
+    decoded = 0
+
+    # separators of the record, control characters can't be in xml text
+    _ENTRY = "\x1e"
+    _KEY = "\x1f"
+    _VALUE = "\x1d"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._record = None
+        self._xml_record = False
+
+    @staticmethod
+    def from_root_tree(root: ET.Element):
+        tags = LazyTags()
+        cold = []
+
+        for element in root:
+            if element.tag in hot_tags_names:
+                dict.__setitem__(tags, element.tag, list(map(str.strip, str(element.text).split(";"))))
+            elif element.tag in tags_names:
+                # split on first access, like Tags.from_root_tree
+                cold.append(element.tag + LazyTags._KEY + str(element.text))
+
+        if cold:
+            tags._record = LazyTags._ENTRY.join(cold).encode("utf-8")
+            tags._xml_record = True
+        return tags
+
+    @staticmethod
+    def from_tags(tags: Tags):
+        """Moves the cold tags of tags into a record
+
+        Args:
+            tags: the tags, Tags.from_mutagen_file for example
+
+        Returns:
+            LazyTags
+
+        """
+        lazy = LazyTags()
+        cold = []
+
+        for key, values in dict.items(tags):
+            if key in hot_tags_names:
+                dict.__setitem__(lazy, key, values)
+            else:
+                cold.append(key + LazyTags._KEY + LazyTags._VALUE.join(values))
+
+        if cold:
+            lazy._record = LazyTags._ENTRY.join(cold).encode("utf-8")
+        return lazy
+
+    @staticmethod
+    def _restore(hot: dict, record: bytes, xml_record: bool):
+        tags = LazyTags(hot)
+        tags._record = record
+        tags._xml_record = xml_record
+        return tags
+
+    def __reduce__(self):
+        # pickled as is, the record stays encoded in the processes of map_library
+        return LazyTags._restore, (dict(dict.items(self)), self._record, self._xml_record)
+
+    @property
+    def is_decoded(self) -> bool:
+        return self._record is None
+
+    def decode(self) -> None:
+        """Decodes the cold tags, does nothing if they were already decoded"""
+        record = self._record
+        if record is None:
+            return
+
+        for entry in record.decode("utf-8").split(LazyTags._ENTRY):
+            key, _, text = entry.partition(LazyTags._KEY)
+            if self._xml_record:
+                values = list(map(str.strip, text.split(";")))
+            else:
+                values = text.split(LazyTags._VALUE) if text else []
+            dict.__setitem__(self, key, values)
+
+        self._record = None
+        LazyTags.decoded += 1
+
+    def _read(self, key) -> None:
+        LazyTags.accesses[key] += 1
+        if self._record is not None and key not in hot_tags_names:
+            self.decode()
+
+    def __getitem__(self, key):
+        self._read(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        self._read(key)
+        return dict.get(self, key, default)
+
+    def __contains__(self, key) -> bool:
+        self._read(key)
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        self.decode()
+        return dict.__iter__(self)
+
+    def __len__(self) -> int:
+        self.decode()
+        return dict.__len__(self)
+
+    def __repr__(self) -> str:
+        self.decode()
+        return dict.__repr__(self)
+
+    def __eq__(self, other) -> bool:
+        self.decode()
+        if isinstance(other, LazyTags):
+            other.decode()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other) -> bool:
+        return not self == other
+
+    __hash__ = None
+
+    def __or__(self, other):
+        self.decode()
+        return dict.__or__(self, other)
+
+    def __ror__(self, other):
+        self.decode()
+        return dict.__ror__(self, other)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def keys(self):
+        self.decode()
+        return dict.keys(self)
+
+    def values(self):
+        self.decode()
+        return dict.values(self)
+
+    def items(self):
+        self.decode()
+        return dict.items(self)
+
+    def copy(self) -> dict:
+        self.decode()
+        return dict.copy(self)
+
+    # the modifications decode the record first, so that it never holds stale values
+
+    def __setitem__(self, key, value) -> None:
+        self.decode()
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key) -> None:
+        self.decode()
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        self.decode()
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self.decode()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self.decode()
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs) -> None:
+        self.decode()
+        dict.update(self, *args, **kwargs)
+
+    def clear(self) -> None:
+        self._record = None
+        dict.clear(self)
+
+
+class LibrarySnapshot(tuple):
+    """Immutable view of the tracks of a Library at a given version
+
+    A snapshot never changes: the library publishes a new snapshot after each modification, and its own methods
+    replace modified tracks by new Track objects instead of modifying them, so the tracks of a snapshot are
+    never modified by the library either.
+
+    Attributes:
+        path (str): path to the root of the library
+        version (int): version of the library the snapshot was taken from
+
+    """
+
+    def __new__(cls, tracks=(), path: str="", version: int=0):
+        snapshot = super().__new__(cls, tracks)
+        snapshot.path = path
+        snapshot.version = version
+        return snapshot
+
+    def __repr__(self) -> str:
+        return 'LibrarySnapshot("{}", version={}, tracks={})'.format(self.path, self.version, len(self))
+
+
+class ChangeSet:
+    """Difference between two snapshots of a library
+
+    The methods of the library keep unchanged tracks as the same objects, so a track is changed when its path maps to
+    another object.
+
+    Attributes:
+        added (list of Track): tracks of the new snapshot only
+        removed (list of Track): tracks of the old snapshot only
+        changed (list of (Track, Track)): (old, new) pairs of tracks with the same path
+        old_version (int): version of the old snapshot
+        new_version (int): version of the new snapshot
+
+    """
+
+    def __init__(self, added=(), removed=(), changed=(), old_version: int=0, new_version: int=0):
+        self.added = list(added)
+        self.removed = list(removed)
+        self.changed = list(changed)
+        self.old_version = old_version
+        self.new_version = new_version
+
+    def __repr__(self) -> str:
+        return "ChangeSet(added={}, removed={}, changed={})".format(len(self.added), len(self.removed), len(self.changed))
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+    def __len__(self) -> int:
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    @staticmethod
+    def between(old: LibrarySnapshot, new: LibrarySnapshot):
+        """
+        Args:
+            old: the old snapshot
+            new: the new snapshot
+
+        Returns:
+            ChangeSet
+
+        """
+        remaining = {track.path: track for track in old}
+        added = []
+        changed = []
+        for track in new:
+            previous = remaining.pop(track.path, None)
+            if previous is None:
+                added.append(track)
+            elif previous is not track:
+                changed.append((previous, track))
+        return ChangeSet(added, remaining.values(), changed, old.version, new.version)
+
+
 class Library(list):
     """[Track] wrapper
 
+    Readers running in other threads than the one modifying the library should use snapshot, which never blocks and
+    always gives a consistent view. The methods of the library build the new list of tracks aside, publish it as a
+    new snapshot and swap it in the list at once. Modifying the list directly drops the published snapshot, the next
+    call to snapshot publishes a new one, or gives the previous one while a writer holds the lock.
+
+    Views derived from the tracks (sorted views, aggregations, ...) subscribe to the library and receive the
+    ChangeSet between consecutive snapshots, so that they are updated instead of being rebuilt.
+
     Attributes:
         path (str): path to the root of the library
+        version (int): incremented each time a new snapshot is published and each time the list is modified directly
+        excluded (set): absolute paths of subfolders of path which are not imported, they belong to other libraries
 
     Todo:
         - add refresh function
@@ -371,17 +759,212 @@ class Library(list):
         """
         super().__init__()
         self.path = os.path.abspath(path)
+        self.version = 0
+        self.excluded = set()
+        self._snapshot = LibrarySnapshot((), self.path, 0)
+        self._published = self._snapshot
+        self._listeners = []
+        # serializes the writers, readers never take it
+        self._write_lock = threading.RLock()
+
+    def __reduce__(self):
+        # the lock and the listeners belong to this library, a copy or an unpickled library gets its own
+        return Library._restore, (type(self), self.path, self.version, set(self.excluded), list(self))
+
+    @staticmethod
+    def _restore(cls, path: str, version: int, excluded: set, tracks: list):
+        library = cls(path)
+        library.excluded = excluded
+        library._publish(LibrarySnapshot(tracks, library.path, version), tracks)
+        return library
+
+    def snapshot(self) -> LibrarySnapshot:
+        """Gives the last published view of the library, without locking
+
+        Returns:
+            LibrarySnapshot
+
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            # the list was modified directly since the last publication, a writer holding the lock publishes soon
+            if not self._write_lock.acquire(blocking=False):
+                return self._published
+            try:
+                return self.publish()
+            finally:
+                self._write_lock.release()
+        return snapshot
+
+    def publish(self) -> LibrarySnapshot:
+        """Publishes the current content of the library as a new snapshot
+
+        Returns:
+            LibrarySnapshot: the new snapshot
+
+        """
+        with self._write_lock:
+            return self._publish(LibrarySnapshot(self, self.path, self.version + 1))
+
+    def _publish(self, snapshot: LibrarySnapshot, tracks: list=None, changes: ChangeSet=None) -> LibrarySnapshot:
+        """Publishes snapshot, then replaces the content of the list by tracks if given, and calls the listeners
+
+        changes is the ChangeSet from the published snapshot to snapshot when the caller knows it, it is computed
+        otherwise.
+        """
+        with self._write_lock:
+            self.version = snapshot.version
+            # a single assignment, readers see either the old or the new snapshot
+            self._snapshot = snapshot
+            if tracks is not None:
+                # not through __setitem__, which would drop the snapshot
+                list.__setitem__(self, slice(None), tracks)
+            previous, self._published = self._published, snapshot
+            if self._listeners:
+                if changes is None:
+                    changes = ChangeSet.between(previous, snapshot)
+                else:
+                    changes.old_version, changes.new_version = previous.version, snapshot.version
+                if changes:
+                    for listener in list(self._listeners):
+                        listener(changes)
+            return snapshot
+
+    def subscribe(self, listener) -> None:
+        """Calls listener with the ChangeSet of every new snapshot
+
+        Listeners are called by the thread publishing the snapshot, with the write lock held, so they see the
+        change sets one at a time and in order.
+
+        Args:
+            listener: function taking a ChangeSet
+
+        """
+        with self._write_lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener) -> None:
+        with self._write_lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def _modified(self) -> None:
+        self.version += 1
+        self._snapshot = None
+
+    def append(self, track) -> None:
+        super().append(track)
+        self._modified()
+
+    def extend(self, tracks) -> None:
+        super().extend(tracks)
+        self._modified()
+
+    def insert(self, index: int, track) -> None:
+        super().insert(index, track)
+        self._modified()
+
+    def remove(self, track) -> None:
+        super().remove(track)
+        self._modified()
+
+    def pop(self, index: int=-1):
+        track = super().pop(index)
+        self._modified()
+        return track
+
+    def clear(self) -> None:
+        super().clear()
+        self._modified()
+
+    def sort(self, *args, **kwargs) -> None:
+        super().sort(*args, **kwargs)
+        self._modified()
+
+    def reverse(self) -> None:
+        super().reverse()
+        self._modified()
+
+    def __setitem__(self, index, value) -> None:
+        super().__setitem__(index, value)
+        self._modified()
+
+    def __delitem__(self, index) -> None:
+        super().__delitem__(index)
+        self._modified()
+
+    def __iadd__(self, tracks):
+        result = super().__iadd__(tracks)
+        self._modified()
+        return result
+
+    def _commit(self, tracks: list) -> None:
+        """Publishes tracks as the new content of the library and replaces the content of the list"""
+        tracks = list(tracks)
+        with self._write_lock:
+            self._publish(LibrarySnapshot(tracks, self.path, self.version + 1), tracks)
+
+    def _commit_changes(self, changes: ChangeSet) -> None:
+        """Publishes the content of the library modified by a ChangeSet, without comparing the whole library
+
+        The removed tracks and the old tracks of the changed ones must be tracks of the library.
+        """
+        with self._write_lock:
+            if self._snapshot is not self._published:
+                # the list was modified directly, the listeners get these modifications first
+                self.publish()
+            tracks = list(self)
+            if changes.removed or changes.changed:
+                if len(changes.removed) + len(changes.changed) > 8:
+                    positions = dict(zip(map(id, tracks), range(len(tracks))))
+                    position = lambda track: positions[id(track)]
+                else:
+                    # a few searches by identity, tracks don't define __eq__, cost less than mapping every track
+                    position = tracks.index
+                for old, new in changes.changed:
+                    tracks[position(old)] = new
+                if changes.removed:
+                    kept = bytearray(b"\x01") * len(tracks)
+                    for track in changes.removed:
+                        kept[position(track)] = 0
+                    tracks = list(itertools.compress(tracks, kept))
+            tracks.extend(changes.added)
+            self._publish(LibrarySnapshot(tracks, self.path, self.version + 1), tracks, changes)
+
+    def _rebase(self, base: list, tracks: list) -> list:
+        """Applies the changes from base to tracks on top of the current content of the library
+
+        Used by the async methods, which read the files without holding the lock: the tracks modified, added or
+        removed by another writer since base was taken keep the modification of the other writer.
+
+        Returns:
+            list: the new content of the library
+
+        """
+        changes = ChangeSet.between(LibrarySnapshot(base), LibrarySnapshot(tracks))
+        removed = {track.path: track for track in changes.removed}
+        changed = {old.path: (old, new) for old, new in changes.changed}
+        rebased = []
+        for track in self:
+            if removed.get(track.path) is track:
+                continue
+            old, new = changed.get(track.path, (None, None))
+            rebased.append(new if old is track else track)
+        tracked_paths = {track.path for track in self}
+        rebased.extend(track for track in changes.added if track.path not in tracked_paths)
+        return rebased
 
     @staticmethod
-    def from_path(path: str):
+    def from_path(path: str, scheduler=None):
         """Initializes the library and imports all the music files located in path and its subfolders
 
         Args:
             path: path to the root of the folder to import
+            scheduler (None): ScanScheduler reading the files, None reads them one after the other
 
         """
         lib = Library(path)
-        lib.import_untracked_files()
+        lib.import_untracked_files(scheduler)
         return lib
 
     def clean_deleted_files(self) -> None:
@@ -391,50 +974,211 @@ class Library(list):
             - add log message
 
         """
-        super().__init__(list(filter(lambda track: os.path.isfile(track.path), self)))
+        with self._write_lock:
+            self._commit(self._cleaned(self))
+
+    def refresh_tracked_files(self, scheduler=None) -> None:
+        """Refreshes all the tracked music files using Track.refreshed
 
-    def refresh_tracked_files(self) -> None:
-        """Refreshes all the tracked music files using Track.refresh
+        If the refresh of a track fails, the track is deleted from the library. Modified tracks are replaced by
+        new Track objects, the tracks of the previous snapshots are left untouched.
 
-        If the refresh of a track fails, the track is deleted from the library.
+        Args:
+            scheduler (None): ScanScheduler reading the modified files, None reads them one after the other
 
         Todo:
             - add log message
 
         """
-        failed = list()
-        for track in self:
-            try:
-                track.refresh()
-            except:
-                # TODO add log message
-                failed.append(track)
+        with self._write_lock:
+            self._commit(Library._run_steps(self._steps(self, refresh=True, imports=False, scheduler=scheduler), scheduler))
 
-        for track in failed:
-            self.remove(track)
-
-    def import_untracked_files(self) -> None:
+    def import_untracked_files(self, scheduler=None) -> None:
         """Looks for untracked files located in self.path and its subfolders and adds then to the library
 
         Untracked music files that failed to be imported are ignored.
 
+        Args:
+            scheduler (None): ScanScheduler reading the files, None reads them one after the other
+
         Todo:
             - add log message
 
         """
-        tracked_paths = {track.path for track in self}
-        all_paths = {os.path.abspath(os.path.join(root, name)) for root, dirs, files in os.walk(self.path) for name in files}
+        with self._write_lock:
+            self._commit(Library._run_steps(self._steps(self, refresh=False, imports=True, scheduler=scheduler), scheduler))
+
+    def untracked_paths(self, tracks=None, scheduler=None) -> list:
+        """Walks self.path and its subfolders, except the excluded ones, to find the files which are not in the library
+
+        Args:
+            tracks (None): the tracked tracks, defaults to the library itself
+            scheduler (None): ScanScheduler listing the folders, None lists them with os.walk
+
+        Returns:
+            list: sorted absolute paths
 
-        for path in sorted(all_paths.difference(tracked_paths)):
+        """
+        tracked_paths = {track.path for track in (self if tracks is None else tracks)}
+        all_paths = set()
+        for root, dirs, files in (scheduler.walk(self.path) if scheduler is not None else os.walk(self.path)):
+            dirs[:] = [name for name in dirs if os.path.abspath(os.path.join(root, name)) not in self.excluded]
+            all_paths.update(os.path.abspath(os.path.join(root, name)) for name in files)
+        return sorted(all_paths.difference(tracked_paths))
+
+    @staticmethod
+    def _cleaned(tracks) -> list:
+        return list(filter(lambda track: os.path.isfile(track.path), tracks))
+
+    def _steps(self, tracks, refresh: bool, imports: bool, scheduler=None):
+        """The steps of the refresh and import methods, shared by their sync and async versions
+
+        A generator yielding (step, function, paths): the driver, _run_steps or _arun_steps, calls function on every
+        path, in any order and possibly concurrently, and sends back {path: result} without the paths for which
+        function failed. For the "walk" step paths is None, function is called once and its result is sent back.
+        The generator returns the new list of tracks, the library itself is never modified. The walk goes through
+        the scheduler if there is one.
+
+        Steps:
+            "check": _file_state of the tracked files
+            "refresh": Track.from_path of the modified files, the tracks which fail to be read are deleted
+            "walk": untracked_paths
+            "import": Track.from_path of the untracked files, the files which fail to be read are ignored
+
+        """
+        tracks = list(tracks)
+        if refresh:
+            tracked = {track.path: track for track in tracks}
+            states = yield "check", lambda path: _file_state(tracked[path]), list(tracked)
+            changed = [path for path in tracked if states.get(path) == "changed"]
+            read = yield "refresh", lambda path: Track.from_path(path, isinstance(tracked[path].tags, LazyTags)), changed
+            tracks = [track if states.get(track.path) == "unchanged" else read[track.path] for track in tracks
+                      if states.get(track.path) == "unchanged" or track.path in read]
+        if imports:
+            paths = yield "walk", lambda: self.untracked_paths(tracks, scheduler), None
+            read = yield "import", Track.from_path, paths
+            tracks.extend(read[path] for path in paths if path in read)
+        return tracks
+
+    @staticmethod
+    def _run_steps(steps, scheduler=None) -> list:
+        """Drives _steps in the calling thread, the files are checked and read through the scheduler if there is one"""
+        results = None
+        while True:
             try:
-                # TODO add log message
-                self.append(Track.from_path(path))
-            except Exception as e:
-                print(path, e)
-                # TODO add log message
-                pass
+                step, function, paths = steps.send(results)
+            except StopIteration as stop:
+                return stop.value
+            if paths is None:
+                results = function()
+            elif scheduler is not None:
+                results = scheduler.run(paths, function, read=step != "check")
+            else:
+                results = dict()
+                for path in paths:
+                    try:
+                        results[path] = function(path)
+                    except Exception as e:
+                        logging.getLogger(__name__).warning("Can't read %s: %s", path, e)
+
+    @staticmethod
+    async def _arun_steps(steps, max_concurrency: int, executor, tracks: list):
+        """Drives _steps in an executor, with at most max_concurrency calls at the same time
+
+        Yields:
+            (step, path, result, done, total) as the calls complete, result is None if the call failed. The new
+            tracks are put in tracks once the steps are over.
+
+        """
+        loop = asyncio.get_running_loop()
+        results = None
+        while True:
+            try:
+                step, function, paths = steps.send(results)
+            except StopIteration as stop:
+                tracks[:] = stop.value
+                return
+            if paths is None:
+                results = await loop.run_in_executor(executor, function)
+                continue
+            results = dict()
+            done = 0
+            async for path, result in _run_limited(paths, function, max_concurrency, executor):
+                done += 1
+                if result is not None:
+                    results[path] = result
+                yield step, path, result, done, len(paths)
+
+    @staticmethod
+    async def afrom_path(path: str, max_concurrency: int=8, executor=None):
+        """Async counterpart of Library.from_path
+
+        Args:
+            path: path to the root of the folder to import
+            max_concurrency (8): maximum number of files read at the same time
+            executor (None): executor running the blocking calls, None for the default executor of the loop
+
+        """
+        lib = Library(path)
+        async for _ in lib.aimport(max_concurrency, executor):
+            pass
+        return lib
+
+    async def aimport(self, max_concurrency: int=8, executor=None):
+        """Async counterpart of import_untracked_files, yields the tracks as they are read
+
+        The walk and the mutagen calls run in the executor. The tracks are only added to the library once every
+        untracked file was read, so cancelling the import, or leaving the loop early, leaves the library untouched.
+
+        Example:
+            async for track in library.aimport():
+                print(track)
+
+        Args:
+            max_concurrency (8): maximum number of files read at the same time
+            executor (None): executor running the blocking calls, None for the default executor of the loop
+
+        Yields:
+            Track: the imported tracks, in the order they are read
+
+        """
+        version = self.version
+        base = list(self)
+        tracks = []
+        async for step, _, track, _, _ in Library._arun_steps(self._steps(base, refresh=False, imports=True), max_concurrency, executor, tracks):
+            if step == "import" and track is not None:
+                yield track
+
+        # the library is only modified here, after the last await
+        with self._write_lock:
+            self._commit(tracks if self.version == version else self._rebase(base, tracks))
+
+    async def arefresh(self, max_concurrency: int=8, executor=None, progress=None) -> None:
+        """Async counterpart of refresh
+
+        Every file is checked and read in the executor. The new content of the library is built aside and replaces
+        the old one at once at the end: cancelling the refresh leaves the library as it was, and the modified
+        tracks are replaced by new Track objects instead of being modified. If the library is modified by someone
+        else in the meantime, the changes of the refresh are applied on top of the new content, see _rebase.
+
+        Args:
+            max_concurrency (8): maximum number of files checked or read at the same time
+            executor (None): executor running the blocking calls, None for the default executor of the loop
+            progress (None): function called with (step, done, total) after each file, step is "check", "refresh" or "import"
 
-    def refresh(self) -> None:
+        """
+        version = self.version
+        base = list(self)
+        tracks = []
+        async for step, _, _, done, total in Library._arun_steps(self._steps(base, refresh=True, imports=True), max_concurrency, executor, tracks):
+            if progress is not None:
+                progress(step, done, total)
+
+        # the library is only modified here, after the last await
+        with self._write_lock:
+            self._commit(tracks if self.version == version else self._rebase(base, tracks))
+
+    def refresh(self, scheduler=None) -> None:
         """Refreshes the library
 
         Refresh the library =
@@ -442,33 +1186,118 @@ class Library(list):
             + refresh_tracked_files
             + import_untracked_files
 
+        Args:
+            scheduler (None): ScanScheduler reading the files, None reads them one after the other
+
         Todo:
             - add log message
 
         """
         # TODO add log message
-        self.clean_deleted_files()
-        self.refresh_tracked_files()
-        self.import_untracked_files()
+        # the three steps are applied to a copy which is published once
+        with self._write_lock:
+            self._commit(Library._run_steps(self._steps(self, refresh=True, imports=True, scheduler=scheduler), scheduler))
 
     @staticmethod
-    def from_root_tree(root: ET.Element):
+    def from_root_tree(root: ET.Element, lazy: bool=None):
+        """
+        Args:
+            root: the library element
+            lazy (None): reads the tags as LazyTags, defaults to Track.lazy_tags
+
+        """
         path = root.attrib["path"]
         library = Library(path)
-        for track in root:
-            library.append(Track.from_root_tree(track))
+        library._commit([Track.from_root_tree(track, lazy) for track in root])
         return library
 
     @staticmethod
-    def from_xml(xml_text: str):
-        return Library.from_root_tree(ET.fromstring(xml_text))
+    def from_xml(xml_text: str, lazy: bool=None):
+        return Library.from_root_tree(ET.fromstring(xml_text), lazy)
+
+    CACHE_MAGIC = b"LXC1"
+
+    def write_cache(self, path: str) -> None:
+        """Writes the current snapshot to a file which Library.from_cache loads with a single read
+
+        The tracks are stored as Track.to_record tuples serialized by marshal, so loading doesn't parse xml or
+        create any element per tag.
+
+        Args:
+            path: path to the cache file, replaced atomically
+
+        """
+        snapshot = self.snapshot()
+        data = Library.CACHE_MAGIC + marshal.dumps((snapshot.path, tuple(track.to_record() for track in snapshot)))
+        atomic_write(path, data)
+
+    @staticmethod
+    def from_cache(path: str, lazy: bool=None):
+        """Loads a library written by write_cache
+
+        Args:
+            path: path to the cache file
+            lazy (None): reads the tags as LazyTags, defaults to Track.lazy_tags
+
+        Returns:
+            Library, None if the file doesn't exist or wasn't written by this version of write_cache
+
+        """
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+        if not data.startswith(Library.CACHE_MAGIC):
+            return None
+        try:
+            root, records = marshal.loads(memoryview(data)[len(Library.CACHE_MAGIC):])
+        except (EOFError, ValueError, TypeError):
+            return None
+        library = Library(root)
+        library._commit([Track.from_record(record, lazy) for record in records])
+        return library
+
+    @staticmethod
+    def from_xml_file(path: str, cache_path: str=None, lazy: bool=None):
+        """Loads a library saved with to_xml, through a cache for fast starts
+
+        The cache is used when it is newer than the xml file, otherwise the xml file is parsed and the cache written.
+
+        Example:
+            library = Library.from_xml_file("library.xml", "library.cache")
+
+        Args:
+            path: path to the xml file
+            cache_path (None): path to the cache file, None to always parse the xml file
+            lazy (None): reads the tags as LazyTags, defaults to Track.lazy_tags
+
+        Returns:
+            Library
+
+        """
+        if cache_path is not None:
+            try:
+                fresh = os.path.getmtime(cache_path) >= os.path.getmtime(path)
+            except OSError:
+                fresh = False
+            library = Library.from_cache(cache_path, lazy) if fresh else None
+            if library is not None:
+                return library
+
+        with open(path, "r", encoding="utf-8") as file:
+            library = Library.from_xml(file.read(), lazy)
+        if cache_path is not None:
+            library.write_cache(cache_path)
+        return library
 
     def to_root_tree(self) -> ET.Element:
         root = ET.Element("library")
         root.attrib["path"] = xml.sax.saxutils.escape(self.path)
         root.attrib["export_time"] = xml.sax.saxutils.escape(str(time.time()))
 
-        for track in self:
+        # the snapshot is serialized, so that a refresh running meanwhile can't give a half refreshed export
+        for track in self.snapshot():
             root.append(track.to_root_tree())
 
         return root
@@ -504,3 +1333,53 @@ class Library(list):
 
         """
         return ET.tostring(self.to_root_tree(), encoding="utf-8").decode("utf-8")
+
+
+
+def _file_state(track: Track) -> str:
+    if not os.path.isfile(track.path):
+        return "deleted"
+    try:
+        return "changed" if track.has_file_changed() else "unchanged"
+    except OSError:
+        return "deleted"
+
+
+async def _run_limited(items, function, max_concurrency: int, executor=None):
+    """Runs function on every item in the executor, with at most max_concurrency calls at the same time
+
+    Yields:
+        (item, result) in the order the calls complete, result is None if the call failed
+
+    """
+    loop = asyncio.get_running_loop()
+    items = iter(items)
+    results = asyncio.Queue()
+
+    async def work():
+        for item in items:
+            try:
+                result = await loop.run_in_executor(executor, function, item)
+            except Exception as e:
+                logging.getLogger(__name__).warning("Can't read %s: %s", item, e)
+                result = None
+            await results.put((item, result))
+
+    workers = [asyncio.ensure_future(work()) for _ in range(max_concurrency)]
+    running = asyncio.ensure_future(asyncio.gather(*workers))
+    try:
+        while not running.done() or not results.empty():
+            getter = asyncio.ensure_future(results.get())
+            await asyncio.wait({getter, running}, return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                yield getter.result()
+            else:
+                getter.cancel()
+        # raises the errors of the workers, if any
+        running.result()
+    finally:
+        for worker in workers:
+            worker.cancel()
+        running.cancel()
+        # the cancellation of the workers is expected, it must not be reported as an unretrieved error
+        running.add_done_callback(lambda future: future.cancelled() or future.exception())
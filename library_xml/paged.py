@@ -0,0 +1,399 @@
+import collections
+import logging
+import marshal
+import os
+import os.path
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+from library_xml.import_library import Info, Tags, Track, _file_state
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    last_modification REAL NOT NULL,
+    record BLOB NOT NULL
+)
+"""
+_TRACK_SIZE = 200  # the Track, Info and Tags objects themselves
+
+
+def footprint(track: Track) -> int:
+    """
+    Returns:
+        int: estimation of the bytes a track keeps resident, the cold tags of LazyTags are counted encoded
+
+    """
+    size = _TRACK_SIZE + sys.getsizeof(track.path) + sys.getsizeof(track.info) + sys.getsizeof(track.tags)
+    size += sum(sys.getsizeof(value) for value in track.info.values())
+    for values in dict.values(track.tags):
+        size += sys.getsizeof(values) + sum(sys.getsizeof(value) for value in values)
+    record = getattr(track.tags, "_record", None)
+    if record is not None:
+        size += sys.getsizeof(record)
+    return size
+
+
+def rss() -> int:
+    """
+    Returns:
+        int: resident set size of the process in bytes, its peak where the current one can't be read, 0 if neither
+        can
+
+    """
+    try:
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class PagedLibrary:
+    """Library kept in a sqlite database, only the recently used tracks are resident
+
+    The tracks are stored as Track.to_record tuples serialized by marshal. get materializes them through a LRU cache
+    bounded by cache_size bytes, estimated by footprint, iteration streams the tracks page by page without filling
+    the cache, and refresh checks the files page by page, so the memory used doesn't depend on the number of tracks.
+
+    Example:
+        library = PagedLibrary("/music", "library.sqlite", cache_size=32 << 20)
+        library.refresh()
+        for track in library:
+            ...
+
+    Attributes:
+        path (str): path to the root of the library
+        database (str): path to the sqlite database
+        cache_size (int): maximum bytes of the resident tracks
+        page_size (int): number of tracks read or written at once
+        lazy (bool): materialize the tags as LazyTags
+        hits (int): gets served by the cache
+        misses (int): gets read from the database
+
+    """
+
+    def __init__(self, path: str, database: str, cache_size: int=64 << 20, page_size: int=1000, lazy: bool=True):
+        self.path = os.path.abspath(path)
+        self.database = database
+        self.cache_size = cache_size
+        self.page_size = page_size
+        self.lazy = lazy
+        self.hits = 0
+        self.misses = 0
+        self.excluded = set()
+        self._cache = collections.OrderedDict()  # path -> (track, footprint), least recently used first
+        self._cached = 0
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(database, check_same_thread=False)
+        # sqlite has its own page cache, bounded here as well
+        self._connection.execute("PRAGMA cache_size = -2048")
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute(_SCHEMA)
+        self._connection.commit()
+
+    @staticmethod
+    def from_library(library, database: str, **kwargs):
+        """
+        Args:
+            library: Library, LibrarySnapshot, or anything with path and an iterable of Track
+            database: path to the sqlite database, its tracks are replaced
+            kwargs: arguments of PagedLibrary
+
+        Returns:
+            PagedLibrary
+
+        """
+        paged = PagedLibrary(library.path, database, **kwargs)
+        paged.clear()
+        page = []
+        for track in library:
+            page.append(track)
+            if len(page) >= paged.page_size:
+                paged.put(page)
+                page = []
+        paged.put(page)
+        return paged
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+            self._clear_cache()
+
+    @property
+    def cached(self) -> int:
+        """estimated bytes of the resident tracks"""
+        return self._cached
+
+    def clear(self) -> None:
+        """Removes all the tracks"""
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM tracks")
+            self._clear_cache()
+
+    def _clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self._cached = 0
+
+    def _materialize(self, record: bytes) -> Track:
+        return Track.from_record(marshal.loads(record), self.lazy)
+
+    def _remember(self, track: Track) -> None:
+        size = footprint(track)
+        if size > self.cache_size:
+            return
+        self._forget(track.path)
+        self._cache[track.path] = (track, size)
+        self._cached += size
+        while self._cached > self.cache_size:
+            _, (_, evicted) = self._cache.popitem(last=False)
+            self._cached -= evicted
+
+    def _forget(self, path: str) -> None:
+        entry = self._cache.pop(path, None)
+        if entry is not None:
+            self._cached -= entry[1]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+    def __contains__(self, path: str) -> bool:
+        with self._lock:
+            if path in self._cache:
+                return True
+            return self._connection.execute("SELECT 1 FROM tracks WHERE path = ?", (path,)).fetchone() is not None
+
+    def get(self, path: str):
+        """
+        Returns:
+            Track: the track of path, None if there is none
+
+        """
+        with self._lock:
+            entry = self._cache.get(path)
+            if entry is not None:
+                self._cache.move_to_end(path)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            row = self._connection.execute("SELECT record FROM tracks WHERE path = ?", (path,)).fetchone()
+            if row is None:
+                return None
+            track = self._materialize(row[0])
+            self._remember(track)
+            return track
+
+    def _rows(self, columns: str):
+        """Yields lists of at most page_size (id, *columns) rows, in id order
+
+        Every page is a new query starting after the last id of the previous one, so the tracks can be modified
+        between two pages.
+
+        """
+        last = -1
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    "SELECT id, {} FROM tracks WHERE id > ? ORDER BY id LIMIT ?".format(columns),
+                    (last, self.page_size)).fetchall()
+            if not rows:
+                return
+            yield rows
+            last = rows[-1][0]
+
+    def pages(self):
+        """Yields the tracks by lists of page_size, the cached tracks are reused but the others aren't cached"""
+        for rows in self._rows("path, record"):
+            with self._lock:
+                cached = [self._cache.get(path) for _, path, _ in rows]
+            yield [entry[0] if entry is not None else self._materialize(record)
+                   for entry, (_, _, record) in zip(cached, rows)]
+
+    def __iter__(self):
+        for page in self.pages():
+            yield from page
+
+    def paths(self):
+        """Yields the paths of the tracks without materializing them"""
+        for rows in self._rows("path"):
+            for _, path in rows:
+                yield path
+
+    def put(self, tracks) -> None:
+        """Adds tracks, or replaces the tracks with the same paths, in a single transaction"""
+        rows = [(track.path, float(track.last_modification), marshal.dumps(track.to_record())) for track in tracks]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO tracks (path, last_modification, record) VALUES (?, ?, ?) "
+                "ON CONFLICT(path) DO UPDATE SET last_modification = excluded.last_modification, record = excluded.record",
+                rows)
+            for path, _, _ in rows:
+                self._forget(path)
+
+    def delete(self, paths) -> None:
+        """Removes the tracks of paths, in a single transaction"""
+        paths = list(paths)
+        with self._lock, self._connection:
+            self._connection.executemany("DELETE FROM tracks WHERE path = ?", ((path,) for path in paths))
+            for path in paths:
+                self._forget(path)
+
+    def _known(self, paths: list) -> set:
+        known = set()
+        with self._lock:
+            for start in range(0, len(paths), 500):
+                chunk = paths[start:start + 500]
+                query = "SELECT path FROM tracks WHERE path IN ({})".format(", ".join("?" * len(chunk)))
+                known.update(path for path, in self._connection.execute(query, chunk))
+        return known
+
+    def _read(self, paths: list, scheduler=None) -> list:
+        if scheduler is not None:
+            read = scheduler.run(paths, lambda path: Track.from_path(path, self.lazy))
+            return [read[path] for path in paths if path in read]
+        tracks = []
+        for path in paths:
+            try:
+                tracks.append(Track.from_path(path, self.lazy))
+            except Exception as e:
+                logger.warning("Can't read %s: %s", path, e)
+        return tracks
+
+    def refresh_tracked_files(self, scheduler=None) -> dict:
+        """Reads again the modified files and removes the deleted ones, one page at a time
+
+        Only the paths and modification times are read from the database, the records of unchanged tracks are left
+        untouched. A file which fails to be read is removed, like Library.refresh_tracked_files does.
+
+        Returns:
+            dict: number of "changed" and "deleted" tracks
+
+        """
+        result = {"changed": 0, "deleted": 0}
+        for rows in self._rows("path, last_modification"):
+            states = [(path, _file_state(Track(path, last_modification, None, None))) for _, path, last_modification in rows]
+            changed = [path for path, state in states if state == "changed"]
+            read = self._read(changed, scheduler)
+            read_paths = {track.path for track in read}
+            deleted = [path for path, state in states if state == "deleted"] + [path for path in changed if path not in read_paths]
+            self.put(read)
+            self.delete(deleted)
+            result["changed"] += len(read)
+            result["deleted"] += len(deleted)
+        return result
+
+    def import_untracked_files(self, scheduler=None) -> int:
+        """Walks self.path, except the excluded folders, and adds the files which are not in the database
+
+        The files are looked up and read page_size at a time, the directories are listed through the scheduler when
+        one is given.
+
+        Returns:
+            int: number of added tracks
+
+        """
+        added = 0
+        pending = []
+
+        def flush() -> int:
+            known = self._known(pending)
+            tracks = self._read([path for path in pending if path not in known], scheduler)
+            self.put(tracks)
+            pending.clear()
+            return len(tracks)
+
+        for root, dirs, files in (scheduler.walk(self.path) if scheduler is not None else os.walk(self.path)):
+            dirs[:] = sorted(name for name in dirs if os.path.abspath(os.path.join(root, name)) not in self.excluded)
+            for name in sorted(files):
+                pending.append(os.path.abspath(os.path.join(root, name)))
+                if len(pending) >= self.page_size:
+                    added += flush()
+        return added + flush()
+
+    def refresh(self, scheduler=None) -> dict:
+        """Counterpart of Library.refresh
+
+        Returns:
+            dict: number of "changed", "deleted" and "added" tracks
+
+        """
+        result = self.refresh_tracked_files(scheduler)
+        result["added"] = self.import_untracked_files(scheduler)
+        return result
+
+
+def _synthetic_path(i: int) -> str:
+    album = i // 12
+    return os.path.join(os.sep, "music", "Artist {}".format(album // 8), "Album {}".format(album), "{:02} Title {}.flac".format(i % 12 + 1, i))
+
+
+def _synthetic_track(i: int) -> Track:
+    album = i // 12
+    tags = Tags({
+        "title": ["Title {}".format(i)], "artist": ["Artist {}".format(album // 8)], "album": ["Album {}".format(album)],
+        "albumartist": ["Artist {}".format(album // 8)], "tracknumber": [str(i % 12 + 1)], "date": [str(1960 + album % 60)],
+        "genre": ["Genre {}".format(album % 40)], "composer": ["Composer {}".format(album % 500)],
+        "musicbrainz_trackid": ["{:032x}".format(i)], "musicbrainz_albumid": ["{:032x}".format(album)],
+        "comment": ["Ripped from the original release, track {} of album {}".format(i % 12 + 1, album)],
+    })
+    info = Info({"codec": "FLAC", "bitrate": 1411200, "channels": 2, "sample_rate": 44100, "bits_per_sample": 16,
+                 "length": 180.0 + i % 240})
+    return Track(_synthetic_path(i), 1.0e9 + i, info, tags)
+
+
+def benchmark(database: str, tracks: int=2000000, cache_size: int=32 << 20, max_rss: int=256 << 20, gets: int=100000) -> dict:
+    """Measures the resident memory of a PagedLibrary of synthetic tracks
+
+    The database is filled first if it doesn't hold tracks tracks, then all the tracks are iterated and gets are made
+    on random paths, the RSS being sampled after every page.
+
+    Args:
+        database: path to the sqlite database
+        tracks (2000000): number of tracks
+        cache_size (32 MiB): cache_size of the library
+        max_rss (256 MiB): the RSS cap
+        gets (100000): number of random gets
+
+    Returns:
+        dict: "iterate" and "get" times in seconds, "rss" the peak sampled RSS in bytes, "within_cap"
+        whether it stayed under max_rss
+
+    """
+    library = PagedLibrary(os.sep + "music", database, cache_size=cache_size)
+    peak = rss()
+    if len(library) != tracks:
+        library.clear()
+        for start in range(0, tracks, library.page_size):
+            library.put(_synthetic_track(i) for i in range(start, min(start + library.page_size, tracks)))
+            peak = max(peak, rss())
+
+    start = time.perf_counter()
+    count = 0
+    for page in library.pages():
+        count += sum(1 for track in page if track.tags.get("title"))
+        peak = max(peak, rss())
+    iterate = time.perf_counter() - start
+
+    start = time.perf_counter()
+    generator = random.Random(0)
+    for n in range(gets):
+        library.get(_synthetic_path(generator.randrange(tracks)))
+        if n % library.page_size == 0:
+            peak = max(peak, rss())
+    get = time.perf_counter() - start
+    library.close()
+
+    return {"tracks": count, "iterate": iterate, "get": get, "rss": peak, "within_cap": peak <= max_rss}
@@ -0,0 +1,301 @@
+import heapq
+import logging
+import os
+import os.path
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket limiting a quantity per second
+
+    Attributes:
+        rate (float): quantity allowed per second, None for no limit
+        burst (float): quantity which can be consumed at once after an idle period
+
+    """
+
+    def __init__(self, rate: float=None, burst: float=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.burst or 0.0
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float=1.0) -> None:
+        """Waits until amount can be consumed
+
+        Amounts larger than the burst are allowed, the bucket then goes in debt and the next calls wait longer.
+
+        Args:
+            amount (1.0): quantity to consume
+
+        """
+        if not self.rate:
+            return
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            self._sleep(wait)
+
+
+def mount_point(path: str) -> str:
+    """
+    Args:
+        path: an absolute path
+
+    Returns:
+        str: the mount point the path is on
+
+    """
+    path = os.path.abspath(path)
+    while not os.path.ismount(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+class _Mount:
+    """directories of a mount point waiting to be scanned, in a priority queue guarded by lock"""
+
+    def __init__(self):
+        self.queue = []  # (priority, order, directory)
+        self.files = dict()  # directory -> [path]
+        self.priorities = dict()  # directory -> priority in the queue
+        self.modifications = dict()  # directory -> last modification, once stat'ed
+        self.order = 0
+        self.lock = threading.Lock()
+
+
+class ScanScheduler:
+    """Schedules the file reads of library imports and refreshes so that they don't starve playback
+
+    Files are read by a few workers per mount point, so a slow mount can't stall the others: everything which
+    touches the file system runs in the threads of its mount and outside of the locks. Within a mount, the
+    directories the user is browsing go first (see prioritize), then the most recently modified directories. Reads
+    are throttled in files and bytes per second, directory listings (see walk) and metadata checks in operations per
+    second, and they all stop while the scheduler is paused or while is_busy returns True, for example while
+    PlayAudio streams from the same share. A scheduler can be shared by several runs at the same time.
+
+    Example:
+        scheduler = ScanScheduler(bytes_per_second=20e6, files_per_second=50, is_busy=player.is_playing)
+        library.refresh(scheduler=scheduler)
+
+    Attributes:
+        files (RateLimiter): limit on the number of files read per second
+        bytes (RateLimiter): limit on the number of bytes read per second, the size of a file counts when it's read
+        operations (RateLimiter): limit on the number of directory listings and metadata checks per second
+        is_busy: function returning True while the scan should wait, None to never wait
+        busy_poll (float): interval in seconds at which is_busy is checked while it returns True
+        workers_per_mount (int): number of files read at the same time on a mount point
+
+    """
+
+    BROWSED = 0
+    DEFAULT = 1
+
+    def __init__(self, bytes_per_second: float=None, files_per_second: float=None, is_busy=None, busy_poll: float=0.5, workers_per_mount: int=2,
+                 operations_per_second: float=None, clock=time.monotonic, sleep=time.sleep, mount_of=mount_point, stat=os.stat, scandir=os.scandir):
+        self.files = RateLimiter(files_per_second, clock=clock, sleep=sleep)
+        self.bytes = RateLimiter(bytes_per_second, burst=max(bytes_per_second or 0, 1 << 20), clock=clock, sleep=sleep)
+        self.operations = RateLimiter(operations_per_second, clock=clock, sleep=sleep)
+        self.is_busy = is_busy
+        self.busy_poll = busy_poll
+        self.workers_per_mount = workers_per_mount
+        self._sleep = sleep
+        self._mount_of = mount_of
+        self._stat = stat
+        self._scandir = scandir
+        self._browsed = frozenset()  # replaced, not modified, so that it's read without the lock
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self._lock = threading.Lock()
+        self._runs = []  # {mount point: _Mount} of every run in progress
+
+    def pause(self) -> None:
+        """Stops the reads until resume is called, the reads already started finish"""
+        self._resumed.clear()
+
+    def resume(self) -> None:
+        self._resumed.set()
+
+    def prioritize(self, directory: str) -> None:
+        """Marks a directory as browsed by the user, its files are read before the others
+
+        Args:
+            directory: path to the directory, its subdirectories are prioritized too
+
+        """
+        directory = os.path.abspath(directory)
+        with self._lock:
+            self._browsed = self._browsed | {directory}
+            runs = list(self._runs)
+        # directories already queued are queued again with their new priority, the ones of a mount not stat'ed yet
+        # get it when they are queued
+        for mounts in runs:
+            for mount in mounts.values():
+                with mount.lock:
+                    for queued in list(mount.priorities):
+                        if queued in mount.files and self._priority(queued) < mount.priorities[queued]:
+                            self._push(mount, queued)
+
+    def run(self, paths, function, read: bool=True) -> dict:
+        """Calls function on every path, in the order and at the pace of the scheduler
+
+        Args:
+            paths: iterable of absolute paths to files
+            function: function taking a path, Track.from_path for example
+            read (True): function reads the files, False if it only checks their metadata, the calls are then
+                limited by operations instead of files and bytes
+
+        Returns:
+            dict: {path: result}, the paths for which function failed are left out
+
+        """
+        mounts = dict()  # mount point -> _Mount, of this run only
+        mount_points = dict()  # directory -> mount point
+        for path in paths:
+            directory = os.path.dirname(path)
+            if directory not in mount_points:
+                mount_points[directory] = self._mount_of(directory)
+            mount = mounts.setdefault(mount_points[directory], _Mount())
+            mount.files.setdefault(directory, []).append(path)
+        for mount in mounts.values():
+            for files in mount.files.values():
+                # popped from the end
+                files.sort(reverse=True)
+        with self._lock:
+            self._runs.append(mounts)
+
+        results = dict()
+        threads = [threading.Thread(target=self._scan, args=(mount, function, results, read), name="ScanScheduler")
+                   for mount in mounts.values()]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            with self._lock:
+                self._runs.remove(mounts)
+        return results
+
+    def walk(self, top: str):
+        """os.walk counterpart listing the directories at the pace of the scheduler
+
+        Every listing waits like a read and counts as an operation. The browsed directories are listed first, and
+        like with os.walk, the caller can remove names from the subdirectories to skip them. Symbolic links to
+        directories are listed but not followed, the directories which can't be listed are skipped.
+
+        Args:
+            top: path to the directory to walk
+
+        Yields:
+            (directory, subdirectory names, file names)
+
+        """
+        pending = [os.path.abspath(top)]
+        while pending:
+            directory = pending.pop()
+            self._wait()
+            self.operations.acquire()
+            dirs, files, links = [], [], set()
+            try:
+                with self._scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+                        if is_dir:
+                            dirs.append(entry.name)
+                            if entry.is_symlink():
+                                links.add(entry.name)
+                        else:
+                            files.append(entry.name)
+            except OSError:
+                continue
+            yield directory, dirs, files
+            pending.extend(os.path.join(directory, name) for name in reversed(dirs) if name not in links)
+            # popped from the end
+            pending.sort(key=self._priority, reverse=True)
+
+    def _priority(self, directory: str) -> int:
+        for browsed in self._browsed:
+            if directory == browsed or directory.startswith(browsed + os.sep):
+                return ScanScheduler.BROWSED
+        return ScanScheduler.DEFAULT
+
+    def _push(self, mount: _Mount, directory: str) -> None:
+        # with the lock of the mount
+        priority = self._priority(directory)
+        mount.priorities[directory] = priority
+        mount.order += 1
+        heapq.heappush(mount.queue, ((priority, -mount.modifications[directory]), mount.order, directory))
+
+    def _scan(self, mount: _Mount, function, results: dict, read: bool) -> None:
+        # the directories are stat'ed in the thread of their mount, then read by workers_per_mount workers
+        modifications = dict()
+        for directory in mount.files:
+            try:
+                modifications[directory] = self._stat(directory).st_mtime
+            except OSError:
+                modifications[directory] = 0.0
+        with mount.lock:
+            mount.modifications = modifications
+            for directory in modifications:
+                self._push(mount, directory)
+        workers = [threading.Thread(target=self._work, args=(mount, function, results, read), name="ScanScheduler")
+                   for _ in range(self.workers_per_mount - 1)]
+        for worker in workers:
+            worker.start()
+        self._work(mount, function, results, read)
+        for worker in workers:
+            worker.join()
+
+    def _next(self, mount: _Mount):
+        with mount.lock:
+            while mount.queue:
+                (priority, _), _, directory = mount.queue[0]
+                files = mount.files.get(directory)
+                if not files or priority != mount.priorities.get(directory):
+                    # finished, or queued again with another priority
+                    heapq.heappop(mount.queue)
+                    continue
+                path = files.pop()
+                if not files:
+                    del mount.files[directory]
+                return path
+            return None
+
+    def _wait(self) -> None:
+        self._resumed.wait()
+        while self.is_busy is not None and self.is_busy():
+            self._sleep(self.busy_poll)
+            self._resumed.wait()
+
+    def _work(self, mount: _Mount, function, results: dict, read: bool) -> None:
+        while True:
+            path = self._next(mount)
+            if path is None:
+                return
+            self._wait()
+            try:
+                if read:
+                    self.files.acquire()
+                    self.bytes.acquire(self._stat(path).st_size)
+                else:
+                    self.operations.acquire()
+                results[path] = function(path)
+            except Exception as e:
+                logger.warning("Can't read %s: %s", path, e)
@@ -0,0 +1,397 @@
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import os
+import os.path
+import threading
+import time
+
+from library_xml.files import atomic_write
+from library_xml.import_library import Library
+
+
+class Shard:
+    """A Library persisted in its own xml file, with its own refresh interval
+
+    The tracks of the shard are indexed by the values of the tags searched with find. The index of a tag is built by
+    the first search of the tag, then updated from the change sets of the library.
+
+    Attributes:
+        library (Library): the tracks of the shard
+        file (str): path to the xml file of the shard
+        refresh_interval (float): minimum number of seconds between two refreshes, None to only refresh when forced
+        last_refresh (float): timestamp of the last refresh, 0 if the shard was never refreshed
+
+    """
+
+    def __init__(self, library: Library, file: str, refresh_interval: float=None, last_refresh: float=0.0):
+        self.library = library
+        self.file = file
+        self.refresh_interval = refresh_interval
+        self.last_refresh = last_refresh
+        self._saved = None  # snapshot matching the content of file
+        self._loaded_mtime = None
+        self._index_version = None
+        self._index = None
+        self._tags = dict()  # tag -> {value: {path: Track}}, for the searched tags
+        self._tags_lock = threading.RLock()
+        library.subscribe(self._apply)
+
+    def close(self) -> None:
+        """Stops following the library"""
+        self.library.unsubscribe(self._apply)
+
+    def __repr__(self) -> str:
+        return 'Shard("{}")'.format(self.library.path)
+
+    @property
+    def root(self) -> str:
+        return self.library.path
+
+    @property
+    def dirty(self) -> bool:
+        """
+        Returns:
+            bool: the library changed since the file was written or read
+
+        """
+        return self.library.snapshot() is not self._saved
+
+    def is_due(self, now: float=None) -> bool:
+        """
+        Returns:
+            bool: the refresh interval elapsed since the last refresh
+
+        """
+        if self.refresh_interval is None:
+            return False
+        return (now if now is not None else time.time()) - self.last_refresh >= self.refresh_interval
+
+    def refresh(self, scheduler=None) -> bool:
+        """Refreshes the library of the shard
+
+        Returns:
+            bool: the library changed
+
+        """
+        with self.library._write_lock:
+            before = self.library.snapshot()
+            self.library.refresh(scheduler)
+            after = self.library.snapshot()
+        self.last_refresh = time.time()
+        # refresh always publishes, unchanged tracks are the same objects
+        changed = len(before) != len(after) or any(a is not b for a, b in zip(before, after))
+        if not changed and before is self._saved:
+            self._saved = after
+        return changed
+
+    def load(self) -> bool:
+        """Reads the xml file of the shard if it changed since it was last read
+
+        Returns:
+            bool: the file was read
+
+        """
+        try:
+            mtime = os.path.getmtime(self.file)
+        except OSError:
+            return False
+        if mtime == self._loaded_mtime:
+            return False
+        with open(self.file, "r", encoding="utf-8") as file:
+            loaded = Library.from_xml(file.read())
+        with self.library._write_lock:
+            self.library._commit(list(loaded))
+            self._saved = self.library.snapshot()
+        self._loaded_mtime = mtime
+        return True
+
+    def save(self) -> bool:
+        """Writes the xml file of the shard if the library changed
+
+        Returns:
+            bool: the file was written
+
+        """
+        with self.library._write_lock:
+            if not self.dirty:
+                return False
+            saved = self.library.snapshot()
+            atomic_write(self.file, self.library.to_xml())
+            self._saved = saved
+        self._loaded_mtime = os.path.getmtime(self.file)
+        return True
+
+    def index(self) -> dict:
+        """
+        Returns:
+            dict: {path: Track} of the current snapshot, built once per version of the library
+
+        """
+        snapshot = self.library.snapshot()
+        if self._index_version != snapshot.version:
+            self._index = {track.path: track for track in snapshot}
+            self._index_version = snapshot.version
+        return self._index
+
+    def find(self, key: str, value: str) -> list:
+        """
+        Args:
+            key: the tag, "artist" for example
+            value: the value of the tag
+
+        Returns:
+            list of Track: the tracks of the current snapshot having the value for the tag
+
+        """
+        with self._tags_lock:
+            values = self._tags.get(key)
+            if values is None:
+                # a change set being delivered for this snapshot is applied again by _apply, which changes nothing
+                values = self._tags[key] = collections.defaultdict(dict)
+                for track in self.library.snapshot():
+                    Shard._add(values, key, track)
+            return list(values.get(value, dict()).values())
+
+    def _apply(self, changes) -> None:
+        with self._tags_lock:
+            for key, values in self._tags.items():
+                for track in changes.removed:
+                    Shard._remove(values, key, track)
+                for old, new in changes.changed:
+                    Shard._remove(values, key, old)
+                    Shard._add(values, key, new)
+                for track in changes.added:
+                    Shard._add(values, key, track)
+
+    @staticmethod
+    def _add(values: dict, key: str, track) -> None:
+        for value in track.tags.get(key, ()):
+            values[value][track.path] = track
+
+    @staticmethod
+    def _remove(values: dict, key: str, track) -> None:
+        for value in track.tags.get(key, ()):
+            tracks = values.get(value)
+            if tracks is not None and tracks.get(track.path) is track:
+                del tracks[track.path]
+                if not tracks:
+                    del values[value]
+
+
+class ShardedLibrary:
+    """Library made of several roots, each root is a Shard
+
+    Every shard is persisted in its own file in directory and refreshed at its own pace. Loading reads only the
+    shard files which changed, saving writes only the shards which changed, and refresh runs the due shards in
+    parallel. Reading goes through the snapshots of the shards, so it never waits for a refresh.
+
+    Example:
+        library = ShardedLibrary("state/library")
+        library.add_root("/mnt/nas/music", refresh_interval=24 * 3600)
+        library.add_root("/home/user/music", refresh_interval=600)
+        library.refresh()
+        library.save()
+
+    Attributes:
+        directory (str): directory holding the shard files and the list of shards (shards.json)
+        shards (list of Shard): the shards, one per root
+
+    """
+
+    INDEX_FILE = "shards.json"
+
+    def __init__(self, directory: str):
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.shards = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def from_directory(directory: str):
+        """Loads a sharded library saved in directory
+
+        Args:
+            directory: directory given to save
+
+        """
+        library = ShardedLibrary(directory)
+        library.load()
+        return library
+
+    def add_root(self, path: str, refresh_interval: float=None) -> Shard:
+        """Adds a root to the library, its files are imported by the next refresh
+
+        The root can be a subfolder of another root, its tracks are then moved from the shard of the other root.
+
+        Args:
+            path: path to the root, or to a subtree of another root
+            refresh_interval (None): minimum number of seconds between two refreshes of the root
+
+        Returns:
+            Shard: the shard of the root, the existing one if the root was already added
+
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            for shard in self.shards:
+                if shard.root == path:
+                    return shard
+            name = hashlib.sha1(path.encode("utf-8")).hexdigest()[:16] + ".xml"
+            shard = Shard(Library(path), os.path.join(self.directory, name), refresh_interval)
+            parent = self.shard_of(path)
+            self.shards.append(shard)
+            self._update_exclusions()
+            if parent is not None:
+                with parent.library._write_lock:
+                    moved = [track for track in parent.library if self.shard_of(track.path) is shard]
+                    parent.library._commit([track for track in parent.library if self.shard_of(track.path) is parent])
+                shard.library._commit(moved)
+            return shard
+
+    def remove_root(self, path: str) -> None:
+        """Removes a root and deletes the file of its shard
+
+        Args:
+            path: path to the root
+
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            for shard in [shard for shard in self.shards if shard.root == path]:
+                self.shards.remove(shard)
+                shard.close()
+                try:
+                    os.remove(shard.file)
+                except FileNotFoundError:
+                    pass
+            self._update_exclusions()
+        self._save_index()
+
+    def _update_exclusions(self) -> None:
+        # the roots nested in a root are left to their own shard
+        for shard in self.shards:
+            shard.library.excluded = {other.root for other in self.shards
+                                      if other is not shard and other.root.startswith(shard.root.rstrip(os.sep) + os.sep)}
+
+    def shard_of(self, path: str):
+        """
+        Args:
+            path: path to a file
+
+        Returns:
+            Shard: the shard with the deepest root containing the path, None if no root contains it
+
+        """
+        path = os.path.abspath(path)
+        found = None
+        for shard in self.shards:
+            if path == shard.root or path.startswith(shard.root.rstrip(os.sep) + os.sep):
+                if found is None or len(shard.root) > len(found.root):
+                    found = shard
+        return found
+
+    def refresh(self, force: bool=False, max_workers: int=None, scheduler=None) -> list:
+        """Refreshes the due shards in parallel
+
+        Args:
+            force (False): refreshes every shard, even the ones whose refresh interval didn't elapse
+            max_workers (None): number of shards refreshed at the same time, None for one thread per shard
+            scheduler (None): ScanScheduler shared by the shards to read the files
+
+        Returns:
+            list of Shard: the shards which changed
+
+        """
+        now = time.time()
+        due = [shard for shard in self.shards if force or shard.is_due(now)]
+        if not due:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(due)) as executor:
+            changed = list(executor.map(lambda shard: shard.refresh(scheduler), due))
+        return [shard for shard, shard_changed in zip(due, changed) if shard_changed]
+
+    def load(self) -> list:
+        """Reads the list of shards and the shard files which changed since they were last read
+
+        Returns:
+            list of Shard: the shards which were read
+
+        """
+        try:
+            with open(os.path.join(self.directory, ShardedLibrary.INDEX_FILE), "r", encoding="utf-8") as file:
+                entries = json.load(file)
+        except FileNotFoundError:
+            entries = []
+
+        for entry in entries:
+            shard = self.add_root(entry["root"], entry.get("refresh_interval"))
+            shard.refresh_interval = entry.get("refresh_interval")
+            shard.last_refresh = max(shard.last_refresh, entry.get("last_refresh", 0.0))
+        return [shard for shard in self.shards if shard.load()]
+
+    def save(self) -> list:
+        """Writes the list of shards and the shards which changed
+
+        Returns:
+            list of Shard: the shards which were written
+
+        """
+        saved = [shard for shard in self.shards if shard.save()]
+        self._save_index()
+        return saved
+
+    def _save_index(self) -> None:
+        entries = [{
+            "root": shard.root,
+            "file": os.path.basename(shard.file),
+            "refresh_interval": shard.refresh_interval,
+            "last_refresh": shard.last_refresh,
+        } for shard in self.shards]
+        atomic_write(os.path.join(self.directory, ShardedLibrary.INDEX_FILE), json.dumps(entries, indent=1))
+
+    def snapshots(self) -> list:
+        """
+        Returns:
+            list of LibrarySnapshot: the current snapshot of every shard
+
+        """
+        return [shard.library.snapshot() for shard in self.shards]
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.snapshots())
+
+    def __len__(self) -> int:
+        return sum(len(snapshot) for snapshot in self.snapshots())
+
+    def __contains__(self, path: str) -> bool:
+        return self.get(path) is not None
+
+    def get(self, path: str):
+        """
+        Args:
+            path: path to a file
+
+        Returns:
+            Track: the track of the file, None if it isn't in the library
+
+        """
+        shard = self.shard_of(path)
+        if shard is None:
+            return None
+        return shard.index().get(os.path.abspath(path))
+
+    def find(self, key: str, value: str) -> list:
+        """Finds the tracks having a tag value, in the tag index of every shard, see Shard.find
+
+        Args:
+            key: the tag, "artist" for example
+            value: the value of the tag
+
+        Returns:
+            list of Track
+
+        """
+        return [track for shard in self.shards for track in shard.find(key, value)]
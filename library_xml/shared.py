@@ -0,0 +1,410 @@
+import array
+import collections.abc
+import mmap
+import os
+import os.path
+import struct
+
+from library_xml.files import atomic_write
+from library_xml.import_library import Info, Tags, Track
+
+MAGIC = b"LXSH"
+FORMAT = 1
+
+# magic, format, version, root path string id, then (offset, count) of every section
+_HEADER = struct.Struct("<4sIQQ")
+_SECTIONS = (
+    "string_offsets",  # Q, count + 1 offsets into string_data
+    "string_data",  # B, utf-8
+    "paths",  # I, string id of the path of every track, the tracks are sorted by path
+    "last_modifications",  # d
+    "info_offsets",  # I, count + 1 offsets into the info columns
+    "info_keys",  # I, string id
+    "info_kinds",  # B, one of the _KIND values
+    "info_values",  # q, or d for floats, or a string id
+    "tag_offsets",  # I, count + 1 offsets into the tag columns
+    "tag_keys",  # I, string id
+    "tag_value_offsets",  # I, count + 1 offsets into tag_values
+    "tag_values",  # I, string id
+)
+_SECTION = struct.Struct("<QQ")
+_TYPECODES = {
+    "string_offsets": "Q", "string_data": "B", "paths": "I", "last_modifications": "d", "info_offsets": "I",
+    "info_keys": "I", "info_kinds": "B", "info_values": "q", "tag_offsets": "I", "tag_keys": "I",
+    "tag_value_offsets": "I", "tag_values": "I",
+}
+_INT, _FLOAT, _STRING = 0, 1, 2
+
+
+def _version_path(path: str, version: int) -> str:
+    return "{}.{}".format(path, version)
+
+
+def _versions(path: str) -> list:
+    # versions of the tables written next to path, in increasing order
+    directory, name = os.path.split(os.path.abspath(path))
+    prefix = name + "."
+    return sorted(int(entry[len(prefix):]) for entry in os.listdir(directory)
+                  if entry.startswith(prefix) and entry[len(prefix):].isdigit())
+
+
+def _read_pointer(path: str):
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            return int(file.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_pointer(path: str, version: int) -> None:
+    atomic_write(path, str(version))
+
+
+def publish(library, path: str, keep: int=2) -> int:
+    """Lays out a snapshot of a library in a file which SharedLibrary maps in other processes
+
+    Every string is stored once, the tracks are stored in columns of numbers and string ids. The table is written
+    to path.<version>, then path itself, which only holds the version number, is replaced atomically, so readers
+    see either the old or the new version in full.
+
+    Example:
+        publish(library, "library.shared")
+        library.subscribe(lambda changes: publish(library, "library.shared"))
+
+    Args:
+        library: Library or LibrarySnapshot
+        path: path to the version file, the tables are written next to it
+        keep (2): number of versions kept, the older ones are removed when no process maps them
+
+    Returns:
+        int: the published version
+
+    """
+    snapshot = library.snapshot() if hasattr(library, "snapshot") else library
+    version = (_read_pointer(path) or 0) + 1
+
+    strings = dict()
+    columns = dict((name, array.array(typecode)) for name, typecode in _TYPECODES.items())
+
+    def intern(text: str) -> int:
+        identifier = strings.get(text)
+        if identifier is None:
+            identifier = strings[text] = len(strings)
+        return identifier
+
+    root = intern(snapshot.path)
+    columns["info_offsets"].append(0)
+    columns["tag_offsets"].append(0)
+    columns["tag_value_offsets"].append(0)
+    for track in sorted(snapshot, key=lambda track: track.path):
+        columns["paths"].append(intern(track.path))
+        columns["last_modifications"].append(float(track.last_modification))
+
+        for key, value in track.info.items():
+            columns["info_keys"].append(intern(key))
+            if isinstance(value, int) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63:
+                columns["info_kinds"].append(_INT)
+                columns["info_values"].append(value)
+            elif isinstance(value, float):
+                columns["info_kinds"].append(_FLOAT)
+                columns["info_values"].append(struct.unpack("<q", struct.pack("<d", value))[0])
+            else:
+                columns["info_kinds"].append(_STRING)
+                columns["info_values"].append(intern(str(value)))
+        columns["info_offsets"].append(len(columns["info_keys"]))
+
+        for key, values in track.tags.items():
+            columns["tag_keys"].append(intern(key))
+            columns["tag_values"].extend(intern(value) for value in values)
+            columns["tag_value_offsets"].append(len(columns["tag_values"]))
+        columns["tag_offsets"].append(len(columns["tag_keys"]))
+
+    columns["string_offsets"].append(0)
+    data = bytearray()
+    for text in strings:  # in id order
+        data += text.encode("utf-8")
+        columns["string_offsets"].append(len(data))
+    columns["string_data"] = array.array("B", data)
+
+    header_size = _HEADER.size + _SECTION.size * len(_SECTIONS)
+    offset = header_size
+    sections = []
+    for name in _SECTIONS:
+        offset += -offset % 8
+        sections.append((offset, len(columns[name])))
+        offset += len(columns[name]) * columns[name].itemsize
+
+    def write(file) -> None:
+        file.write(_HEADER.pack(MAGIC, FORMAT, version, root))
+        for section in sections:
+            file.write(_SECTION.pack(*section))
+        for name, (start, _) in zip(_SECTIONS, sections):
+            file.write(bytes(start - file.tell()))
+            columns[name].tofile(file)
+
+    atomic_write(_version_path(path, version), write)
+    _write_pointer(path, version)
+
+    # every older table is looked for, not only the last removed one, a table still mapped by a process on Windows
+    # can't be removed and is left for a later publish
+    for old in _versions(path):
+        if old > version - keep:
+            break
+        try:
+            os.remove(_version_path(path, old))
+        except (FileNotFoundError, PermissionError):
+            pass
+    return version
+
+
+class _Table:
+    """The mapped columns of a published version"""
+
+    def __init__(self, path: str, version: int):
+        with open(_version_path(path, version), "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._map)
+        magic, format_, self.version, root = _HEADER.unpack_from(buffer)
+        if magic != MAGIC or format_ != FORMAT or self.version != version:
+            raise ValueError("Not a shared library of version {}: {}".format(version, path))
+
+        for i, name in enumerate(_SECTIONS):
+            start, count = _SECTION.unpack_from(buffer, _HEADER.size + i * _SECTION.size)
+            size = count * struct.calcsize(_TYPECODES[name])
+            setattr(self, name, buffer[start:start + size].cast(_TYPECODES[name]))
+        start = _SECTION.unpack_from(buffer, _HEADER.size + _SECTIONS.index("info_values") * _SECTION.size)[0]
+        self.info_floats = buffer[start:start + len(self.info_values) * 8].cast("d")
+        self._keys = dict()  # decoded keys, few and read often
+        self.root = self.string(root)
+
+    def string(self, identifier: int) -> str:
+        return str(self.string_data[self.string_offsets[identifier]:self.string_offsets[identifier + 1]], "utf-8")
+
+    def key(self, identifier: int) -> str:
+        key = self._keys.get(identifier)
+        if key is None:
+            key = self._keys[identifier] = self.string(identifier)
+        return key
+
+
+class SharedInfo(collections.abc.Mapping):
+    """Read-only Info of a SharedTrack, the values are read from the mapped table"""
+
+    __slots__ = ("_table", "_start", "_stop")
+
+    def __init__(self, table: _Table, index: int):
+        self._table = table
+        self._start = table.info_offsets[index]
+        self._stop = table.info_offsets[index + 1]
+
+    def _value(self, i: int):
+        kind = self._table.info_kinds[i]
+        if kind == _INT:
+            return self._table.info_values[i]
+        if kind == _FLOAT:
+            return self._table.info_floats[i]
+        return self._table.string(self._table.info_values[i])
+
+    def __getitem__(self, key: str):
+        for i in range(self._start, self._stop):
+            if self._table.key(self._table.info_keys[i]) == key:
+                return self._value(i)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return (self._table.key(self._table.info_keys[i]) for i in range(self._start, self._stop))
+
+    def __len__(self) -> int:
+        return self._stop - self._start
+
+
+class SharedTags(collections.abc.Mapping):
+    """Read-only Tags of a SharedTrack, the values are tuples of strings read from the mapped table"""
+
+    __slots__ = ("_table", "_start", "_stop")
+
+    def __init__(self, table: _Table, index: int):
+        self._table = table
+        self._start = table.tag_offsets[index]
+        self._stop = table.tag_offsets[index + 1]
+
+    def _values(self, i: int) -> tuple:
+        table = self._table
+        return tuple(table.string(table.tag_values[j])
+                     for j in range(table.tag_value_offsets[i], table.tag_value_offsets[i + 1]))
+
+    def __getitem__(self, key: str) -> tuple:
+        for i in range(self._start, self._stop):
+            if self._table.key(self._table.tag_keys[i]) == key:
+                return self._values(i)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return (self._table.key(self._table.tag_keys[i]) for i in range(self._start, self._stop))
+
+    def __len__(self) -> int:
+        return self._stop - self._start
+
+
+class SharedTrack:
+    """Read-only Track backed by the mapped table of a SharedLibrary
+
+    Attributes:
+        path (str): path to the music file
+        last_modification (float): modification time of the file when it was read
+        info (SharedInfo): mapping like Info
+        tags (SharedTags): mapping like Tags, the values are tuples
+
+    """
+
+    __slots__ = ("_table", "_index")
+
+    def __init__(self, table: _Table, index: int):
+        self._table = table
+        self._index = index
+
+    @property
+    def path(self) -> str:
+        return self._table.string(self._table.paths[self._index])
+
+    @property
+    def last_modification(self) -> float:
+        return self._table.last_modifications[self._index]
+
+    @property
+    def info(self) -> SharedInfo:
+        return SharedInfo(self._table, self._index)
+
+    @property
+    def tags(self) -> SharedTags:
+        return SharedTags(self._table, self._index)
+
+    def to_track(self) -> Track:
+        """
+        Returns:
+            Track: a modifiable copy of the track
+
+        """
+        tags = Tags((key, list(values)) for key, values in self.tags.items())
+        return Track(self.path, self.last_modification, Info(self.info.items()), tags)
+
+    def __repr__(self) -> str:
+        return 'SharedTrack("{}")'.format(self.path)
+
+
+class SharedLibrary(collections.abc.Sequence):
+    """Read-only library mapped from the file written by publish, shared by the processes which attach it
+
+    The table is mapped read-only: the pages are shared with the other processes and with the page cache, and the
+    tracks are views which decode their strings when they are read. attach gives the last published version, and
+    refresh moves to a newer one, the tracks taken from the previous version stay valid.
+
+    Example:
+        library = SharedLibrary.attach("library.shared")
+        track = library.get("/music/a.flac")
+        library.refresh()
+
+    Attributes:
+        path (str): path to the version file given to publish
+        root (str): path to the root of the published library
+        version (int): the attached version
+
+    """
+
+    def __init__(self, path: str, table: _Table):
+        self.path = path
+        self._table = table
+
+    @staticmethod
+    def attach(path: str, retries: int=10):
+        """
+        Args:
+            path: path to the version file given to publish
+            retries (10): attempts when a newer version removes the one being attached
+
+        Returns:
+            SharedLibrary
+
+        Raises:
+            FileNotFoundError: nothing was published at path
+
+        """
+        return SharedLibrary(path, SharedLibrary._map(path, retries))
+
+    @staticmethod
+    def _map(path: str, retries: int) -> _Table:
+        for _ in range(retries):
+            version = _read_pointer(path)
+            if version is None:
+                raise FileNotFoundError("Nothing published at {}".format(path))
+            try:
+                return _Table(path, version)
+            except FileNotFoundError:
+                continue
+        raise FileNotFoundError("The version of {} changes too often to be attached".format(path))
+
+    @property
+    def root(self) -> str:
+        return self._table.root
+
+    @property
+    def version(self) -> int:
+        return self._table.version
+
+    def refresh(self, retries: int=10) -> bool:
+        """Attaches the last published version
+
+        Returns:
+            bool: whether a newer version was attached
+
+        """
+        if _read_pointer(self.path) == self._table.version:
+            return False
+        table = SharedLibrary._map(self.path, retries)
+        changed = table.version != self._table.version
+        self._table = table
+        return changed
+
+    def __len__(self) -> int:
+        return len(self._table.paths)
+
+    def __getitem__(self, index):
+        table = self._table
+        if isinstance(index, slice):
+            return [SharedTrack(table, i) for i in range(*index.indices(len(table.paths)))]
+        if index < 0:
+            index += len(table.paths)
+        if not 0 <= index < len(table.paths):
+            raise IndexError("track index out of range")
+        return SharedTrack(table, index)
+
+    def __iter__(self):
+        table = self._table
+        return (SharedTrack(table, i) for i in range(len(table.paths)))
+
+    def index_of(self, path: str) -> int:
+        """
+        Returns:
+            int: index of the track of path, -1 if there is none
+
+        """
+        table = self._table
+        low, high = 0, len(table.paths)
+        while low < high:
+            middle = (low + high) // 2
+            if table.string(table.paths[middle]) < path:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(table.paths) and table.string(table.paths[low]) == path:
+            return low
+        return -1
+
+    def get(self, path: str):
+        """
+        Returns:
+            SharedTrack: the track of path, None if there is none
+
+        """
+        index = self.index_of(path)
+        return SharedTrack(self._table, index) if index >= 0 else None
@@ -0,0 +1,97 @@
+import os
+import os.path
+import re
+import subprocess
+import sys
+
+# seconds, check fails when a measure is above its budget
+BUDGET = {
+    "import": 0.05,  # cumulative -X importtime of library_xml.import_library
+    "cached_first_query": 0.5,  # process start to the first page of a cached library of 10k tracks
+}
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # imported by the measured interpreters
+
+_RE_IMPORT_TIME = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)\s*$")
+
+_FIRST_QUERY = """
+import time
+start = time.perf_counter()
+from library_xml.import_library import Library
+from library_xml.collation import SortedView
+library = Library.from_xml_file({xml_path!r}, {cache_path!r}, {lazy!r})
+page = SortedView(library).page(0)
+print(time.perf_counter() - start)
+"""
+
+
+def _run(arguments: list) -> subprocess.CompletedProcess:
+    # the packages are found from any working directory
+    path = os.environ.get("PYTHONPATH")
+    env = dict(os.environ, PYTHONPATH=_ROOT + os.pathsep + path if path else _ROOT)
+    return subprocess.run([sys.executable] + arguments, capture_output=True, text=True, check=True, env=env)
+
+
+def import_times(module: str="library_xml.import_library") -> list:
+    """Imports a module in a new interpreter with -X importtime
+
+    Args:
+        module ("library_xml.import_library"): the module to import
+
+    Returns:
+        list: (module, self seconds, cumulative seconds, depth) of every imported module, in import order, module
+        last
+
+    """
+    process = _run(["-X", "importtime", "-c", "import " + module])
+    times = []
+    for line in process.stderr.splitlines():
+        match = _RE_IMPORT_TIME.match(line)
+        if match is not None:
+            own, cumulative, indent, name = match.groups()
+            times.append((name, int(own) / 1e6, int(cumulative) / 1e6, len(indent) // 2))
+    return times
+
+
+def time_to_first_query(xml_path: str, cache_path: str=None, lazy: bool=True) -> float:
+    """Measures in a new interpreter the time to load a library with Library.from_xml_file and sort its first page
+
+    Args:
+        xml_path: path to a library saved with to_xml
+        cache_path (None): path to the cache of the library, None to parse the xml file
+        lazy (True): loads the tags as LazyTags, the first page only reads hot tags
+
+    Returns:
+        float: seconds from the first import to the first page
+
+    """
+    return float(_run(["-c", _FIRST_QUERY.format(xml_path=xml_path, cache_path=cache_path, lazy=lazy)]).stdout)
+
+
+def check(xml_path: str, cache_path: str, budget: dict=None) -> dict:
+    """Measures the startup and compares it with a budget
+
+    The cache is written first if it is missing or older than the xml file, so the measure is a warm start.
+
+    Args:
+        xml_path: path to a library saved with to_xml, 10k tracks for the default budget
+        cache_path: path to its cache
+        budget (None): seconds by measure, defaults to BUDGET
+
+    Returns:
+        dict: "import" and "cached_first_query" seconds, "slowest_imports" the 10 modules with the largest self
+        time, "over_budget" the names of the measures above their budget
+
+    """
+    budget = budget if budget is not None else BUDGET
+    from library_xml.import_library import Library
+    Library.from_xml_file(xml_path, cache_path)
+
+    times = import_times()
+    result = {
+        "import": times[-1][2],
+        "cached_first_query": time_to_first_query(xml_path, cache_path),
+        "slowest_imports": sorted(times, key=lambda time: time[1], reverse=True)[:10],
+    }
+    result["over_budget"] = [name for name, seconds in budget.items() if result.get(name, 0.0) > seconds]
+    return result
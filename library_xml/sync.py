@@ -0,0 +1,419 @@
+import collections
+import dbm
+import hashlib
+import json
+import os
+import os.path
+import socket
+import socketserver
+import struct
+import threading
+
+from library_xml.import_library import ChangeSet, Info, Tags, Track
+
+
+def _relative(root: str, path: str):
+    relative = os.path.relpath(path, root)
+    if relative == os.curdir or relative.startswith(os.pardir + os.sep) or relative == os.pardir:
+        return None
+    return relative.replace(os.sep, "/")
+
+
+def _split(relative: str) -> tuple:
+    directory, _, name = relative.rpartition("/")
+    return directory, name
+
+
+def _join(directory: str, name: str) -> str:
+    return directory + "/" + name if directory else name
+
+
+def track_record(track, relative: str) -> dict:
+    """
+    Args:
+        track (Track): the track
+        relative: path of the track relative to the root of its library, with / separators
+
+    Returns:
+        dict: JSON serializable description of the track, independent of where the library is mounted. The info
+        values are strings and the empty tags are left out, as in the xml of the library, so a scanned track and the
+        same track loaded from xml have the same record and digest
+
+    """
+    return {
+        "path": relative,
+        "last_modification": float(track.last_modification),
+        "info": {key: str(value) for key, value in track.info.items()},
+        "tags": {key: list(values) for key, values in track.tags.items() if values},
+    }
+
+
+def record_digest(record: dict) -> str:
+    """
+    Returns:
+        str: hexadecimal sha1 of the canonical serialization of a track record
+
+    """
+    return hashlib.sha1(json.dumps(record, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+class MerkleTree:
+    """Hash tree of the tracks of a library, one node per directory
+
+    The hash of a directory covers the digests of its tracks (relative path, last modification, info and tags) and
+    the hashes of its subdirectories, so two libraries with the same hash for a directory have the same tracks under
+    it. The tree follows the change sets of the library and only hashes again the directories above modified tracks.
+
+    Attributes:
+        library (Library): the library
+        root (str): root of the library, paths are stored relative to it
+
+    """
+
+    def __init__(self, library):
+        self.library = library
+        self.root = library.path
+        self._files = collections.defaultdict(dict)  # directory -> {name: digest}
+        self._dirs = collections.defaultdict(set)  # directory -> names of the subdirectories
+        self._tracks = dict()  # relative path -> Track
+        self._hashes = dict()  # directory -> hash, missing when outdated
+        self._lock = threading.RLock()
+        with library._write_lock:
+            for track in library.snapshot():
+                self._add(track)
+            library.subscribe(self.apply)
+
+    def close(self) -> None:
+        """Stops following the library"""
+        self.library.unsubscribe(self.apply)
+
+    def apply(self, changes) -> None:
+        """Updates the tree with a ChangeSet of the library"""
+        with self._lock:
+            for track in changes.removed:
+                self._remove(track)
+            for old, new in changes.changed:
+                self._remove(old)
+                self._add(new)
+            for track in changes.added:
+                self._add(track)
+
+    def _add(self, track) -> None:
+        relative = _relative(self.root, track.path)
+        if relative is None:
+            return
+        directory, name = _split(relative)
+        self._files[directory][name] = record_digest(track_record(track, relative))
+        self._tracks[relative] = track
+        while directory:
+            parent, child = _split(directory)
+            self._dirs[parent].add(child)
+            self._hashes.pop(directory, None)
+            directory = parent
+        self._hashes.pop("", None)
+
+    def _remove(self, track) -> None:
+        relative = _relative(self.root, track.path)
+        if relative is None or relative not in self._tracks:
+            return
+        del self._tracks[relative]
+        directory, name = _split(relative)
+        del self._files[directory][name]
+        while True:
+            self._hashes.pop(directory, None)
+            if not directory:
+                break
+            parent, child = _split(directory)
+            if not self._files.get(directory) and not self._dirs.get(directory):
+                self._files.pop(directory, None)
+                self._dirs.pop(directory, None)
+                self._dirs[parent].discard(child)
+            directory = parent
+
+    def hash(self, directory: str="") -> str:
+        """
+        Args:
+            directory ("": the root): path relative to the root, with / separators
+
+        Returns:
+            str: hexadecimal hash of the directory
+
+        """
+        with self._lock:
+            value = self._hashes.get(directory)
+            if value is None:
+                digest = hashlib.sha1()
+                for name, file_digest in sorted(self._files.get(directory, dict()).items()):
+                    digest.update("f{}\0{}\n".format(name, file_digest).encode("utf-8"))
+                for name in sorted(self._dirs.get(directory, ())):
+                    digest.update("d{}\0{}\n".format(name, self.hash(_join(directory, name))).encode("utf-8"))
+                value = self._hashes[directory] = digest.hexdigest()
+            return value
+
+    def node(self, directory: str):
+        """
+        Args:
+            directory: path relative to the root, with / separators
+
+        Returns:
+            dict: "hash" of the directory, "dirs" {name: hash} and "files" {name: digest}, None if the directory
+            has no tracks
+
+        """
+        with self._lock:
+            if directory and directory not in self._files and directory not in self._dirs:
+                return None
+            return {
+                "hash": self.hash(directory),
+                "dirs": {name: self.hash(_join(directory, name)) for name in self._dirs.get(directory, ())},
+                "files": dict(self._files.get(directory, dict())),
+            }
+
+    def walk(self, directory: str) -> list:
+        """
+        Returns:
+            list: the relative paths of the tracks under a directory
+
+        """
+        with self._lock:
+            paths = [_join(directory, name) for name in self._files.get(directory, ())]
+            for name in self._dirs.get(directory, ()):
+                paths.extend(self.walk(_join(directory, name)))
+            return paths
+
+    def record(self, relative: str):
+        """
+        Returns:
+            dict: the track_record of a relative path, None if there is no track at this path
+
+        """
+        with self._lock:
+            track = self._tracks.get(relative)
+            return track_record(track, relative) if track is not None else None
+
+    def answer(self, method: str, params: dict):
+        """Answers a request of sync, the transports call it on the side of the source library
+
+        Args:
+            method: "root", "nodes" or "records"
+            params: the parameters of the request
+
+        Returns:
+            the JSON serializable answer
+
+        """
+        if method == "root":
+            return {"hash": self.hash("")}
+        if method == "nodes":
+            return {directory: self.node(directory) for directory in params["dirs"]}
+        if method == "records":
+            return {relative: self.record(relative) for relative in params["paths"]}
+        raise ValueError("Unknown method: {}".format(method))
+
+
+def sync(tree: MerkleTree, transport, batch_size: int=500) -> dict:
+    """Makes the library of tree a mirror of the library behind transport
+
+    The roots of the two trees are compared, then the nodes of the directories whose hashes differ, level by level,
+    so only the subtrees which changed are exchanged. The modified tracks are then fetched and applied to the
+    library in a single commit of their ChangeSet, the rest of the library isn't compared.
+
+    Args:
+        tree: the tree of the mirrored library
+        transport: LocalTransport, SocketTransport or FileTransport to the source library
+        batch_size (500): maximum number of records fetched by request
+
+    Returns:
+        dict: "requests" sent, "nodes" compared, "fetched" and "deleted" tracks
+
+    """
+    result = {"requests": 1, "nodes": 0, "fetched": 0, "deleted": 0}
+    if transport.request("root", dict())["hash"] == tree.hash(""):
+        return result
+
+    fetch = []
+    delete = []
+    pending = [""]
+    while pending:
+        nodes = transport.request("nodes", {"dirs": pending})
+        result["requests"] += 1
+        result["nodes"] += len(pending)
+        differing = []
+        for directory in pending:
+            remote = nodes.get(directory)
+            local = tree.node(directory) or {"dirs": dict(), "files": dict()}
+            if remote is None:
+                delete.extend(tree.walk(directory))
+                continue
+            for name, digest in remote["files"].items():
+                if local["files"].get(name) != digest:
+                    fetch.append(_join(directory, name))
+            delete.extend(_join(directory, name) for name in local["files"] if name not in remote["files"])
+            for name, value in remote["dirs"].items():
+                if local["dirs"].get(name) != value:
+                    differing.append(_join(directory, name))
+            for name in local["dirs"]:
+                if name not in remote["dirs"]:
+                    delete.extend(tree.walk(_join(directory, name)))
+        pending = differing
+
+    records = []
+    for start in range(0, len(fetch), batch_size):
+        answer = transport.request("records", {"paths": fetch[start:start + batch_size]})
+        result["requests"] += 1
+        records.extend(record for record in answer.values() if record is not None)
+
+    library = tree.library
+    with library._write_lock:
+        # the tree follows the library, its tracks are the current ones while the lock is held
+        changes = ChangeSet(removed=[tree._tracks[relative] for relative in delete if relative in tree._tracks])
+        for record in records:
+            path = os.path.join(tree.root, *record["path"].split("/"))
+            track = Track(path, record["last_modification"], Info(record["info"]), Tags(record["tags"]))
+            old = tree._tracks.get(record["path"])
+            if old is None:
+                changes.added.append(track)
+            else:
+                changes.changed.append((old, track))
+        library._commit_changes(changes)
+
+    result["fetched"] = len(records)
+    result["deleted"] = len(delete)
+    return result
+
+
+class LocalTransport:
+    """Transport to a tree of the same process, the requests go through JSON like on the other transports"""
+
+    def __init__(self, tree: MerkleTree):
+        self.tree = tree
+
+    def request(self, method: str, params: dict):
+        params = json.loads(json.dumps(params))
+        return json.loads(json.dumps(self.tree.answer(method, params)))
+
+
+def _send(connection: socket.socket, value) -> int:
+    data = json.dumps(value, separators=(",", ":")).encode("utf-8")
+    connection.sendall(struct.pack(">I", len(data)) + data)
+    return len(data) + 4
+
+
+def _receive_exactly(connection: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = connection.recv(min(size - len(data), 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def _receive(connection: socket.socket):
+    size, = struct.unpack(">I", _receive_exactly(connection, 4))
+    return json.loads(_receive_exactly(connection, size).decode("utf-8"))
+
+
+class SyncServer(socketserver.ThreadingTCPServer):
+    """Answers the requests of SocketTransport clients, messages are length-prefixed JSON
+
+    Example:
+        server = SyncServer(MerkleTree(library), ("0.0.0.0", 7600))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, tree: MerkleTree, address: tuple):
+        self.tree = tree
+        super().__init__(address, _SyncHandler)
+
+
+class _SyncHandler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        while True:
+            try:
+                request = _receive(self.request)
+            except (ConnectionError, struct.error):
+                return
+            try:
+                answer = {"result": self.server.tree.answer(request["method"], request["params"])}
+            except Exception as e:
+                answer = {"error": str(e)}
+            _send(self.request, answer)
+
+
+class SocketTransport:
+    """Transport to a SyncServer
+
+    Attributes:
+        sent (int): number of bytes sent
+        received (int): number of bytes received
+
+    """
+
+    def __init__(self, address: tuple, timeout: float=30.0):
+        self._connection = socket.create_connection(address, timeout)
+        self.sent = 0
+        self.received = 0
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def request(self, method: str, params: dict):
+        self.sent += _send(self._connection, {"method": method, "params": params})
+        answer = _receive(self._connection)
+        self.received += len(json.dumps(answer))
+        if "error" in answer:
+            raise RuntimeError(answer["error"])
+        return answer["result"]
+
+
+def export(tree: MerkleTree, path: str) -> None:
+    """Writes the nodes and records of a tree to a dbm file, for FileTransport
+
+    Args:
+        tree: the tree of the source library
+        path: path to the file, dbm may add an extension
+
+    """
+    with tree._lock, dbm.open(path, "n") as database:
+        database["root"] = json.dumps({"hash": tree.hash("")})
+        pending = [""]
+        while pending:
+            directory = pending.pop()
+            node = tree.node(directory)
+            database["node:" + directory] = json.dumps(node)
+            pending.extend(_join(directory, name) for name in node["dirs"])
+            for name in node["files"]:
+                relative = _join(directory, name)
+                database["record:" + relative] = json.dumps(tree.record(relative))
+
+
+class FileTransport:
+    """Transport to a file written by export, for nodes which don't share a network
+
+    Only the nodes and records requested by sync are read from the file.
+
+    """
+
+    def __init__(self, path: str):
+        self._database = dbm.open(path, "r")
+
+    def close(self) -> None:
+        self._database.close()
+
+    def _get(self, key: str):
+        value = self._database.get(key)
+        return json.loads(value) if value is not None else None
+
+    def request(self, method: str, params: dict):
+        if method == "root":
+            return self._get("root")
+        if method == "nodes":
+            return {directory: self._get("node:" + directory) for directory in params["dirs"]}
+        if method == "records":
+            return {relative: self._get("record:" + relative) for relative in params["paths"]}
+        raise ValueError("Unknown method: {}".format(method))
@@ -0,0 +1,126 @@
+import copy
+import os
+import os.path
+import pickle
+import unittest
+
+from library_xml.import_library import ChangeSet, Info, Library, Tags, Track
+
+ROOT = os.path.abspath(os.path.join(os.sep, "music"))
+
+
+def _track(name: str, title: str=None, last_modification: float=1.0) -> Track:
+    return Track(os.path.join(ROOT, name), last_modification, Info(codec="FLAC"), Tags(title=[title or name]))
+
+
+def _titles(library) -> dict:
+    return {os.path.relpath(track.path, ROOT): track.tags["title"][0] for track in library}
+
+
+class CopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.library = Library(ROOT)
+        self.library._commit([_track("a.flac"), _track("b.flac")])
+        self.library.excluded.add(os.path.join(ROOT, "other"))
+        self.library.subscribe(lambda changes: None)
+
+    def _check_copy(self, library: Library) -> None:
+        self.assertEqual(_titles(library), _titles(self.library))
+        self.assertEqual(library.version, self.library.version)
+        self.assertEqual(library.excluded, self.library.excluded)
+        self.assertEqual(tuple(library.snapshot()), tuple(library))
+        self.assertEqual(library.snapshot().version, library.version)
+        # the copy is independent of the original
+        self.assertEqual(library._listeners, [])
+        self.assertIsNot(library._write_lock, self.library._write_lock)
+        library._commit([_track("c.flac")])
+        self.assertEqual(_titles(self.library), {"a.flac": "a.flac", "b.flac": "b.flac"})
+
+    def test_pickle(self):
+        self._check_copy(pickle.loads(pickle.dumps(self.library)))
+
+    def test_deepcopy(self):
+        self._check_copy(copy.deepcopy(self.library))
+
+
+class RebaseTest(unittest.TestCase):
+    """The async methods read the files without the lock, then merge their changes with the ones of other writers"""
+
+    def setUp(self):
+        self.library = Library(ROOT)
+        self.library._commit([_track(name) for name in ("kept.flac", "theirs.flac", "ours.flac", "removed.flac",
+                                                          "both.flac", "removed_by_them.flac")])
+        self.base = list(self.library)
+        self.changes = []
+        self.library.subscribe(self.changes.append)
+
+    def _replace(self, tracks: list, name: str, title: str) -> list:
+        path = os.path.join(ROOT, name)
+        return [_track(name, title, 2.0) if track.path == path else track for track in tracks]
+
+    def test_concurrent_writers(self):
+        # what the async refresh computed from base
+        ours = self._replace(self.base, "ours.flac", "ours")
+        ours = self._replace(ours, "both.flac", "ours")
+        ours = self._replace(ours, "removed_by_them.flac", "ours")
+        ours = [track for track in ours if not track.path.endswith("removed.flac")] + [_track("added.flac"), _track("added_by_both.flac", "ours")]
+
+        # another writer committed meanwhile
+        theirs = self._replace(list(self.library), "theirs.flac", "theirs")
+        theirs = self._replace(theirs, "both.flac", "theirs")
+        theirs = [track for track in theirs if not track.path.endswith("removed_by_them.flac")]
+        theirs += [_track("added_by_them.flac"), _track("added_by_both.flac", "theirs")]
+        self.library._commit(theirs)
+        kept = [track for track in self.library if track.path.endswith("kept.flac")][0]
+
+        self.library._commit(self.library._rebase(self.base, ours))
+        self.assertEqual(_titles(self.library), {
+            "kept.flac": "kept.flac",
+            "theirs.flac": "theirs",
+            "ours.flac": "ours",
+            "both.flac": "theirs",
+            "added.flac": "added.flac",
+            "added_by_them.flac": "added_by_them.flac",
+            "added_by_both.flac": "theirs",
+        })
+        self.assertIs([track for track in self.library if track.path.endswith("kept.flac")][0], kept)
+        self.assertEqual(tuple(self.library.snapshot()), tuple(self.library))
+
+        changes = self.changes[-1]
+        self.assertEqual([track.path for track in changes.added], [os.path.join(ROOT, "added.flac")])
+        self.assertEqual([track.path for track in changes.removed], [os.path.join(ROOT, "removed.flac")])
+        self.assertEqual([new.tags["title"] for _, new in changes.changed], [["ours"]])
+
+    def test_without_concurrent_writer(self):
+        ours = self._replace(self.base, "ours.flac", "ours")
+        self.library._commit(self.library._rebase(self.base, ours))
+        self.assertEqual([track.path for track in self.library], [track.path for track in ours])
+        self.assertEqual(len(self.changes), 1)
+        self.assertEqual(len(self.changes[0]), 1)
+
+
+class CommitChangesTest(unittest.TestCase):
+
+    def test_incremental_commit(self):
+        library = Library(ROOT)
+        library._commit([_track("{:02}.flac".format(i)) for i in range(20)])
+        received = []
+        library.subscribe(received.append)
+        for removed in (range(0, 20, 2), range(1, 3)):
+            # a few changes are searched by identity, more by mapping the tracks
+            current = list(library)
+            changes = ChangeSet(added=[_track("new{}.flac".format(len(received)))],
+                                removed=[current[i] for i in removed],
+                                changed=[(current[-1], _track(os.path.basename(current[-1].path), "changed", 2.0))])
+            library._commit_changes(changes)
+            expected = [track for i, track in enumerate(current) if i not in removed][:-1] + [changes.changed[0][1]]
+            expected.append(changes.added[0])
+            self.assertEqual(sorted(library, key=lambda track: track.path), sorted(expected, key=lambda track: track.path))
+            self.assertEqual(tuple(library.snapshot()), tuple(library))
+            self.assertIs(received[-1], changes)
+            self.assertEqual((changes.old_version, changes.new_version), (library.version - 1, library.version))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,378 @@
+import os
+import os.path
+import threading
+import unittest
+
+from library_xml.import_library import Library
+from library_xml.scheduler import RateLimiter, ScanScheduler
+
+ROOT = os.path.abspath(os.path.join(os.sep, "nas", "music"))
+
+
+class FakeClock:
+    """Virtual time shared by the threads, sleeping advances it instead of waiting"""
+
+    def __init__(self):
+        self.now = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        with self._lock:
+            self.now += seconds
+
+
+class _Stat:
+
+    def __init__(self, size: int=0, mtime: float=0.0):
+        self.st_size = size
+        self.st_mtime = mtime
+
+
+class _Entry:
+
+    def __init__(self, name: str, is_dir: bool):
+        self.name = name
+        self._is_dir = is_dir
+
+    def is_dir(self) -> bool:
+        return self._is_dir
+
+    def is_symlink(self) -> bool:
+        return False
+
+
+class _Listing(list):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class SlowFileSystem:
+    """In-memory tree of a slow network share, every stat, listing and open costs latency seconds of virtual time
+
+    Attributes:
+        stats (int): number of stat calls
+        listings (int): number of scandir calls
+        read (list): paths opened by read, in order
+
+    """
+
+    def __init__(self, clock: FakeClock, latency: float=0.0):
+        self.clock = clock
+        self.latency = latency
+        self.directories = {ROOT: 0.0}  # path -> mtime
+        self.files = dict()  # path -> size
+        self.stats = 0
+        self.listings = 0
+        self.read = []
+        self._lock = threading.Lock()
+
+    def add_directory(self, path: str, mtime: float=0.0) -> str:
+        path = os.path.join(ROOT, path)
+        self.directories[path] = mtime
+        return path
+
+    def add_file(self, path: str, size: int=1000) -> str:
+        path = os.path.join(ROOT, path)
+        self.files[path] = size
+        return path
+
+    def stat(self, path: str) -> _Stat:
+        self.clock.sleep(self.latency)
+        with self._lock:
+            self.stats += 1
+        if path in self.directories:
+            return _Stat(mtime=self.directories[path])
+        if path in self.files:
+            return _Stat(size=self.files[path])
+        raise FileNotFoundError(path)
+
+    def scandir(self, directory: str) -> _Listing:
+        self.clock.sleep(self.latency)
+        with self._lock:
+            self.listings += 1
+        if directory not in self.directories:
+            raise FileNotFoundError(directory)
+        return _Listing([_Entry(os.path.basename(path), True) for path in self.directories if os.path.dirname(path) == directory] +
+                        [_Entry(os.path.basename(path), False) for path in self.files if os.path.dirname(path) == directory])
+
+    def open_file(self, path: str) -> str:
+        """stands for Track.from_path"""
+        self.clock.sleep(self.latency)
+        with self._lock:
+            self.read.append(path)
+        return path
+
+
+def _scheduler(fs: SlowFileSystem, **kwargs) -> ScanScheduler:
+    kwargs.setdefault("workers_per_mount", 1)
+    return ScanScheduler(clock=fs.clock, sleep=fs.clock.sleep, mount_of=lambda directory: ROOT, stat=fs.stat, scandir=fs.scandir, **kwargs)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        clock = FakeClock()
+        limiter = RateLimiter(10, clock=clock, sleep=clock.sleep)
+        for _ in range(10):
+            limiter.acquire()
+        self.assertEqual(clock.now, 0.0)
+        for _ in range(10):
+            limiter.acquire()
+        self.assertAlmostEqual(clock.now, 1.0)
+
+    def test_no_limit(self):
+        clock = FakeClock()
+        limiter = RateLimiter(None, clock=clock, sleep=clock.sleep)
+        for _ in range(1000):
+            limiter.acquire(1e9)
+        self.assertEqual(clock.now, 0.0)
+
+
+class ThrottlingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fs = SlowFileSystem(FakeClock())
+        self.fs.add_directory("album")
+
+    def test_files_per_second(self):
+        paths = [self.fs.add_file(os.path.join("album", "{:02}.flac".format(i))) for i in range(30)]
+        results = _scheduler(self.fs, files_per_second=10).run(paths, self.fs.open_file)
+        self.assertEqual(set(results), set(paths))
+        # the first 10 files are the burst
+        self.assertAlmostEqual(self.fs.clock.now, 2.0)
+
+    def test_bytes_per_second(self):
+        paths = [self.fs.add_file(os.path.join("album", "{:02}.flac".format(i)), size=1 << 20) for i in range(5)]
+        _scheduler(self.fs, bytes_per_second=1 << 20).run(paths, self.fs.open_file)
+        self.assertAlmostEqual(self.fs.clock.now, 4.0)
+
+    def test_latency_is_not_throttled_twice(self):
+        self.fs.latency = 0.1
+        paths = [self.fs.add_file(os.path.join("album", "{:02}.flac".format(i))) for i in range(5)]
+        _scheduler(self.fs, files_per_second=100).run(paths, self.fs.open_file)
+        # a stat of the directory, then a stat and an open per file
+        self.assertAlmostEqual(self.fs.clock.now, 0.1 + 5 * 0.2)
+
+    def test_metadata_checks_use_operations(self):
+        paths = [self.fs.add_file(os.path.join("album", "{:02}.flac".format(i)), size=1 << 30) for i in range(10)]
+        stats = self.fs.stats
+        results = _scheduler(self.fs, bytes_per_second=1, files_per_second=1, operations_per_second=5).run(paths, self.fs.open_file, read=False)
+        self.assertEqual(len(results), 10)
+        # only the directory is stat'ed, the file sizes aren't charged
+        self.assertEqual(self.fs.stats - stats, 1)
+        self.assertAlmostEqual(self.fs.clock.now, 1.0)
+
+    def test_busy_waits(self):
+        paths = [self.fs.add_file(os.path.join("album", "01.flac"))]
+        polls = []
+
+        def is_busy() -> bool:
+            polls.append(self.fs.clock.now)
+            return len(polls) <= 3
+
+        _scheduler(self.fs, is_busy=is_busy, busy_poll=0.5).run(paths, self.fs.open_file)
+        self.assertEqual(self.fs.read, paths)
+        self.assertAlmostEqual(self.fs.clock.now, 1.5)
+
+    def test_failed_reads_are_left_out(self):
+        paths = [self.fs.add_file(os.path.join("album", "01.flac")), os.path.join(ROOT, "album", "missing.flac")]
+        results = _scheduler(self.fs).run(paths, self.fs.open_file)
+        self.assertEqual(list(results), paths[:1])
+
+
+class PriorityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fs = SlowFileSystem(FakeClock())
+        self.paths = dict()
+        for name, mtime in (("old", 1.0), ("recent", 3.0), ("browsed", 2.0)):
+            self.fs.add_directory(name, mtime)
+            self.paths[name] = [self.fs.add_file(os.path.join(name, "{:02}.flac".format(i))) for i in range(3)]
+        self.all_paths = [path for paths in self.paths.values() for path in paths]
+
+    def _directories(self) -> list:
+        directories = []
+        for path in self.fs.read:
+            directory = os.path.basename(os.path.dirname(path))
+            if not directories or directories[-1] != directory:
+                directories.append(directory)
+        return directories
+
+    def test_recently_modified_first(self):
+        _scheduler(self.fs).run(self.all_paths, self.fs.open_file)
+        self.assertEqual(self._directories(), ["recent", "browsed", "old"])
+        self.assertEqual(self.fs.read[:3], self.paths["recent"])
+
+    def test_browsed_first(self):
+        scheduler = _scheduler(self.fs)
+        scheduler.prioritize(os.path.join(ROOT, "browsed"))
+        scheduler.run(self.all_paths, self.fs.open_file)
+        self.assertEqual(self._directories(), ["browsed", "recent", "old"])
+
+    def test_prioritize_during_run(self):
+        scheduler = _scheduler(self.fs)
+
+        def open_file(path: str) -> str:
+            if not self.fs.read:
+                scheduler.prioritize(os.path.join(ROOT, "old"))
+            return self.fs.open_file(path)
+
+        scheduler.run(self.all_paths, open_file)
+        # the prioritized directory goes before the rest of the one being read
+        self.assertEqual(self._directories(), ["recent", "old", "recent", "browsed"])
+
+    def test_prioritize_reaches_concurrent_runs(self):
+        self.fs.add_directory("other", 0.5)
+        other = [self.fs.add_file(os.path.join("other", "{:02}.flac".format(i))) for i in range(3)]
+        scheduler = _scheduler(self.fs)
+        started = threading.Barrier(3)
+        prioritized = threading.Barrier(3)
+        runs = {"first": (self.paths["recent"] + self.paths["old"], []), "second": (self.paths["browsed"] + other, [])}
+
+        def run(name: str) -> None:
+            paths, read = runs[name]
+
+            def open_file(path: str) -> str:
+                if not read:
+                    started.wait()
+                    prioritized.wait()
+                read.append(path)
+                return path
+
+            scheduler.run(paths, open_file)
+
+        threads = [threading.Thread(target=run, args=(name,)) for name in runs]
+        for thread in threads:
+            thread.start()
+        # both runs are reading the first file of their most recent directory
+        started.wait()
+        scheduler.prioritize(os.path.join(ROOT, "old"))
+        scheduler.prioritize(os.path.join(ROOT, "other"))
+        prioritized.wait()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(runs["first"][1], self.paths["recent"][:1] + self.paths["old"] + self.paths["recent"][1:])
+        self.assertEqual(runs["second"][1], self.paths["browsed"][:1] + other + self.paths["browsed"][1:])
+        self.assertFalse(scheduler._runs)
+
+
+class HungMountTest(unittest.TestCase):
+    """A mount which stops answering only stalls its own reads"""
+
+    def setUp(self):
+        self.fs = SlowFileSystem(FakeClock())
+        self.hung = os.path.join(os.sep, "nas", "hung")
+        self.released = threading.Event()
+        self.healthy = [self.fs.add_file(os.path.join("album", "{:02}.flac".format(i))) for i in range(5)]
+        self.fs.add_directory("album")
+        self.blocked = [os.path.join(self.hung, "album", "{:02}.flac".format(i)) for i in range(5)]
+        self.healthy_read = threading.Event()
+
+    def _mount_of(self, directory: str) -> str:
+        return self.hung if directory.startswith(self.hung) else ROOT
+
+    def _stat(self, path: str) -> _Stat:
+        if path.startswith(self.hung):
+            self.released.wait(10)
+            return _Stat()
+        return self.fs.stat(path)
+
+    def _open_file(self, path: str) -> str:
+        self.fs.open_file(path)
+        if all(healthy in self.fs.read for healthy in self.healthy):
+            self.healthy_read.set()
+        return path
+
+    def _in_thread(self, function, *args) -> threading.Thread:
+        thread = threading.Thread(target=function, args=args, daemon=True)
+        thread.start()
+        return thread
+
+    def test_other_mounts_progress(self):
+        scheduler = ScanScheduler(mount_of=self._mount_of, stat=self._stat, workers_per_mount=1)
+        results = dict()
+        run = self._in_thread(lambda: results.update(scheduler.run(self.healthy + self.blocked, self._open_file)))
+        try:
+            self.assertTrue(self.healthy_read.wait(5))
+            # prioritize doesn't wait for the hung mount either
+            prioritize = self._in_thread(scheduler.prioritize, os.path.join(self.hung, "album"))
+            prioritize.join(5)
+            self.assertFalse(prioritize.is_alive())
+            self.assertTrue(run.is_alive())
+        finally:
+            self.released.set()
+        run.join(5)
+        self.assertEqual(set(results), set(self.healthy + self.blocked))
+
+    def test_other_runs_progress_while_a_mount_point_is_resolved(self):
+        def mount_of(directory: str) -> str:
+            if directory.startswith(self.hung):
+                self.released.wait(10)
+            return self._mount_of(directory)
+
+        scheduler = ScanScheduler(mount_of=mount_of, stat=self._stat, workers_per_mount=1)
+        hung_run = self._in_thread(scheduler.run, self.blocked, self._open_file)
+        try:
+            healthy_run = self._in_thread(scheduler.run, self.healthy, self._open_file)
+            healthy_run.join(5)
+            self.assertFalse(healthy_run.is_alive())
+            self.assertTrue(self.healthy_read.is_set())
+        finally:
+            self.released.set()
+        hung_run.join(5)
+        self.assertFalse(hung_run.is_alive())
+
+
+class WalkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fs = SlowFileSystem(FakeClock(), latency=0.01)
+        for artist in range(3):
+            for album in range(3):
+                directory = self.fs.add_directory(os.path.join("artist{}".format(artist)))
+                self.fs.add_directory(os.path.join(directory, "album{}".format(album)))
+                for track in range(4):
+                    self.fs.add_file(os.path.join(directory, "album{}".format(album), "{:02}.flac".format(track)))
+
+    def test_walk_lists_every_directory(self):
+        walked = {directory: set(files) for directory, _, files in _scheduler(self.fs).walk(ROOT)}
+        self.assertEqual(set(walked), set(self.fs.directories))
+        self.assertEqual(sum(len(files) for files in walked.values()), len(self.fs.files))
+
+    def test_walk_is_throttled(self):
+        self.fs.latency = 0.0
+        list(_scheduler(self.fs, operations_per_second=4).walk(ROOT))
+        # 13 listings, 4 of them in the burst
+        self.assertEqual(self.fs.listings, 13)
+        self.assertAlmostEqual(self.fs.clock.now, 9 / 4)
+
+    def test_walk_prunes_and_prioritizes(self):
+        scheduler = _scheduler(self.fs)
+        scheduler.prioritize(os.path.join(ROOT, "artist2"))
+        order = []
+        for directory, dirs, _ in scheduler.walk(ROOT):
+            order.append(directory)
+            if directory == ROOT:
+                dirs.remove("artist1")
+        self.assertEqual(order[1], os.path.join(ROOT, "artist2"))
+        self.assertFalse(any(directory.startswith(os.path.join(ROOT, "artist1")) for directory in order))
+        self.assertEqual(len(order), 9)
+
+    def test_library_walks_through_the_scheduler(self):
+        library = Library(ROOT)
+        library.excluded.add(os.path.join(ROOT, "artist0"))
+        paths = library.untracked_paths(scheduler=_scheduler(self.fs))
+        self.assertEqual(self.fs.listings, 9)
+        self.assertEqual(paths, sorted(path for path in self.fs.files if not path.startswith(os.path.join(ROOT, "artist0"))))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from library_xml import startup
+from library_xml.import_library import Library
+from library_xml.paged import _synthetic_track
+
+
+class StartupBudgetTest(unittest.TestCase):
+    """The warm start of a library of 10k tracks stays within startup.BUDGET"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        library = Library(os.path.join(os.sep, "music"))
+        library.extend(_synthetic_track(i) for i in range(10000))
+        cls.xml_path = os.path.join(cls.directory, "library.xml")
+        with open(cls.xml_path, "w", encoding="utf-8") as file:
+            file.write(library.to_xml())
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def setUp(self):
+        # the measured interpreters find the packages from any working directory
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.directory)
+
+    def test_budget(self):
+        result = startup.check(self.xml_path, os.path.join(self.directory, "library.cache"))
+        self.assertEqual(result["over_budget"], [], {name: result[name] for name in startup.BUDGET})
+
+    def test_import_times(self):
+        times = startup.import_times()
+        self.assertEqual(times[-1][0], "library_xml.import_library")
+
+
+if __name__ == "__main__":
+    unittest.main()